@@ -0,0 +1,188 @@
+"""
+Behavior characterizations (BCs), selectable from the experiment JSON through the policy args:
+
+    "policy": {"type": "ESAtariPolicy", "args": {"bc": {"type": "frostbite_ice", "every": 4, "size": 64}}}
+    "policy": {"type": "MujocoPolicy", "args": {..., "bc": {"type": "com_traj", "every": 10}}}
+
+A BC is evaluated every `every` steps (or only once at the end of the episode with "at_end": true). Atari BCs look
+at the raw RGB screen, not at the warped/stacked observation the network sees. With "pad" or "size" set, the samples
+are padded with the last value up to the episode horizon (the same convention nses.euclidean_distance uses for
+shorter vectors), and with "size" additionally average-pooled into a fixed-length vector, so BCs don't grow with
+episode length.
+"""
+import numpy as np
+
+_registry = {}
+
+
+def register(name):
+    def _register(cls):
+        _registry[name] = cls
+        return cls
+    return _register
+
+
+def make_bc(spec=None):
+    """spec is None (the Frostbite stepped-on-ice count, one sample per step), a registered name or a dict with a
+    'type' and the BC's arguments"""
+    if spec is None:
+        spec = {'type': 'frostbite_ice'}
+    elif isinstance(spec, str):
+        spec = {'type': spec}
+    if spec['type'] not in _registry:
+        raise NotImplementedError(spec['type'])
+    return _registry[spec['type']](**{k: v for k, v in spec.items() if k != 'type'})
+
+
+def pack_rgb(color):
+    r, g, b = color
+    return (int(r) << 16) | (int(g) << 8) | int(b)
+
+
+class BehaviorCharacterization(object):
+    dim = 1
+    time_major = True  # False flattens to [all samples of dim 0, all samples of dim 1, ...]
+
+    def __init__(self, every=1, at_end=False, size=None, pad=False):
+        assert every >= 1 and (size is None or size >= 1)
+        self.every = every
+        self.at_end = at_end
+        self.size = size
+        self.pad = pad
+        self.values = None
+        self.count = 0
+
+    def evaluate(self, env):
+        raise NotImplementedError
+
+    def reset(self, timestep_limit):
+        num_samples = 1 if self.at_end else -(-timestep_limit // self.every)
+        if self.values is None or len(self.values) != num_samples:
+            self.values = np.zeros((num_samples, self.dim), dtype=np.float32)
+        self.count = 0
+
+    def step(self, env, t):
+        """Called after the t-th env step of the episode (t starts at 1)"""
+        if not self.at_end and (t - 1) % self.every == 0:
+            self.values[self.count] = self.evaluate(env)
+            self.count += 1
+
+    def end(self, env):
+        if self.at_end:
+            self.values[0] = self.evaluate(env)
+            self.count = 1
+        return self.result()
+
+    def result(self):
+        if self.size is None and not self.pad:
+            values = self.values[:self.count]
+        else:
+            values = self.values
+            if self.count == 0:
+                values[:] = 0
+            else:
+                values[self.count:] = values[self.count - 1]
+            if self.size is None:
+                pass
+            elif len(values) >= self.size:
+                bounds = np.linspace(0, len(values), self.size + 1).astype(np.int64)
+                values = np.add.reduceat(values, bounds[:-1], axis=0) / np.diff(bounds)[:, None]
+            else:
+                values = values[np.linspace(0, len(values) - 1, self.size).round().astype(np.int64)]
+        if not self.time_major:
+            values = values.T
+        return values.astype(np.float32).ravel()
+
+
+@register('pixel_count')
+class PixelCountBC(BehaviorCharacterization):
+    """
+    Number of pixels within rows x cols of the RGB screen having any of the given colors. The screen region is packed
+    into one uint32 per pixel in a preallocated buffer and compared with the precomputed packed colors, so there are
+    no per-step temporaries.
+    """
+    def __init__(self, colors, rows=(None, None), cols=(None, None), **kwargs):
+        super(PixelCountBC, self).__init__(**kwargs)
+        self.targets = [np.uint32(pack_rgb(c)) for c in colors]
+        self.rows, self.cols = slice(*rows), slice(*cols)
+        self._packed = None
+        self._mask = None
+
+    def evaluate(self, env):
+        frame = env.unwrapped._get_image()[self.rows, self.cols]
+        if self._packed is None or self._packed.shape != frame.shape[:2]:
+            self._packed = np.empty(frame.shape[:2], dtype=np.uint32)
+            self._mask = np.empty(frame.shape[:2], dtype=np.bool_)
+        packed = self._packed
+        np.copyto(packed, frame[..., 0])
+        packed <<= 8
+        packed |= frame[..., 1]
+        packed <<= 8
+        packed |= frame[..., 2]
+        count = 0
+        for target in self.targets:
+            np.equal(packed, target, out=self._mask)
+            count += np.count_nonzero(self._mask)
+        return count
+
+
+@register('frostbite_ice')
+class FrostbiteIceBC(PixelCountBC):
+    """Stepped on ice in the water (see configurations/frostbite_info.txt)"""
+    def __init__(self, colors=((84, 138, 210),), rows=(78, 185), cols=(8, 160), **kwargs):
+        super(FrostbiteIceBC, self).__init__(colors, rows=rows, cols=cols, **kwargs)
+
+
+@register('ram')
+class RamBC(BehaviorCharacterization):
+    """The 128 bytes of console RAM, by default only at the end of the episode"""
+    dim = 128
+
+    def __init__(self, at_end=True, **kwargs):
+        super(RamBC, self).__init__(at_end=at_end, **kwargs)
+
+    def evaluate(self, env):
+        return env.unwrapped._get_ram()
+
+
+@register('maze_position')
+class MazePositionBC(BehaviorCharacterization):
+    """(x, y) of the hard maze navigator (HardMaze-v0), by default only at the end of the episode"""
+    dim = 2
+    time_major = False
+
+    def __init__(self, at_end=True, **kwargs):
+        super(MazePositionBC, self).__init__(at_end=at_end, **kwargs)
+
+    def evaluate(self, env):
+        return env.unwrapped.position
+
+
+@register('com')
+class CenterOfMassBC(BehaviorCharacterization):
+    """
+    (x, y) of the MuJoCo model's center of mass, by default only at the end of the episode. The mass weights are
+    computed once per model instead of on every evaluation.
+    """
+    dim = 2
+    time_major = False
+
+    def __init__(self, at_end=True, **kwargs):
+        super(CenterOfMassBC, self).__init__(at_end=at_end, **kwargs)
+        self._model = None
+        self._weights = None
+
+    def evaluate(self, env):
+        model = env.unwrapped.model
+        if model is not self._model:
+            mass = np.asarray(model.body_mass, dtype=np.float64).ravel()
+            self._weights = mass / mass.sum()
+            self._model = model
+        return np.dot(self._weights, model.data.xipos)[:2]
+
+
+@register('com_traj')
+class CenterOfMassTrajectoryBC(CenterOfMassBC):
+    """Center of mass trajectory, padded with the final position to a fixed length"""
+    def __init__(self, at_end=False, pad=True, **kwargs):
+        super(CenterOfMassTrajectoryBC, self).__init__(at_end=at_end, pad=pad, **kwargs)
@@ -15,6 +15,21 @@ TASK_DATA_KEY = 'es:task_data'
 TASK_CHANNEL = 'es:task_channel'
 RESULTS_KEY = 'es:results'
 ARCHIVE_KEY = 'es:archive'
+ARCHIVE_EPOCH_KEY = 'es:archive_epoch'
+LINEAGE_KEY = 'es:lineage'
+
+_worker_slot = None
+
+
+def set_worker_slot(results_counter, ready_times, index):
+    """
+    Count every result this process pushes in results_counter[index] and record in ready_times[index] when it
+    first asks for a task (both shared arrays), so that the process supervising the workers can report their
+    throughput and startup latency.
+    """
+    global _worker_slot
+    _worker_slot = (results_counter, ready_times, index)
+
 
 def serialize(x):
     return pickle.dumps(x, protocol=-1)
@@ -24,6 +39,53 @@ def deserialize(x):
     return pickle.loads(x)
 
 
+# numpy is imported where it's used: main.py imports this module before limit_threads() has configured BLAS
+
+def encode_archive_entry(slot, bc):
+    # The archive is a log of (row, BC) writes, stored as an int32 row index followed by the raw float32 BC
+    import numpy as np
+    return np.int32(slot).tobytes() + np.asarray(bc, dtype=np.float32).ravel().tobytes()
+
+
+def decode_archive_entry(x):
+    import numpy as np
+    return int(np.frombuffer(x, dtype=np.int32, count=1)[0]), np.frombuffer(x, dtype=np.float32, offset=4)
+
+
+def read_archive_log(r, offset, epoch):
+    """
+    (epoch, entries) of the archive log from offset on. If the master compacted the log since epoch, the whole new
+    log is returned instead: it starts with a snapshot that rewrites every row of the archive.
+    """
+    new_epoch, entries = r.pipeline().get(ARCHIVE_EPOCH_KEY).lrange(ARCHIVE_KEY, offset, -1).execute()
+    if new_epoch != epoch:
+        new_epoch, entries = r.pipeline().get(ARCHIVE_EPOCH_KEY).lrange(ARCHIVE_KEY, 0, -1).execute()
+    return new_epoch, entries
+
+
+def replay_archive(entries):
+    archive = []
+    for slot, bc in entries:
+        if slot == len(archive):
+            archive.append(bc)
+        else:
+            archive[slot] = bc
+    return archive
+
+
+def encode_generation(parents, seeds, members):
+    # A GA generation is stored as int32: the number of new lineage nodes, their parents, their seeds, the members
+    import numpy as np
+    return np.concatenate([[len(seeds)], parents, seeds, members]).astype(np.int32).tobytes()
+
+
+def decode_generation(x):
+    import numpy as np
+    x = np.frombuffer(x, dtype=np.int32)
+    n = x[0]
+    return x[1:1 + n], x[1 + n:1 + 2 * n], x[1 + 2 * n:]
+
+
 def retry_connect(redis_cfg, tries=300, base_delay=4.):
     for i in range(tries):
         try:
@@ -59,11 +121,22 @@ def retry_get(pipe, key, tries=300, base_delay=4.):
     raise RuntimeError('{} not set'.format(key))
 
 
+def fetch_experiment(redis_cfg):
+    r = retry_connect(redis_cfg)
+    exp = deserialize(retry_get(r, EXP_KEY))
+    r.connection_pool.disconnect()
+    return exp
+
+
 class MasterClient:
     def __init__(self, master_redis_cfg):
         self.task_counter = 0
         self.master_redis = retry_connect(master_redis_cfg)
         logger.info('[master] Connected to Redis: {}'.format(self.master_redis))
+        # Relays and workers mirror the archive and the GA lineages by offset, so they must not carry over from a
+        # previous run
+        self.master_redis.delete(ARCHIVE_KEY, ARCHIVE_EPOCH_KEY, LINEAGE_KEY)
+        self.archive_log_size = 0
 
     def declare_experiment(self, exp):
         self.master_redis.set(EXP_KEY, serialize(exp))
@@ -89,18 +162,36 @@ class MasterClient:
     def flush_results(self):
         return max(self.master_redis.pipeline().llen(RESULTS_KEY).ltrim(RESULTS_KEY, -1, -1).execute()[0] -1, 0)
 
-    def add_to_novelty_archive(self, novelty_vector):
-        self.master_redis.rpush(ARCHIVE_KEY, serialize(novelty_vector))
-        logger.info('[master] Added novelty vector to archive')
+    def add_to_novelty_archive(self, novelty_vector, slot):
+        self.master_redis.rpush(ARCHIVE_KEY, encode_archive_entry(slot, novelty_vector))
+        self.archive_log_size += 1
+        logger.info('[master] Wrote novelty vector to archive row {}'.format(slot))
+
+    def publish_archive(self, bcs):
+        """
+        Replaces the archive log with a snapshot of the whole archive (one write per row) and bumps the archive
+        epoch, so that relays and workers start over from the snapshot. Used on resume, and to compact the log once
+        evictions made it longer than the archive.
+        """
+        pipe = self.master_redis.pipeline().delete(ARCHIVE_KEY)
+        if bcs:
+            pipe.rpush(ARCHIVE_KEY, *[encode_archive_entry(slot, bc) for slot, bc in enumerate(bcs)])
+        pipe.incr(ARCHIVE_EPOCH_KEY).execute()
+        self.archive_log_size = len(bcs)
+        logger.info('[master] Wrote a snapshot of {} novelty vectors to the archive'.format(len(bcs)))
 
     def get_archive(self):
-        archive = self.master_redis.lrange(ARCHIVE_KEY, 0, -1)
-        return [deserialize(novelty_vector) for novelty_vector in archive]
+        return replay_archive(decode_archive_entry(x) for x in self.master_redis.lrange(ARCHIVE_KEY, 0, -1))
+
+    def add_generation(self, parents, seeds, members):
+        self.master_redis.rpush(LINEAGE_KEY, encode_generation(parents, seeds, members))
+        logger.debug('[master] Wrote generation with {} new nodes to the lineage table'.format(len(seeds)))
 
 
 class RelayClient:
     """
     Receives and stores task broadcasts from the master
+    Mirrors the novelty archive and the GA lineage table of the master
     Batches and pushes results from workers to the master
     """
 
@@ -110,10 +201,17 @@ class RelayClient:
         self.local_redis = retry_connect(relay_redis_cfg)
         logger.info('[relay] Connected to relay: {}'.format(self.local_redis))
         self.results_published = 0
+        self.log_sizes = {ARCHIVE_KEY: 0, LINEAGE_KEY: 0}
+        self.archive_epoch = None
+        self.flush_on_task = True
 
     def run(self):
         # Initialization: read exp and latest task from master
-        self.local_redis.set(EXP_KEY, retry_get(self.master_redis, EXP_KEY))
+        exp = retry_get(self.master_redis, EXP_KEY)
+        self.local_redis.set(EXP_KEY, exp)
+        # The steady-state GA folds in results of earlier tasks, so they must not be flushed on a new task
+        self.flush_on_task = 'steady_state' not in deserialize(exp)
+        self.local_redis.delete(ARCHIVE_EPOCH_KEY, *self.log_sizes)
         self._declare_task_local(*retry_get(self.master_redis, (TASK_ID_KEY, TASK_DATA_KEY)))
 
         # Start subscribing to tasks
@@ -143,21 +241,53 @@ class RelayClient:
         logger.warning('[relay] Flushed {} results from worker redis and {} from master'
             .format(number_flushed, number_flushed_master))
 
+    def _sync_logs(self):
+        # The master extends the archive and the lineage table before declaring the task that depends on them, so
+        # syncing before publishing a task locally guarantees workers see all entries they need
+        epoch, entries = read_archive_log(self.master_redis, self.log_sizes[ARCHIVE_KEY], self.archive_epoch)
+        if epoch != self.archive_epoch:
+            # The master compacted the archive log, replace the local one and its epoch at once
+            pipe = self.local_redis.pipeline().delete(ARCHIVE_KEY)
+            if entries:
+                pipe.rpush(ARCHIVE_KEY, *entries)
+            if epoch is None:
+                pipe.delete(ARCHIVE_EPOCH_KEY)
+            else:
+                pipe.set(ARCHIVE_EPOCH_KEY, epoch)
+            pipe.execute()
+            self.archive_epoch, self.log_sizes[ARCHIVE_KEY] = epoch, len(entries)
+            logger.info('[relay] Mirrored archive snapshot {} ({} entries)'.format(epoch, len(entries)))
+        elif entries:
+            self.local_redis.rpush(ARCHIVE_KEY, *entries)
+            self.log_sizes[ARCHIVE_KEY] += len(entries)
+            logger.info('[relay] Mirrored {} new {} entries ({} total)'.format(
+                len(entries), ARCHIVE_KEY, self.log_sizes[ARCHIVE_KEY]))
+        new_entries = self.master_redis.lrange(LINEAGE_KEY, self.log_sizes[LINEAGE_KEY], -1)
+        if new_entries:
+            self.local_redis.rpush(LINEAGE_KEY, *new_entries)
+            self.log_sizes[LINEAGE_KEY] += len(new_entries)
+            logger.info('[relay] Mirrored {} new {} entries ({} total)'.format(
+                len(new_entries), LINEAGE_KEY, self.log_sizes[LINEAGE_KEY]))
+
     def _declare_task_local(self, task_id, task_data):
         logger.info('[relay] Received task {}'.format(task_id))
         self.results_published = 0
+        self._sync_logs()
         self.local_redis.mset({TASK_ID_KEY: task_id, TASK_DATA_KEY: task_data})
-        self.flush_results()
+        if self.flush_on_task:
+            self.flush_results()
 
 
 class WorkerClient:
     def __init__(self, relay_redis_cfg, master_redis_cfg):
+        # Everything, including the novelty archive, is read from the relay, so master_redis_cfg is unused
         self.local_redis = retry_connect(relay_redis_cfg)
         logger.info('[worker] Connected to relay: {}'.format(self.local_redis))
-        self.master_redis = retry_connect(master_redis_cfg)
-        logger.warning('[worker] Connected to master: {}'.format(self.master_redis))
 
         self.cached_task_id, self.cached_task_data = None, None
+        self.archive_offset = 0
+        self.archive_epoch = None
+        self.lineage_offset = 0
 
     def get_experiment(self):
         # Grab experiment info
@@ -166,10 +296,32 @@ class WorkerClient:
         return exp
 
     def get_archive(self):
-        archive = self.master_redis.lrange(ARCHIVE_KEY, 0, -1)
-        return [deserialize(novelty_vector) for novelty_vector in archive]
+        return replay_archive(decode_archive_entry(x) for x in self.local_redis.lrange(ARCHIVE_KEY, 0, -1))
+
+    def get_archive_updates(self):
+        """
+        (row, BC) archive writes since the last call, in order. After a compaction of the log these are all the rows
+        of the archive, which overwrite the rows already mirrored.
+        """
+        epoch, new_entries = read_archive_log(self.local_redis, self.archive_offset, self.archive_epoch)
+        if epoch != self.archive_epoch:
+            self.archive_epoch, self.archive_offset = epoch, 0
+        self.archive_offset += len(new_entries)
+        return [decode_archive_entry(x) for x in new_entries]
+
+    def get_lineage_updates(self):
+        """
+        (parents, seeds, members) of the GA generations declared since the last call, in order
+        """
+        new_entries = self.local_redis.lrange(LINEAGE_KEY, self.lineage_offset, -1)
+        self.lineage_offset += len(new_entries)
+        return [decode_generation(x) for x in new_entries]
 
     def get_current_task(self):
+        if _worker_slot is not None:
+            _, ready_times, index = _worker_slot
+            if ready_times[index] == 0:
+                ready_times[index] = time.time()
         with self.local_redis.pipeline() as pipe:
             while True:
                 try:
@@ -189,4 +341,7 @@ class WorkerClient:
 
     def push_result(self, task_id, result):
         self.local_redis.rpush(RESULTS_KEY, serialize((task_id, result)))
+        if _worker_slot is not None:
+            results_counter, _, index = _worker_slot
+            results_counter[index] += 1
         logger.debug('[worker] Pushed result for task {}'.format(task_id))
@@ -1,3 +1,4 @@
+import json
 import logging
 import time
 from collections import namedtuple
@@ -19,7 +20,8 @@ Result = namedtuple('Result', [
     'worker_id',
     'noise_inds_n', 'returns_n2', 'signreturns_n2', 'lengths_n2',
     'eval_return', 'eval_length',
-    'ob_sum', 'ob_sumsq', 'ob_count'
+    'ob_sum', 'ob_sumsq', 'ob_count',
+    'worker_stats'
 ])
 
 
@@ -67,6 +69,50 @@ class SharedNoiseTable(object):
         return stream.randint(0, len(self.noise) - dim + 1)
 
 
+class ChunkSizeController(object):
+    """
+    Sizes the chunks of rollouts a worker batches into one result.
+
+    Keeps a moving average of the time taken by one chunk item (an antithetic pair for ES, one offspring for the GA)
+    and picks the chunk size so that each worker pushes about target_result_rate results per second. A chunk is cut
+    short once it has been running for max_result_latency seconds, so long episodes never produce one huge, late result.
+    """
+    def __init__(self, target_result_rate=5., max_result_latency=30., min_chunk_size=1, max_chunk_size=10000, decay=0.9):
+        assert target_result_rate > 0 and max_result_latency > 0 and 1 <= min_chunk_size <= max_chunk_size
+        self.target_result_rate = target_result_rate
+        self.max_result_latency = max_result_latency
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.decay = decay
+        self.mean_item_time = None
+        self.chunk_size = min_chunk_size
+
+    def should_continue(self, num_items, elapsed):
+        if num_items < self.min_chunk_size:
+            return True
+        return num_items < self.chunk_size and elapsed < self.max_result_latency
+
+    def update(self, num_items, elapsed):
+        if num_items == 0:
+            return
+        item_time = max(elapsed / num_items, 1e-6)
+        if self.mean_item_time is None:
+            self.mean_item_time = item_time
+        else:
+            self.mean_item_time = self.decay * self.mean_item_time + (1. - self.decay) * item_time
+        chunk_time = min(1. / self.target_result_rate, self.max_result_latency)
+        self.chunk_size = int(np.clip(chunk_time / self.mean_item_time, self.min_chunk_size, self.max_chunk_size))
+
+    @property
+    def stats(self):
+        return {'chunk_size': self.chunk_size, 'item_time': self.mean_item_time}
+
+
+def mean_worker_stat(results, key):
+    vals = [r.worker_stats[key] for r in results if r.worker_stats and r.worker_stats.get(key) is not None]
+    return np.mean(vals) if vals else np.nan
+
+
 def compute_ranks(x):
     """
     Returns ranks in [0, len(x))
@@ -122,18 +168,85 @@ def batched_weighted_sum(weights, vecs, batch_size):
     return total, num_items_summed
 
 
+_preloaded_policy = None
+
+
+def policy_spec(exp):
+    return exp['env_id'], exp['policy']['type'], json.dumps(exp['policy']['args'], sort_keys=True)
+
+
+def preload(exp, wrap_atari=None):
+    """
+    Fork-safe part of worker setup, done once in the process the workers are forked from: imports gym (which
+    registers the envs), tensorflow and the wrappers, and builds the policy graph in the default graph. No session
+    is created and the env used to read the spaces is closed again, so forked workers only build their own env and
+    session and initialize the variables.
+    """
+    global _preloaded_policy
+    import gym
+    gym.undo_logger_setup()
+    import tensorflow
+    from . import policies
+    from .atari_wrappers import wrap_deepmind
+
+    if wrap_atari is None:
+        wrap_atari = exp['policy']['type'] == "ESAtariPolicy"
+    import_env_modules(exp)
+    env = gym.make(exp['env_id'])
+    if wrap_atari:
+        env = wrap_deepmind(env)
+    ob_space, ac_space = env.observation_space, env.action_space
+    env.close()
+    policy = getattr(policies, exp['policy']['type'])(ob_space, ac_space, **exp['policy']['args'])
+    _preloaded_policy = (policy_spec(exp), policy)
+
+
+def import_env_modules(exp):
+    """
+    Imports the modules listed in env_modules, which register additional gym envs (e.g. gym_tensorflow.maze.np_maze
+    for HardMaze-v0)
+    """
+    import importlib
+    for name in exp.get('env_modules', []):
+        importlib.import_module(name)
+
+
+def make_policy(exp, ob_space, ac_space):
+    """
+    Returns the policy preload() built for this experiment, if this process was forked from a preloaded template,
+    and builds a new one otherwise. Either way the caller still has to initialize the variables. Must be called
+    before a session is created, as a preloaded policy that doesn't match is dropped with its default graph.
+    """
+    global _preloaded_policy
+    import tensorflow as tf
+    from . import policies
+    if _preloaded_policy is not None:
+        spec, policy = _preloaded_policy
+        _preloaded_policy = None
+        if spec == policy_spec(exp):
+            logger.info('Using preloaded policy')
+            return policy
+        logger.warning('Preloaded policy {} does not match the experiment {}, building a new one'.format(
+            spec, policy_spec(exp)))
+        # The policies create their variables under a scope named after their type
+        tf.reset_default_graph()
+    return getattr(policies, exp['policy']['type'])(ob_space, ac_space, **exp['policy']['args'])
+
+
 def setup(exp, single_threaded):
     import gym
     gym.undo_logger_setup()
-    from . import policies, tf_util
+    from . import tf_util
 
     config = Config(**exp['config'])
+    import_env_modules(exp)
     env = gym.make(exp['env_id'])
     if exp['policy']['type'] == "ESAtariPolicy":
         from .atari_wrappers import wrap_deepmind
         env = wrap_deepmind(env)
+    # The policy is built before the session, make_policy may have to reset the default graph
+    policy = make_policy(exp, env.observation_space, env.action_space)
     sess = make_session(single_threaded=single_threaded)
-    policy = getattr(policies, exp['policy']['type'])(env.observation_space, env.action_space, **exp['policy']['args'])
     tf_util.initialize()
     return config, env, sess, policy
 
@@ -337,6 +450,8 @@ def run_master(master_redis_cfg, log_dir, exp):
         tlogger.record_tabular("UniqueWorkersFrac", num_unique_workers / len(worker_ids))
         tlogger.record_tabular("ResultsSkippedFrac", frac_results_skipped)
         tlogger.record_tabular("ObCount", ob_count_this_batch)
+        tlogger.record_tabular("WorkerChunkSizeMean", mean_worker_stat(curr_task_results, 'chunk_size'))
+        tlogger.record_tabular("WorkerChunkItemTimeMean", mean_worker_stat(curr_task_results, 'item_time'))
 
         tlogger.record_tabular("TimeElapsedThisIter", step_tend - step_tstart)
         tlogger.record_tabular("TimeElapsed", step_tend - tstart)
@@ -363,11 +478,12 @@ def rollout_and_update_ob_stat(policy, env, timestep_limit, rs, task_ob_stat, ca
     return rollout_rews, rollout_len, rollout_nov
 
 
-def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2):
+def run_worker(master_redis_cfg, relay_redis_cfg, noise):
     logger.info('run_worker: {}'.format(locals()))
     assert isinstance(noise, SharedNoiseTable)
     worker = WorkerClient(relay_redis_cfg, master_redis_cfg)
     exp = worker.get_experiment()
+    chunker = ChunkSizeController(**exp.get('chunking', {}))
     config, env, sess, policy = setup(exp, single_threaded=True)
     rs = np.random.RandomState()
     worker_id = rs.randint(2 ** 31)
@@ -401,14 +517,16 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 eval_length=eval_length,
                 ob_sum=None,
                 ob_sumsq=None,
-                ob_count=None
+                ob_count=None,
+                worker_stats=None
             ))
         else:
             # Rollouts with noise
             noise_inds, returns, signreturns, lengths = [], [], [], []
             task_ob_stat = RunningStat(env.observation_space.shape, eps=0.)  # eps=0 because we're incrementing only
 
-            while not noise_inds or time.time() - task_tstart < min_task_runtime:
+            chunk_tstart = time.time()
+            while chunker.should_continue(len(noise_inds), time.time() - chunk_tstart):
                 noise_idx = noise.sample_index(rs, policy.num_params)
                 v = config.noise_stdev * noise.get(noise_idx, policy.num_params)
 
@@ -425,6 +543,7 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 returns.append([rews_pos.sum(), rews_neg.sum()])
                 lengths.append([len_pos, len_neg])
 
+            chunker.update(len(noise_inds), time.time() - chunk_tstart)
             worker.push_result(task_id, Result(
                 worker_id=worker_id,
                 noise_inds_n=np.array(noise_inds),
@@ -435,5 +554,6 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 eval_length=None,
                 ob_sum=None if task_ob_stat.count == 0 else task_ob_stat.sum,
                 ob_sumsq=None if task_ob_stat.count == 0 else task_ob_stat.sumsq,
-                ob_count=task_ob_stat.count
+                ob_count=task_ob_stat.count,
+                worker_stats=chunker.stats
             ))
@@ -1,21 +1,180 @@
+from collections import OrderedDict
+
 from .es import *
 
 
-GATask = namedtuple('GATask', ['params', 'population', 'ob_mean', 'ob_std', 'timestep_limit'])
+GATask = namedtuple('GATask', ['params', 'generation', 'ob_mean', 'ob_std', 'timestep_limit'])
+
+
+class GenerationTable(object):
+    """
+    Seed lineages of the GA populations, as a table of nodes that each hold a parent node (-1 for none) and a noise
+    seed (-1 for none). A generation adds the nodes of its new offspring and lists its members, which are new nodes or
+    nodes of earlier generations (elites, or survivors in steady-state mode). Lineages share their prefixes through
+    the parent pointers, so a generation takes a few int32 per member to store and to broadcast, no matter how long
+    the lineages get.
+    """
+
+    def __init__(self, initial_capacity=4096):
+        self.parents = np.empty(initial_capacity, dtype=np.int32)
+        self.seeds = np.empty(initial_capacity, dtype=np.int32)
+        self.num_nodes = 0
+        self.members = []
+        self._generation_start = 0  # first node added after the last generation
+
+    def __len__(self):
+        return len(self.members)
+
+    def _reserve(self, n):
+        if self.num_nodes + n > len(self.seeds):
+            capacity = max(self.num_nodes + n, 2 * len(self.seeds))
+            self.parents = np.resize(self.parents, capacity)
+            self.seeds = np.resize(self.seeds, capacity)
+
+    def add_node(self, parent, seed):
+        self._reserve(1)
+        self.parents[self.num_nodes], self.seeds[self.num_nodes] = parent, seed
+        self.num_nodes += 1
+        return self.num_nodes - 1
+
+    def add_generation(self, members):
+        """
+        Declares a generation made of the given nodes, returns its delta for apply(): the (parents, seeds) of the
+        nodes added since the previous generation and the members
+        """
+        parents = self.parents[self._generation_start:self.num_nodes].copy()
+        seeds = self.seeds[self._generation_start:self.num_nodes].copy()
+        self._generation_start = self.num_nodes
+        self.members.append(np.asarray(members, dtype=np.int32))
+        return parents, seeds, self.members[-1]
+
+    def apply(self, parents, seeds, members):
+        self._reserve(len(seeds))
+        self.parents[self.num_nodes:self.num_nodes + len(seeds)] = parents
+        self.seeds[self.num_nodes:self.num_nodes + len(seeds)] = seeds
+        self.num_nodes += len(seeds)
+        self._generation_start = self.num_nodes
+        self.members.append(np.asarray(members, dtype=np.int32))
+
+    def lineage(self, node):
+        """
+        Seeds of the lineage ending in node, oldest first
+        """
+        seeds = []
+        while node >= 0:
+            if self.seeds[node] >= 0:
+                seeds.append(int(self.seeds[node]))
+            node = self.parents[node]
+        return tuple(reversed(seeds))
+
+    def flatten(self, gen):
+        """
+        Lineages of all members of generation gen as flattened int32 seeds and offsets: the seeds of member i are
+        flat[offsets[i]:offsets[i + 1]]
+        """
+        # Walk up from all members at once, one ancestor per row, then read the columns back oldest first
+        nodes = self.members[gen]
+        ancestry = []
+        while (nodes >= 0).any():
+            valid = nodes >= 0
+            ancestry.append(np.where(valid, self.seeds[np.maximum(nodes, 0)], -1))
+            nodes = np.where(valid, self.parents[np.maximum(nodes, 0)], -1)
+        ancestry = np.array(ancestry[::-1], dtype=np.int32).reshape(-1, len(nodes))
+        mask = ancestry >= 0
+        flat = ancestry.T[mask.T]
+        offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(mask.sum(axis=0), out=offsets[1:])
+        return flat, offsets
+
+
+class ParamCache(object):
+    """
+    LRU cache of parameters reconstructed from seed lineages, bounded by max_mb megabytes.
+
+    The parameters of [s0, s1, ..., sn] are the policy initialization drawn from s0 plus noise_stdev times the noise
+    slices of s1..sn. Parents are cached by their seed tuple, so that an offspring costs a single noise add when its
+    parent was seen before, and otherwise starts from the longest cached prefix of its lineage.
+    """
+
+    def __init__(self, policy, noise, noise_stdev, max_mb=256):
+        self.policy, self.noise, self.noise_stdev = policy, noise, noise_stdev
+        self.capacity = max(1, int(max_mb * 2 ** 20 // (4 * policy.num_params)))
+        self._cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def _lookup(self, seeds):
+        theta = self._cache.get(seeds)
+        if theta is not None:
+            self._cache.move_to_end(seeds)
+        return theta
+
+    def _insert(self, seeds, theta):
+        self._cache[seeds] = theta
+        if len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    def _initial(self, seed):
+        self.policy.set_trainable_flat(self.noise.get(seed, self.policy.num_params))
+        self.policy.reinitialize()
+        return self.policy.get_trainable_flat()
+
+    def _reconstruct(self, seeds):
+        # Deepest cached ancestor (or the lineage itself), then add the remaining noise slices
+        for i in range(len(seeds), 0, -1):
+            theta = self._lookup(seeds[:i])
+            if theta is not None:
+                v = theta.copy()
+                break
+        else:
+            i = 1
+            v = self._initial(seeds[0])
+        for seed in seeds[i:]:
+            v += self.noise_stdev * self.noise.get(seed, self.policy.num_params)
+        return v
+
+    def get(self, seeds):
+        """
+        Parameters of the lineage seeds, whose parent (all but the last seed) is kept in the cache
+        """
+        seeds = tuple(seeds)
+        if len(seeds) == 1:
+            return self._initial(seeds[0])
+        parent = seeds[:-1]
+        theta = self._lookup(parent)
+        if theta is None:
+            self.misses += 1
+            theta = self._reconstruct(parent)
+            self._insert(parent, theta)
+        else:
+            self.hits += 1
+        v = theta.copy()
+        v += self.noise_stdev * self.noise.get(seeds[-1], self.policy.num_params)
+        return v
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+
+def preload(exp):
+    from . import es
+    es.preload(exp, wrap_atari=exp['env_id'].endswith('NoFrameskip-v4'))
 
 
 def setup(exp, single_threaded):
     import gym
     gym.undo_logger_setup()
-    from . import policies, tf_util
+    from . import tf_util
 
     config = Config(**exp['config'])
+    import_env_modules(exp)
     env = gym.make(exp['env_id'])
     if exp['env_id'].endswith('NoFrameskip-v4'):
         from .atari_wrappers import wrap_deepmind
         env = wrap_deepmind(env)
+    # The policy is built before the session, make_policy may have to reset the default graph
+    policy = make_policy(exp, env.observation_space, env.action_space)
     sess = make_session(single_threaded=single_threaded)
-    policy = getattr(policies, exp['policy']['type'])(env.observation_space, env.action_space, **exp['policy']['args'])
     tf_util.initialize()
     return config, env, sess, policy
 
@@ -30,6 +189,118 @@ def rollout_and_update_ob_stat(policy, env, timestep_limit, rs, task_ob_stat, ca
     return rollout_rews, rollout_len
 
 
+def parse_episode_cutoff(episode_cutoff_mode):
+    """
+    (tslimit, incr_tslimit_threshold, tslimit_incr_ratio, adaptive_tslimit) of an episode_cutoff_mode
+    """
+    if isinstance(episode_cutoff_mode, int):
+        return episode_cutoff_mode, None, None, False
+    elif episode_cutoff_mode.startswith('adaptive:'):
+        _, args = episode_cutoff_mode.split(':')
+        arg0, arg1, arg2 = args.split(',')
+        tslimit, incr_tslimit_threshold, tslimit_incr_ratio = int(arg0), float(arg1), float(arg2)
+        logger.info(
+            'Starting timestep limit set to {}. When {}% of rollouts hit the limit, it will be increased by {}'.format(
+                tslimit, incr_tslimit_threshold * 100, tslimit_incr_ratio))
+        return tslimit, incr_tslimit_threshold, tslimit_incr_ratio, True
+    elif episode_cutoff_mode == 'env_default':
+        return None, None, None, False
+    else:
+        raise NotImplementedError(episode_cutoff_mode)
+
+
+def set_params_from_seeds(policy, noise, noise_stdev, seeds):
+    policy.set_trainable_flat(noise.get(seeds[0], policy.num_params))
+    policy.reinitialize()
+    v = policy.get_trainable_flat()
+
+    for seed in seeds[1:]:
+        v += noise_stdev * noise.get(seed, policy.num_params)
+    policy.set_trainable_flat(v)
+
+
+def record_eval_stats(tlogger, eval_rets, eval_lens, returns_n2):
+    tlogger.record_tabular("EvalEpRewMean", np.nan if not eval_rets else np.mean(eval_rets))
+    tlogger.record_tabular("EvalEpRewMedian", np.nan if not eval_rets else np.median(eval_rets))
+    tlogger.record_tabular("EvalEpRewStd", np.nan if not eval_rets else np.std(eval_rets))
+    tlogger.record_tabular("EvalEpLenMean", np.nan if not eval_rets else np.mean(eval_lens))
+    tlogger.record_tabular("EvalPopRank", np.nan if not eval_rets else (
+        np.searchsorted(np.sort(returns_n2.ravel()), eval_rets).mean() / returns_n2.size))
+    tlogger.record_tabular("EvalEpCount", len(eval_rets))
+
+
+def save_snapshot(tlogger, policy, iteration, eval_rets):
+    import os.path as osp
+    filename = 'snapshot_iter{:05d}_rew{}.h5'.format(
+        iteration,
+        np.nan if not eval_rets else int(np.mean(eval_rets))
+    )
+    assert not osp.exists(filename)
+    policy.save(filename)
+    tlogger.log('Saved snapshot {}'.format(filename))
+
+
+class SteadyStatePopulation(object):
+    """
+    Live population of the asynchronous GA, every offspring is offered as soon as its result arrives. Until the
+    population is full, everything is accepted. Then, depending on insertion:
+        truncation: the offspring replaces the worst member, if it is better
+        tournament: the offspring replaces the worst of tournament_size random members, if it is better
+    """
+
+    INSERTION_POLICIES = ('truncation', 'tournament')
+
+    def __init__(self, size, insertion='truncation', tournament_size=2, seed=None):
+        if insertion not in self.INSERTION_POLICIES:
+            raise NotImplementedError(insertion)
+        self.size = size
+        self.insertion = insertion
+        self.tournament_size = min(tournament_size, size)
+        self.rs = np.random.RandomState(seed)
+        self.nodes = np.empty(size, dtype=np.int32)
+        self.scores = np.empty(size, dtype=np.float32)
+        self.count = 0
+        self.num_offered, self.num_inserted = 0, 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        return self.count == self.size
+
+    def offer(self, score):
+        """
+        Slot an offspring with this score goes to, None if it is rejected
+        """
+        self.num_offered += 1
+        if not self.full:
+            slot = self.count
+        else:
+            if self.insertion == 'truncation':
+                slot = int(np.argmin(self.scores))
+            else:
+                contestants = self.rs.choice(self.size, self.tournament_size, replace=False)
+                slot = int(contestants[np.argmin(self.scores[contestants])])
+            if score <= self.scores[slot]:
+                return None
+        self.num_inserted += 1
+        return slot
+
+    def put(self, slot, node, score):
+        self.nodes[slot], self.scores[slot] = node, score
+        self.count = max(self.count, slot + 1)
+
+    @property
+    def elite(self):
+        i = int(np.argmax(self.scores[:self.count]))
+        return self.nodes[i], self.scores[i]
+
+    @property
+    def insert_rate(self):
+        return self.num_inserted / max(1, self.num_offered)
+
+
 def run_master(master_redis_cfg, log_dir, exp):
     logger.info('run_master: {}'.format(locals()))
     from . import tabular_logger as tlogger
@@ -38,31 +309,17 @@ def run_master(master_redis_cfg, log_dir, exp):
     config, env, sess, policy = setup(exp, single_threaded=False)
     master = MasterClient(master_redis_cfg)
     noise = SharedNoiseTable()
-    rs = np.random.RandomState()
 
-    if isinstance(config.episode_cutoff_mode, int):
-        tslimit, incr_tslimit_threshold, tslimit_incr_ratio = config.episode_cutoff_mode, None, None
-        adaptive_tslimit = False
-    elif config.episode_cutoff_mode.startswith('adaptive:'):
-        _, args = config.episode_cutoff_mode.split(':')
-        arg0, arg1, arg2 = args.split(',')
-        tslimit, incr_tslimit_threshold, tslimit_incr_ratio = int(arg0), float(arg1), float(arg2)
-        adaptive_tslimit = True
-        logger.info(
-            'Starting timestep limit set to {}. When {}% of rollouts hit the limit, it will be increased by {}'.format(
-                tslimit, incr_tslimit_threshold * 100, tslimit_incr_ratio))
-    elif config.episode_cutoff_mode == 'env_default':
-        tslimit, incr_tslimit_threshold, tslimit_incr_ratio = None, None, None
-        adaptive_tslimit = False
-    else:
-        raise NotImplementedError(config.episode_cutoff_mode)
+    master.declare_experiment(exp)
+    if 'steady_state' in exp:
+        return run_steady_state_master(master, config, env, policy, noise, exp, tlogger)
 
+    tslimit, incr_tslimit_threshold, tslimit_incr_ratio, adaptive_tslimit = parse_episode_cutoff(
+        config.episode_cutoff_mode)
     episodes_so_far = 0
     timesteps_so_far = 0
     tstart = time.time()
-    master.declare_experiment(exp)
-    best_score = float('-inf')
-    population = []
+    lineages = GenerationTable()
     population_size = exp['population_size']
     num_elites = exp['num_elites']
     population_score = np.array([])
@@ -80,7 +337,7 @@ def run_master(master_redis_cfg, log_dir, exp):
 
         curr_task_id = master.declare_task(GATask(
             params=theta,
-            population=population,
+            generation=len(lineages) - 1,
             ob_mean=ob_stat.mean if policy.needs_ob_stat else None,
             ob_std=ob_stat.std if policy.needs_ob_stat else None,
             timestep_limit=tslimit
@@ -89,7 +346,7 @@ def run_master(master_redis_cfg, log_dir, exp):
         tlogger.log('********** Iteration {} **********'.format(curr_task_id))
 
         # Pop off results for the current task
-        curr_task_results, eval_rets, eval_lens, worker_ids = [], [], [], []
+        curr_task_results, eval_rets, eval_lens, worker_ids, staleness = [], [], [], [], []
         num_results_skipped, num_episodes_popped, num_timesteps_popped, ob_count_this_batch = 0, 0, 0, 0
         while num_episodes_popped < config.episodes_per_batch or num_timesteps_popped < config.timesteps_per_batch:
             # Wait for a result
@@ -97,6 +354,7 @@ def run_master(master_redis_cfg, log_dir, exp):
             assert isinstance(task_id, int) and isinstance(result, Result)
             assert (result.eval_return is None) == (result.eval_length is None)
             worker_ids.append(result.worker_id)
+            staleness.append(curr_task_id - task_id)
 
             if result.eval_length is not None:
                 # This was an eval job
@@ -132,30 +390,23 @@ def run_master(master_redis_cfg, log_dir, exp):
             logger.warning('Skipped {} out of date results ({:.2f}%)'.format(
                 num_results_skipped, 100. * frac_results_skipped))
 
-        # Assemble results + elite
-        noise_inds_n = list(population[:num_elites])
-        returns_n2 = list(population_score[:num_elites])
-        for r in curr_task_results:
-            noise_inds_n.extend(r.noise_inds_n)
-            returns_n2.extend(r.returns_n2)
-        noise_inds_n = np.array(noise_inds_n)
-        returns_n2 = np.array(returns_n2)
+        # Assemble results + elite, as (parent node, seed) pairs, elites are their own node (seed -1)
+        elites = lineages.members[-1][:num_elites] if len(lineages) > 0 else np.zeros(0, dtype=np.int32)
+        noise_inds_n = np.concatenate(
+            [np.stack([elites, np.full_like(elites, -1)], axis=1)] + [r.noise_inds_n for r in curr_task_results])
+        returns_n2 = np.concatenate([population_score[:num_elites]] + [r.returns_n2 for r in curr_task_results])
         lengths_n2 = np.array([r.lengths_n2 for r in curr_task_results])
         # Process returns
         idx = np.argpartition(returns_n2, (-population_size, -1))[-1:-population_size-1:-1]
-        population = noise_inds_n[idx]
         population_score = returns_n2[idx]
-        assert len(population) == population_size
+        assert len(idx) == population_size
         assert np.max(returns_n2) == population_score[0]
+        members = [node if seed < 0 else lineages.add_node(node, seed) for node, seed in noise_inds_n[idx].tolist()]
+        master.add_generation(*lineages.add_generation(members))
 
-        print('Elite: {} score: {}'.format(population[0], population_score[0]))
-        policy.set_trainable_flat(noise.get(population[0][0], policy.num_params))
-        policy.reinitialize()
-        v = policy.get_trainable_flat()
-
-        for seed in population[0][1:]:
-            v += config.noise_stdev * noise.get(seed, policy.num_params)
-        policy.set_trainable_flat(v)
+        elite_seeds = lineages.lineage(members[0])
+        print('Elite: {} score: {}'.format(list(elite_seeds), population_score[0]))
+        set_params_from_seeds(policy, noise, config.noise_stdev, elite_seeds)
 
         # Update number of steps to take
         if adaptive_tslimit and (lengths_n2 == tslimit).mean() >= incr_tslimit_threshold:
@@ -169,13 +420,7 @@ def run_master(master_redis_cfg, log_dir, exp):
         tlogger.record_tabular("EpRewStd", returns_n2.std())
         tlogger.record_tabular("EpLenMean", lengths_n2.mean())
 
-        tlogger.record_tabular("EvalEpRewMean", np.nan if not eval_rets else np.mean(eval_rets))
-        tlogger.record_tabular("EvalEpRewMedian", np.nan if not eval_rets else np.median(eval_rets))
-        tlogger.record_tabular("EvalEpRewStd", np.nan if not eval_rets else np.std(eval_rets))
-        tlogger.record_tabular("EvalEpLenMean", np.nan if not eval_rets else np.mean(eval_lens))
-        tlogger.record_tabular("EvalPopRank", np.nan if not eval_rets else (
-            np.searchsorted(np.sort(returns_n2.ravel()), eval_rets).mean() / returns_n2.size))
-        tlogger.record_tabular("EvalEpCount", len(eval_rets))
+        record_eval_stats(tlogger, eval_rets, eval_lens, returns_n2)
 
         tlogger.record_tabular("Norm", float(np.square(policy.get_trainable_flat()).sum()))
 
@@ -188,7 +433,13 @@ def run_master(master_redis_cfg, log_dir, exp):
         tlogger.record_tabular("UniqueWorkers", num_unique_workers)
         tlogger.record_tabular("UniqueWorkersFrac", num_unique_workers / len(worker_ids))
         tlogger.record_tabular("ResultsSkippedFrac", frac_results_skipped)
+        tlogger.record_tabular("ResultStalenessMean", np.mean(staleness))
+        tlogger.record_tabular("ResultsPerSecond", len(worker_ids) / (step_tend - step_tstart))
+        tlogger.record_tabular("TimestepsPerSecond", lengths_n2.sum() / (step_tend - step_tstart))
         tlogger.record_tabular("ObCount", ob_count_this_batch)
+        tlogger.record_tabular("WorkerChunkSizeMean", mean_worker_stat(curr_task_results, 'chunk_size'))
+        tlogger.record_tabular("WorkerChunkItemTimeMean", mean_worker_stat(curr_task_results, 'item_time'))
+        tlogger.record_tabular("WorkerParamCacheHitRate", mean_worker_stat(curr_task_results, 'param_cache_hit_rate'))
 
         tlogger.record_tabular("TimeElapsedThisIter", step_tend - step_tstart)
         tlogger.record_tabular("TimeElapsed", step_tend - tstart)
@@ -196,22 +447,155 @@ def run_master(master_redis_cfg, log_dir, exp):
 
         # if config.snapshot_freq != 0 and curr_task_id % config.snapshot_freq == 0:
         if config.snapshot_freq != 0:
-            import os.path as osp
-            filename = 'snapshot_iter{:05d}_rew{}.h5'.format(
-                curr_task_id,
-                np.nan if not eval_rets else int(np.mean(eval_rets))
-            )
-            assert not osp.exists(filename)
-            policy.save(filename)
-            tlogger.log('Saved snapshot {}'.format(filename))
+            save_snapshot(tlogger, policy, curr_task_id, eval_rets)
+
+
+def run_steady_state_master(master, config, env, policy, noise, exp, tlogger):
+    """
+    Asynchronous GA: results are folded into a SteadyStatePopulation as they arrive, whatever task they were
+    computed for, and the parent pool is republished once publish_every offspring were inserted since the last
+    publication. There is no generation barrier and no result is discarded. Logging happens every
+    episodes_per_batch / timesteps_per_batch worth of results, with the same throughput and staleness statistics
+    as the generational mode. Configured through exp['steady_state']:
+        {"insertion": "truncation" | "tournament", "tournament_size": 2, "publish_every": 10}
+    """
+    ss_cfg = dict(exp['steady_state'])
+    publish_every = ss_cfg.pop('publish_every', 10)
+    population = SteadyStatePopulation(exp['population_size'], **ss_cfg)
+    lineages = GenerationTable()
+
+    tslimit, incr_tslimit_threshold, tslimit_incr_ratio, adaptive_tslimit = parse_episode_cutoff(
+        config.episode_cutoff_mode)
+    episodes_so_far = 0
+    timesteps_so_far = 0
+    tstart = time.time()
+    iteration = 0
+
+    def publish():
+        if population.full:
+            master.add_generation(*lineages.add_generation(population.nodes.copy()))
+        return master.declare_task(GATask(
+            params=policy.get_trainable_flat(),
+            generation=len(lineages) - 1,
+            ob_mean=ob_stat.mean if policy.needs_ob_stat else None,
+            ob_std=ob_stat.std if policy.needs_ob_stat else None,
+            timestep_limit=tslimit
+        ))
+
+    while True:
+        step_tstart = time.time()
+        if policy.needs_ob_stat:
+            ob_stat = RunningStat(env.observation_space.shape, eps=1e-2)
+        curr_task_id = publish()
+        num_inserted_since_publish = 0
+        tlogger.log('********** Iteration {} **********'.format(iteration))
+
+        results, eval_rets, eval_lens, worker_ids, staleness = [], [], [], [], []
+        returns, lengths = [], []
+        num_episodes_popped, num_timesteps_popped, ob_count_this_batch = 0, 0, 0
+        inserted_before = population.num_inserted
+        while num_episodes_popped < config.episodes_per_batch or num_timesteps_popped < config.timesteps_per_batch:
+            task_id, result = master.pop_result()
+            assert isinstance(task_id, int) and isinstance(result, Result)
+            assert (result.eval_return is None) == (result.eval_length is None)
+            worker_ids.append(result.worker_id)
+            staleness.append(curr_task_id - task_id)
 
+            if result.eval_length is not None:
+                episodes_so_far += 1
+                timesteps_so_far += result.eval_length
+                eval_rets.append(result.eval_return)
+                eval_lens.append(result.eval_length)
+                continue
+
+            assert result.returns_n2.dtype == np.float32
+            result_num_eps = result.lengths_n2.size
+            result_num_timesteps = result.lengths_n2.sum()
+            episodes_so_far += result_num_eps
+            timesteps_so_far += result_num_timesteps
+            num_episodes_popped += result_num_eps
+            num_timesteps_popped += result_num_timesteps
+            results.append(result)
+            returns.extend(result.returns_n2)
+            lengths.extend(result.lengths_n2)
+            if policy.needs_ob_stat and result.ob_count > 0:
+                ob_stat.increment(result.ob_sum, result.ob_sumsq, result.ob_count)
+                ob_count_this_batch += result.ob_count
+
+            # Nodes are never removed from the lineage table, so results of any earlier task are still valid
+            for (parent, seed), ret in zip(result.noise_inds_n.tolist(), result.returns_n2):
+                slot = population.offer(ret)
+                if slot is not None:
+                    population.put(slot, lineages.add_node(parent, seed), ret)
+                    num_inserted_since_publish += 1
+
+            if population.full and (len(lineages) == 0 or num_inserted_since_publish >= publish_every):
+                curr_task_id = publish()
+                num_inserted_since_publish = 0
+
+        iteration += 1
+        returns_n2 = np.array(returns, dtype=np.float32)
+        lengths_n2 = np.array(lengths)
+        elite_node, elite_score = population.elite
+        elite_seeds = lineages.lineage(elite_node)
+        print('Elite: {} score: {}'.format(list(elite_seeds), elite_score))
+        set_params_from_seeds(policy, noise, config.noise_stdev, elite_seeds)
 
-def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2):
+        if adaptive_tslimit and (lengths_n2 == tslimit).mean() >= incr_tslimit_threshold:
+            old_tslimit = tslimit
+            tslimit = int(tslimit_incr_ratio * tslimit)
+            logger.info('Increased timestep limit from {} to {}'.format(old_tslimit, tslimit))
+
+        step_tend = time.time()
+        tlogger.record_tabular("EpRewMax", returns_n2.max())
+        tlogger.record_tabular("EpRewMean", returns_n2.mean())
+        tlogger.record_tabular("EpRewStd", returns_n2.std())
+        tlogger.record_tabular("EpLenMean", lengths_n2.mean())
+        tlogger.record_tabular("PopulationRewMax", population.scores[:len(population)].max())
+        tlogger.record_tabular("PopulationRewMean", population.scores[:len(population)].mean())
+        tlogger.record_tabular("PopulationInsertRate", population.insert_rate)
+        tlogger.record_tabular("InsertedThisIter", population.num_inserted - inserted_before)
+        tlogger.record_tabular("PublishedTasks", curr_task_id + 1)
+
+        record_eval_stats(tlogger, eval_rets, eval_lens, returns_n2)
+
+        tlogger.record_tabular("Norm", float(np.square(policy.get_trainable_flat()).sum()))
+
+        tlogger.record_tabular("EpisodesThisIter", lengths_n2.size)
+        tlogger.record_tabular("EpisodesSoFar", episodes_so_far)
+        tlogger.record_tabular("TimestepsThisIter", lengths_n2.sum())
+        tlogger.record_tabular("TimestepsSoFar", timesteps_so_far)
+
+        num_unique_workers = len(set(worker_ids))
+        tlogger.record_tabular("UniqueWorkers", num_unique_workers)
+        tlogger.record_tabular("UniqueWorkersFrac", num_unique_workers / len(worker_ids))
+        tlogger.record_tabular("ResultsSkippedFrac", 0.)
+        tlogger.record_tabular("ResultStalenessMean", np.mean(staleness))
+        tlogger.record_tabular("ResultsPerSecond", len(worker_ids) / (step_tend - step_tstart))
+        tlogger.record_tabular("TimestepsPerSecond", lengths_n2.sum() / (step_tend - step_tstart))
+        tlogger.record_tabular("ObCount", ob_count_this_batch)
+        tlogger.record_tabular("WorkerChunkSizeMean", mean_worker_stat(results, 'chunk_size'))
+        tlogger.record_tabular("WorkerChunkItemTimeMean", mean_worker_stat(results, 'item_time'))
+        tlogger.record_tabular("WorkerParamCacheHitRate", mean_worker_stat(results, 'param_cache_hit_rate'))
+
+        tlogger.record_tabular("TimeElapsedThisIter", step_tend - step_tstart)
+        tlogger.record_tabular("TimeElapsed", step_tend - tstart)
+        tlogger.dump_tabular()
+
+        if config.snapshot_freq != 0:
+            save_snapshot(tlogger, policy, iteration, eval_rets)
+
+
+def run_worker(master_redis_cfg, relay_redis_cfg, noise):
     logger.info('run_worker: {}'.format(locals()))
     assert isinstance(noise, SharedNoiseTable)
-    worker = WorkerClient(master_redis_cfg, relay_redis_cfg)
+    worker = WorkerClient(relay_redis_cfg, master_redis_cfg)
     exp = worker.get_experiment()
+    chunker = ChunkSizeController(**exp.get('chunking', {}))
     config, env, sess, policy = setup(exp, single_threaded=True)
+    param_cache = ParamCache(policy, noise, config.noise_stdev, **exp.get('param_cache', {}))
+    lineages = GenerationTable()
+    flat_generation, flat_seeds, offsets = None, None, None
     rs = np.random.RandomState()
     worker_id = rs.randint(2 ** 31)
 
@@ -223,6 +607,13 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
         assert isinstance(task_id, int) and isinstance(task_data, GATask)
         if policy.needs_ob_stat:
             policy.set_ob_stat(task_data.ob_mean, task_data.ob_std)
+        if task_data.generation >= len(lineages):
+            for delta in worker.get_lineage_updates():
+                lineages.apply(*delta)
+            assert task_data.generation < len(lineages)
+        if task_data.generation >= 0 and task_data.generation != flat_generation:
+            flat_seeds, offsets = lineages.flatten(task_data.generation)
+            flat_seeds, offsets, flat_generation = flat_seeds.tolist(), offsets.tolist(), task_data.generation
 
         if rs.rand() < config.eval_prob:
             # Evaluation: noiseless weights and noiseless actions
@@ -240,39 +631,37 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 eval_length=eval_length,
                 ob_sum=None,
                 ob_sumsq=None,
-                ob_count=None
+                ob_count=None,
+                worker_stats=None
             ))
         else:
             # Rollouts with noise
             noise_inds, returns, signreturns, lengths = [], [], [], []
             task_ob_stat = RunningStat(env.observation_space.shape, eps=0.)  # eps=0 because we're incrementing only
 
-            while not noise_inds or time.time() - task_tstart < min_task_runtime:
-                if len(task_data.population) > 0:
-                    seeds = list(task_data.population[rs.randint(len(task_data.population))]) + [noise.sample_index(rs, policy.num_params)]
+            chunk_tstart = time.time()
+            while chunker.should_continue(len(noise_inds), time.time() - chunk_tstart):
+                seed = noise.sample_index(rs, policy.num_params)
+                if task_data.generation >= 0:
+                    i = rs.randint(len(offsets) - 1)
+                    parent = int(lineages.members[task_data.generation][i])
+                    seeds = flat_seeds[offsets[i]:offsets[i + 1]] + [seed]
                 else:
-                    seeds = [noise.sample_index(rs, policy.num_params)]
-
-                v = noise.get(seeds[0], policy.num_params)
-
-                policy.set_trainable_flat(v)
-                policy.reinitialize()
-                v = policy.get_trainable_flat()
+                    parent, seeds = -1, [seed]
 
-                for seed in seeds[1:]:
-                    v += config.noise_stdev * noise.get(seed, policy.num_params)
-                policy.set_trainable_flat(v)
+                policy.set_trainable_flat(param_cache.get(seeds))
 
                 rews_pos, len_pos = rollout_and_update_ob_stat(
                     policy, env, task_data.timestep_limit, rs, task_ob_stat, config.calc_obstat_prob)
-                noise_inds.append(seeds)
+                noise_inds.append((parent, seed))
                 returns.append(rews_pos.sum())
                 signreturns.append(np.sign(rews_pos).sum())
                 lengths.append(len_pos)
 
+            chunker.update(len(noise_inds), time.time() - chunk_tstart)
             worker.push_result(task_id, Result(
                 worker_id=worker_id,
-                noise_inds_n=noise_inds,
+                noise_inds_n=np.array(noise_inds, dtype=np.int32).reshape(-1, 2),
                 returns_n2=np.array(returns, dtype=np.float32),
                 signreturns_n2=np.array(signreturns, dtype=np.float32),
                 lengths_n2=np.array(lengths, dtype=np.int32),
@@ -280,5 +669,6 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 eval_length=None,
                 ob_sum=None if task_ob_stat.count == 0 else task_ob_stat.sum,
                 ob_sumsq=None if task_ob_stat.count == 0 else task_ob_stat.sumsq,
-                ob_count=task_ob_stat.count
+                ob_count=task_ob_stat.count,
+                worker_stats=dict(chunker.stats, param_cache_hit_rate=param_cache.hit_rate)
             ))
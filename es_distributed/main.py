@@ -6,8 +6,8 @@ import sys
 
 import click
 
-from .dist import RelayClient
-from .es import run_master, run_worker, SharedNoiseTable
+from .dist import RelayClient, fetch_experiment
+from .supervisor import WorkerSupervisor, limit_threads
 
 
 def mkdir_p(path):
@@ -69,23 +69,27 @@ def master(algo, exp_str, exp_file, master_socket_path, log_dir):
 @click.option('--master_port', default=6379, type=int)
 @click.option('--relay_socket_path', required=True)
 @click.option('--num_workers', type=int, default=0)
-def workers(algo, master_host, master_port, relay_socket_path, num_workers):
-    # Start the relay
+@click.option('--pin_cpus/--no_pin_cpus', default=True)
+@click.option('--report_interval', type=float, default=60.)
+@click.option('--preload/--no_preload', default=True)
+def workers(algo, master_host, master_port, relay_socket_path, num_workers, pin_cpus, report_interval, preload):
+    # Single threaded BLAS/TF in the workers, set before the algo imports numpy and tensorflow
+    limit_threads()
     master_redis_cfg = {'host': master_host, 'port': master_port}
     relay_redis_cfg = {'unix_socket_path': relay_socket_path}
-    if os.fork() == 0:
-        RelayClient(master_redis_cfg, relay_redis_cfg).run()
-        return
-    # Start the workers
     algo = import_algo(algo)
     noise = algo.SharedNoiseTable()  # Workers share the same noise
     num_workers = num_workers if num_workers else os.cpu_count()
     logging.info('Spawning {} workers'.format(num_workers))
-    for _ in range(num_workers):
-        if os.fork() == 0:
-            algo.run_worker(master_redis_cfg, relay_redis_cfg, noise=noise)
-            return
-    os.wait()
+    # Start the relay and the workers, restarting any of them that die
+    WorkerSupervisor(
+        num_workers,
+        run_worker=lambda: algo.run_worker(master_redis_cfg, relay_redis_cfg, noise=noise),
+        run_relay=lambda: RelayClient(master_redis_cfg, relay_redis_cfg).run(),
+        preload=(lambda: algo.preload(fetch_experiment(relay_redis_cfg))) if preload and hasattr(algo, 'preload') else None,
+        pin_cpus=pin_cpus,
+        report_interval=report_interval
+    ).run()
 
 
 if __name__ == '__main__':
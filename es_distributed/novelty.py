@@ -0,0 +1,344 @@
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class NoveltyArchive(object):
+    """
+    Novelty search archive of behavior characterizations (BCs), kept in one contiguous float32 matrix.
+
+    BCs may have different lengths. Distances follow nses.euclidean_distance: of two BCs, the shorter one is padded
+    with its last value up to the length of the longer one. Rows are stored padded with their last value up to the
+    current width and their true lengths are kept, so that padding past max(len(a), len(b)) can be subtracted out.
+
+    Distances to many query BCs are computed at once, in blocks of rows so that memory stays bounded. When all BCs
+    have the same, small dimension (<= tree_max_dim) and scipy is available, a KD-tree over the archive is used
+    instead. It is rebuilt once enough rows were appended since the last build, the rows appended in the meantime
+    are searched by brute force.
+    """
+
+    def __init__(self, bcs=(), initial_capacity=1024, tree_max_dim=16, block_size=2 ** 22):
+        self.tree_max_dim = tree_max_dim
+        self.block_size = block_size
+        self._data = np.zeros((initial_capacity, 1), dtype=np.float32)
+        self._lengths = np.zeros(initial_capacity, dtype=np.int64)
+        self._size = 0
+        self._width = 0
+        self._tree = None
+        self._tree_size = 0
+        self._tree_unavailable = False
+        self._diff = np.empty(0, dtype=np.float32)
+        self.num_queries = 0
+        self.query_time = 0.
+        self.extend(bcs)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def data(self):
+        """(len(self), width) view of the padded BCs"""
+        return self._data[:self._size, :self._width]
+
+    @property
+    def lengths(self):
+        return self._lengths[:self._size]
+
+    def bcs(self):
+        """The stored BCs without their padding, in row order"""
+        return [self._data[i, :self._lengths[i]].copy() for i in range(self._size)]
+
+    def _ensure_width(self, width):
+        if width <= self._width:
+            return
+        if width > self._data.shape[1]:
+            data = np.empty((self._data.shape[0], max(width, 2 * self._data.shape[1])), dtype=np.float32)
+            data[:, :self._width] = self._data[:, :self._width]
+            self._data = data
+        if self._width > 0:
+            self._data[:self._size, self._width:width] = self._data[:self._size, self._width - 1:self._width]
+        self._width = width
+        self._tree = None
+        self._tree_size = 0
+
+    def _ensure_capacity(self, size):
+        if size <= self._data.shape[0]:
+            return
+        capacity = max(size, 2 * self._data.shape[0])
+        data = np.empty((capacity, self._data.shape[1]), dtype=np.float32)
+        data[:self._size] = self._data[:self._size]
+        self._data = data
+        self._lengths = np.resize(self._lengths, capacity)
+
+    def _set_row(self, i, bc):
+        n = len(bc)
+        self._data[i, :n] = bc
+        self._data[i, n:self._width] = bc[-1]
+        self._lengths[i] = n
+
+    def append(self, bc):
+        self.extend([bc])
+
+    def put(self, slot, bc):
+        """
+        Stores bc in row slot, which is either an existing row to overwrite or len(self) to append
+        """
+        if slot == self._size:
+            return self.append(bc)
+        assert 0 <= slot < self._size
+        bc = np.asarray(bc, dtype=np.float32).ravel()
+        self._ensure_width(len(bc))
+        self._set_row(slot, bc)
+        if slot < self._tree_size:
+            self._tree = None
+            self._tree_size = 0
+
+    @property
+    def mean_query_time(self):
+        """Mean time per novelty query since the archive was created"""
+        return self.query_time / max(1, self.num_queries)
+
+    def extend(self, bcs):
+        bcs = [np.asarray(bc, dtype=np.float32).ravel() for bc in bcs]
+        if not bcs:
+            return
+        self._ensure_width(max(len(bc) for bc in bcs))
+        self._ensure_capacity(self._size + len(bcs))
+        for bc in bcs:
+            self._set_row(self._size, bc)
+            self._size += 1
+
+    def _pad_queries(self, bcs):
+        bcs = [np.asarray(bc, dtype=np.float32).ravel() for bc in bcs]
+        self._ensure_width(max(len(bc) for bc in bcs))
+        queries = np.empty((len(bcs), self._width), dtype=np.float32)
+        lengths = np.empty(len(bcs), dtype=np.int64)
+        for i, bc in enumerate(bcs):
+            queries[i, :len(bc)] = bc
+            queries[i, len(bc):] = bc[-1]
+            lengths[i] = len(bc)
+        return queries, lengths
+
+    def _sq_distances(self, queries, q_lengths, start, stop):
+        """Squared distances between the padded queries and rows start:stop"""
+        rows = self._data[start:stop, :self._width]
+        sq = np.empty((len(queries), stop - start), dtype=np.float32)
+        rows_per_block = min(max(1, self.block_size // max(1, len(queries) * self._width)), stop - start)
+        if self._diff.size < len(queries) * rows_per_block * self._width:
+            self._diff = np.empty(len(queries) * rows_per_block * self._width, dtype=np.float32)
+        for b in range(0, stop - start, rows_per_block):
+            block = rows[b:b + rows_per_block]
+            d = self._diff[:len(queries) * len(block) * self._width].reshape(len(queries), len(block), self._width)
+            np.subtract(block[None], queries[:, None], out=d)
+            sq[:, b:b + len(block)] = np.einsum('qbw,qbw->qb', d, d)
+
+        # Remove the padding both sides got beyond the longer of the two
+        excess = self._width - np.maximum(self._lengths[None, start:stop], q_lengths[:, None])
+        if excess.any():
+            last = rows[:, -1][None] - queries[:, -1][:, None]
+            sq -= excess * np.square(last)
+            np.maximum(sq, 0, out=sq)
+        return sq
+
+    def _use_tree(self, q_lengths):
+        if self._tree_unavailable or self._width > self.tree_max_dim:
+            return False
+        if (self.lengths != self._width).any() or (q_lengths != self._width).any():
+            return False
+        if self._tree is None or self._size - self._tree_size > max(256, self._tree_size // 4):
+            try:
+                from scipy.spatial import cKDTree
+            except ImportError:
+                logger.warning('scipy is not available, computing novelty by brute force')
+                self._tree_unavailable = True
+                return False
+            self._tree = cKDTree(self.data.copy())
+            self._tree_size = self._size
+        return True
+
+    def distances(self, bcs):
+        """(len(bcs), len(self)) matrix of distances"""
+        queries, q_lengths = self._pad_queries(bcs)
+        return np.sqrt(self._sq_distances(queries, q_lengths, 0, self._size))
+
+    def pairwise_distances(self):
+        """(len(self), len(self)) matrix of distances between the archive entries"""
+        return np.sqrt(self._sq_distances(self.data, self.lengths, 0, self._size))
+
+    def knn(self, bcs, k):
+        """Distances to the (up to) k nearest archive entries of every query, in no particular order"""
+        assert self._size > 0, 'Empty archive'
+        queries, q_lengths = self._pad_queries(bcs)
+        k = min(k, self._size)
+        if self._use_tree(q_lengths) and self._tree_size >= k:
+            tree_d, _ = self._tree.query(queries, k=k)
+            tree_d = np.asarray(tree_d, dtype=np.float32).reshape(len(queries), k)
+            if self._tree_size == self._size:
+                return tree_d
+            rest = np.sqrt(self._sq_distances(queries, q_lengths, self._tree_size, self._size))
+            d = np.concatenate([tree_d, rest], axis=1)
+        else:
+            d = np.sqrt(self._sq_distances(queries, q_lengths, 0, self._size))
+        if k < d.shape[1]:
+            d = d[np.arange(len(d))[:, None], np.argpartition(d, k - 1, axis=1)[:, :k]]
+        return d
+
+    def novelty(self, bcs, k):
+        """Mean distance of every BC to its k nearest neighbors in the archive"""
+        tstart = time.time()
+        novelty = self.knn(bcs, k).mean(axis=1)
+        self.num_queries += len(novelty)
+        self.query_time += time.time() - tstart
+        return novelty
+
+
+class ArchivePolicy(object):
+    """
+    Decides, on the master, which BCs enter the archive and which entries they replace. Configured through
+    novelty_search.archive_policy in the experiment JSON.
+
+    Insertion: a candidate is considered with probability insert_prob, and only if its novelty w.r.t. the archive
+    is at least novelty_threshold (when set).
+
+    Eviction, once the archive holds capacity entries (capacity=None never evicts):
+        fifo: the oldest entry is replaced
+        reservoir: reservoir sampling over all considered candidates, a candidate may be dropped instead
+        least_novel: the entry (or candidate) with the lowest mean distance to its k nearest neighbors is dropped
+        cluster: the entry (or candidate) closest to its nearest neighbor is dropped, so that dense clusters are
+            pruned down to representatives
+    The last two keep the distances of every entry to its nearest neighbors in the archive, computed from all
+    pairwise distances once the archive is full and then updated on every eviction, so that an offer costs the
+    distances of the candidate (and of the entries that had the evicted one among their neighbors) to the archive.
+
+    offer() returns the row the candidate was written to (or None), which workers replay to mirror the archive.
+    """
+
+    EVICTION_POLICIES = ('fifo', 'reservoir', 'least_novel', 'cluster')
+
+    def __init__(self, archive, k, capacity=None, eviction='fifo', insert_prob=1., novelty_threshold=None, seed=None):
+        if eviction not in self.EVICTION_POLICIES:
+            raise NotImplementedError(eviction)
+        self.archive = archive
+        self.k = k
+        self.capacity = capacity
+        self.eviction = eviction
+        self.insert_prob = insert_prob
+        self.novelty_threshold = novelty_threshold
+        self.rs = np.random.RandomState(seed)
+        self.num_offered, self.num_considered, self.num_inserted, self.num_evicted = 0, 0, 0, 0
+        self._next_fifo_slot = 0
+        # Sorted distances to, and rows of, the nearest neighbors of every entry (least_novel and cluster only)
+        self._nn_dist, self._nn_idx = None, None
+
+    @property
+    def _num_neighbors(self):
+        return 1 if self.eviction == 'cluster' else min(self.k, len(self.archive))
+
+    def _score(self, nn_dist):
+        return nn_dist[..., 0] if self.eviction == 'cluster' else nn_dist.mean(axis=-1)
+
+    def _nearest(self, d):
+        idx = np.argsort(d, axis=-1)[..., :self._num_neighbors]
+        return np.take_along_axis(d, idx, axis=-1), idx
+
+    def _evict_redundant(self, bc):
+        # Scores of the archive entries and the candidate among each other, the lowest one is dropped
+        archive = self.archive
+        if self._nn_dist is None:
+            d = archive.pairwise_distances()
+            np.fill_diagonal(d, np.inf)
+            self._nn_dist, self._nn_idx = self._nearest(d)
+        d = archive.distances([bc])[0]
+        # The neighbors of the entries if the candidate joined them
+        merged = np.concatenate([self._nn_dist, d[:, None]], axis=1)
+        merged.sort(axis=1)
+        scores = self._score(merged[:, :self._num_neighbors])
+        candidate_score = self._score(np.partition(d, self._num_neighbors - 1)[None, :self._num_neighbors])[0]
+        victim = int(np.argmin(scores))
+        if candidate_score < scores[victim]:
+            return None
+        self._replace_neighbors(victim, bc, d)
+        return victim
+
+    def _replace_neighbors(self, victim, bc, d):
+        # Neighbors once the candidate took the row of the victim, d being its distances to the current archive
+        archive = self.archive
+        to_candidate = d.copy()
+        to_candidate[victim] = np.inf
+        rows = np.arange(len(archive))
+        affected = np.flatnonzero((self._nn_idx == victim).any(axis=1) & (rows != victim))
+        # Entries that didn't have the victim as a neighbor only need the candidate merged in
+        nn_dist = np.concatenate([self._nn_dist, to_candidate[:, None]], axis=1)
+        nn_idx = np.concatenate([self._nn_idx, np.full((len(archive), 1), victim)], axis=1)
+        order = np.argsort(nn_dist, axis=1)[:, :self._num_neighbors]
+        self._nn_dist, self._nn_idx = np.take_along_axis(nn_dist, order, 1), np.take_along_axis(nn_idx, order, 1)
+        self._nn_dist[victim], self._nn_idx[victim] = self._nearest(to_candidate)
+        # The others lost a neighbor, their distances to the whole archive are needed again
+        if len(affected):
+            da = archive.distances([archive.data[i, :archive.lengths[i]] for i in affected])
+            da[:, victim] = d[affected]
+            da[np.arange(len(affected)), affected] = np.inf
+            self._nn_dist[affected], self._nn_idx[affected] = self._nearest(da)
+
+    def _choose_slot(self, bc):
+        n = len(self.archive)
+        if self.capacity is None or n < self.capacity:
+            return n
+        if self.eviction == 'fifo':
+            slot = self._next_fifo_slot
+            self._next_fifo_slot = (slot + 1) % self.capacity
+            return slot
+        if self.eviction == 'reservoir':
+            j = self.rs.randint(self.num_considered)
+            return j if j < self.capacity else None
+        return self._evict_redundant(bc)
+
+    def offer(self, bc):
+        self.num_offered += 1
+        if self.insert_prob < 1 and self.rs.rand() >= self.insert_prob:
+            return None
+        if (self.novelty_threshold is not None and len(self.archive) > 0 and
+                self.archive.novelty([bc], self.k)[0] < self.novelty_threshold):
+            return None
+        self.num_considered += 1
+        slot = self._choose_slot(bc)
+        if slot is None:
+            return None
+        if slot < len(self.archive):
+            self.num_evicted += 1
+        else:
+            self._nn_dist, self._nn_idx = None, None
+        self.num_inserted += 1
+        self.archive.put(slot, bc)
+        return slot
+
+    def get_state(self):
+        return {
+            'bcs': self.archive.bcs(),
+            'counts': (self.num_offered, self.num_considered, self.num_inserted, self.num_evicted),
+            'next_fifo_slot': self._next_fifo_slot,
+            'rs': self.rs.get_state(),
+        }
+
+    def set_state(self, state):
+        """
+        Restores a get_state() into an empty archive
+        """
+        assert len(self.archive) == 0
+        self.archive.extend(state['bcs'])
+        self.num_offered, self.num_considered, self.num_inserted, self.num_evicted = state['counts']
+        self._next_fifo_slot = state['next_fifo_slot']
+        self.rs.set_state(state['rs'])
+        self._nn_dist, self._nn_idx = None, None
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self.archive),
+            'insert_rate': self.num_inserted / max(1, self.num_offered),
+            'evicted': self.num_evicted,
+            'query_time': self.archive.mean_query_time,
+        }
@@ -2,12 +2,20 @@ import logging
 import time
 from collections import namedtuple
 import tensorflow as tf
-from copy import deepcopy
 
 import numpy as np
 
 from .dist import MasterClient, WorkerClient
 from .es import *
+from .novelty import ArchivePolicy, NoveltyArchive
+
+# Behavior evaluation of unperturbed population members, declared on the task channel like ES tasks. Workers pick a
+# random member per rollout and report its BC, the master averages num_rollouts BCs per member.
+BCTask = namedtuple('BCTask', ['keys', 'params', 'ob_means', 'ob_stds', 'ref_batch', 'timestep_limit'])
+BCResult = namedtuple('BCResult', ['worker_id', 'key', 'bc'])
+# ES task for several population members at once. Workers pick a random member per chunk and tag their results with it.
+ParentsTask = namedtuple('ParentsTask', ['parent_ids', 'params', 'ob_means', 'ob_stds', 'ref_batch', 'timestep_limit'])
+ParentResult = namedtuple('ParentResult', ['parent_id', 'result'])
 
 def euclidean_distance(x, y):
     n, m = len(x), len(y)
@@ -22,6 +30,8 @@ def euclidean_distance(x, y):
 # (J) computes novelty score i.e. computes distance of current BC to every BC in the archive to get each point's KNN and
 # takes the mean of the distances (the novelty_vector is really the BC)
 def compute_novelty_vs_archive(archive, novelty_vector, k):
+    if isinstance(archive, NoveltyArchive):
+        return archive.novelty([novelty_vector], k)[0]
     distances = []
     nov = novelty_vector.astype(np.float)
     # TODO: (J) change this to compute different distance metric for novelty calculation
@@ -41,6 +51,31 @@ def get_mean_bc(env, policy, tslimit, num_rollouts=1):
         novelty_vector.append(nv)
     return np.mean(novelty_vector, axis=0)
 
+def evaluate_bcs(master, keys, thetas, ob_stats, ref_batch, tslimit, num_rollouts):
+    """
+    Mean BC of every (key, theta) over num_rollouts noiseless rollouts, computed by the workers
+    """
+    tstart = time.time()
+    bc_task_id = master.declare_task(BCTask(
+        keys=list(keys),
+        params=list(thetas),
+        ob_means=[None if s is None else s.mean for s in ob_stats],
+        ob_stds=[None if s is None else s.std for s in ob_stats],
+        ref_batch=ref_batch,
+        timestep_limit=tslimit
+    ))
+    bcs = {key: [] for key in keys}
+    num_done = 0
+    while num_done < len(bcs):
+        task_id, result = master.pop_result()
+        if task_id != bc_task_id or not isinstance(result, BCResult) or len(bcs[result.key]) >= num_rollouts:
+            continue
+        bcs[result.key].append(result.bc)
+        if len(bcs[result.key]) == num_rollouts:
+            num_done += 1
+    logger.info('Evaluated the behavior of {} population members in {:.2f}s'.format(len(bcs), time.time() - tstart))
+    return {key: np.mean(bc, axis=0) for key, bc in bcs.items()}
+
 def setup_env(exp):
     import gym
     gym.undo_logger_setup()
@@ -52,15 +87,16 @@ def setup_env(exp):
     return config, env
 
 def setup_policy(env, exp, single_threaded):
-    from . import policies, tf_util
+    from . import tf_util
+    # The policy is built before the session, make_policy may have to reset the default graph
+    policy = make_policy(exp, env.observation_space, env.action_space)
     sess = make_session(single_threaded=single_threaded)
-    policy = getattr(policies, exp['policy']['type'])(env.observation_space, env.action_space, **exp['policy']['args'])
     tf_util.initialize()
     return sess, policy
 
 def run_master(master_redis_cfg, log_dir, exp):
     logger.info('run_master: {}'.format(locals()))
-    from .optimizers import SGD, Adam
+    from .population import PopulationStore
     from . import tabular_logger as tlogger
     config, env = setup_env(exp)
     algo_type = exp['algo_type']
@@ -71,10 +107,20 @@ def run_master(master_redis_cfg, log_dir, exp):
 
     pop_size = int(exp['novelty_search']['population_size'])
     num_rollouts = int(exp['novelty_search']['num_rollouts'])
-    theta_dict = {}
-    optimizer_dict = {}
-    obstat_dict = {}
-    curr_parent = 0
+    # Mean BCs per (parent, theta version), so that unchanged parents are never evaluated again
+    theta_version = {}
+    bc_cache = {}
+    # Local copy of the archive, the master is its only writer
+    archive = NoveltyArchive(**exp['novelty_search'].get('archive', {}))
+    archive_policy = ArchivePolicy(archive, exp['novelty_search']['k'], **exp['novelty_search'].get('archive_policy', {}))
+
+    def add_to_archive(bc):
+        slot = archive_policy.offer(bc)
+        if slot is not None:
+            master.add_to_novelty_archive(bc, slot)
+            # With evictions the log outgrows the archive, keep it within twice the archive size
+            if master.archive_log_size > 2 * len(archive):
+                master.publish_archive(archive.bcs())
 
     if isinstance(config.episode_cutoff_mode, int):
         tslimit, incr_tslimit_threshold, tslimit_incr_ratio, tslimit_max = config.episode_cutoff_mode, None, None, config.episode_cutoff_mode
@@ -95,54 +141,75 @@ def run_master(master_redis_cfg, log_dir, exp):
     else:
         raise NotImplementedError(config.episode_cutoff_mode)
 
-    for p in range(pop_size):
-        with tf.Graph().as_default():
-            sess, policy = setup_policy(env, exp, single_threaded=False)
-
-            if 'init_from' in exp['policy']:
-                logger.info('Initializing weights from {}'.format(exp['policy']['init_from']))
-                policy.initialize_from(exp['policy']['init_from'], ob_stat)
-
-            theta = policy.get_trainable_flat()
-            optimizer = {'sgd': SGD, 'adam': Adam}[exp['optimizer']['type']](theta, **exp['optimizer']['args'])
-
+    # One policy for the whole population, the members only differ in their rows of the store
+    sess, policy = setup_policy(env, exp, single_threaded=False)
+    if policy.needs_ref_batch:
+        policy.set_ref_batch(ref_batch)
+    population = PopulationStore(
+        pop_size, policy.num_params, exp['optimizer']['type'], exp['optimizer']['args'],
+        ob_shape=env.observation_space.shape if policy.needs_ob_stat else None,
+        **exp['novelty_search'].get('population_store', {}))
+    if not population.resumed:
+        init_ob_stat = RunningStat(env.observation_space.shape, eps=1e-2) if policy.needs_ob_stat else None
+        if 'init_from' in exp['policy']:
+            logger.info('Initializing weights from {}'.format(exp['policy']['init_from']))
             if policy.needs_ob_stat:
-                ob_stat = RunningStat(env.observation_space.shape, eps=1e-2)
-                obstat_dict[p] = ob_stat
-
-            if policy.needs_ref_batch:
-                policy.set_ref_batch(ref_batch)
-
-            mean_bc = get_mean_bc(env, policy, tslimit_max, num_rollouts)
-            master.add_to_novelty_archive(mean_bc)
-
-            theta_dict[p] = theta
-            optimizer_dict[p] = optimizer
+                policy.initialize_from(exp['policy']['init_from'], init_ob_stat)
+            else:
+                policy.initialize_from(exp['policy']['init_from'])
+        reinit = tf.initialize_variables(policy.trainable_variables)
+        for p in range(pop_size):
+            if p > 0 and 'init_from' not in exp['policy']:
+                sess.run(reinit)
+            population.set_member(p, policy.get_trainable_flat(), init_ob_stat)
+        population.flush()
+    theta_version = {p: 0 for p in range(pop_size)}
 
     episodes_so_far = 0
     timesteps_so_far = 0
+    parents_per_iteration = int(exp['novelty_search'].get('parents_per_iteration', 1))
+    assert 1 <= parents_per_iteration <= pop_size
+    active_parents = list(range(parents_per_iteration))
+    iteration = 0
+    # The loop state saved with the population, None on a fresh start
+    resume_state = population.load_state() if population.resumed else None
+    if resume_state is not None:
+        iteration, tslimit = resume_state['iteration'], resume_state['tslimit']
+        episodes_so_far, timesteps_so_far = resume_state['episodes_so_far'], resume_state['timesteps_so_far']
+        theta_version = resume_state['theta_version']
+        if len(resume_state['active_parents']) == parents_per_iteration:
+            active_parents = resume_state['active_parents']
+        archive_policy.set_state(resume_state['archive'])
+        # MasterClient cleared the archive log, workers rebuild the archive from it
+        master.publish_archive(archive.bcs())
+        logger.info('Resuming at iteration {} with an archive of {}'.format(iteration, len(archive)))
     tstart = time.time()
     master.declare_experiment(exp)
 
+    # Initial population BCs
+    bc_cache = evaluate_bcs(
+        master, [(p, theta_version[p]) for p in range(pop_size)], [population.theta(p) for p in range(pop_size)],
+        [population.ob_stat(p) for p in range(pop_size)], ref_batch if policy.needs_ref_batch else None,
+        tslimit_max, num_rollouts)
+    if resume_state is None:
+        for p in range(pop_size):
+            add_to_archive(bc_cache[(p, 0)])
     while True:
         step_tstart = time.time()
 
-        theta = theta_dict[curr_parent]
-        policy.set_trainable_flat(theta)
-        optimizer = optimizer_dict[curr_parent]
-
-        if policy.needs_ob_stat:
-            ob_stat = deepcopy(obstat_dict[curr_parent])
+        ob_stats = {p: population.ob_stat(p) for p in active_parents}
 
-        assert theta.dtype == np.float32
+        def declare_parents_task():
+            return master.declare_task(ParentsTask(
+                parent_ids=list(active_parents),
+                params=[population.theta(p) for p in active_parents],
+                ob_means=[ob_stats[p].mean if policy.needs_ob_stat else None for p in active_parents],
+                ob_stds=[ob_stats[p].std if policy.needs_ob_stat else None for p in active_parents],
+                ref_batch=ref_batch if policy.needs_ref_batch else None,
+                timestep_limit=tslimit
+            ))
 
-        curr_task_id = master.declare_task(Task(
-            params=theta,
-            ob_mean=ob_stat.mean if policy.needs_ob_stat else None,
-            ob_std=ob_stat.std if policy.needs_ob_stat else None,
-            ref_batch=ref_batch if policy.needs_ref_batch else None,
-            timestep_limit=tslimit
-        ))
+        curr_task_id = declare_parents_task()
         master.flush_results()
         new_task_checker = False
         while not new_task_checker:
@@ -155,22 +222,25 @@ def run_master(master_redis_cfg, log_dir, exp):
             # Re-declare task if original declaration fails to register
             if not new_task_checker:
                 master.task_counter -= 1
-                curr_task_id = master.declare_task(Task(
-                    params=theta,
-                    ob_mean=ob_stat.mean if policy.needs_ob_stat else None,
-                    ob_std=ob_stat.std if policy.needs_ob_stat else None,
-                    ref_batch=ref_batch if policy.needs_ref_batch else None,
-                    timestep_limit=tslimit
-                ))
-        tlogger.log('********** Iteration {} **********'.format(curr_task_id))
-
-        # Pop off results for the current task
-        curr_task_results, eval_rets, eval_lens, worker_ids = [], [], [], []
-        num_results_skipped, num_episodes_popped, num_timesteps_popped, ob_count_this_batch = 0, 0, 0, 0
-        while num_episodes_popped < config.episodes_per_batch or num_timesteps_popped < config.timesteps_per_batch:
+                curr_task_id = declare_parents_task()
+        tlogger.log('********** Iteration {} **********'.format(iteration))
+
+        # Pop off results for the current task, until every active parent has a full batch
+        curr_task_results = {p: [] for p in active_parents}
+        eval_rets, eval_lens, worker_ids = [], [], []
+        num_episodes_popped = {p: 0 for p in active_parents}
+        num_timesteps_popped = {p: 0 for p in active_parents}
+        num_results_skipped, ob_count_this_batch = 0, 0
+        while any(num_episodes_popped[p] < config.episodes_per_batch or
+                  num_timesteps_popped[p] < config.timesteps_per_batch for p in active_parents):
             # Wait for a result
-            task_id, result = master.pop_result()
-            assert isinstance(task_id, int) and isinstance(result, Result)
+            task_id, tagged_result = master.pop_result()
+            if isinstance(tagged_result, BCResult):
+                # Late behavior evaluation
+                continue
+            assert isinstance(task_id, int) and isinstance(tagged_result, ParentResult)
+            parent_id, result = tagged_result
+            assert isinstance(result, Result)
             assert (result.eval_return is None) == (result.eval_length is None)
             worker_ids.append(result.worker_id)
 
@@ -193,61 +263,83 @@ def run_master(master_redis_cfg, log_dir, exp):
                 timesteps_so_far += result_num_timesteps
                 # Store results only for current tasks
                 if task_id == curr_task_id:
-                    curr_task_results.append(result)
-                    num_episodes_popped += result_num_eps
-                    num_timesteps_popped += result_num_timesteps
+                    curr_task_results[parent_id].append(result)
+                    num_episodes_popped[parent_id] += result_num_eps
+                    num_timesteps_popped[parent_id] += result_num_timesteps
                     # Update ob stats
                     if policy.needs_ob_stat and result.ob_count > 0:
-                        ob_stat.increment(result.ob_sum, result.ob_sumsq, result.ob_count)
+                        ob_stats[parent_id].increment(result.ob_sum, result.ob_sumsq, result.ob_count)
                         ob_count_this_batch += result.ob_count
                 else:
                     num_results_skipped += 1
 
         # Compute skip fraction
-        frac_results_skipped = num_results_skipped / (num_results_skipped + len(curr_task_results))
+        all_task_results = [r for p in active_parents for r in curr_task_results[p]]
+        frac_results_skipped = num_results_skipped / (num_results_skipped + len(all_task_results))
         if num_results_skipped > 0:
             logger.warning('Skipped {} out of date results ({:.2f}%)'.format(
                 num_results_skipped, 100. * frac_results_skipped))
 
-        # Assemble results
-        noise_inds_n = np.concatenate([r.noise_inds_n for r in curr_task_results])
-        returns_n2 = np.concatenate([r.returns_n2 for r in curr_task_results])
-        lengths_n2 = np.concatenate([r.lengths_n2 for r in curr_task_results])
-        signreturns_n2 = np.concatenate([r.signreturns_n2 for r in curr_task_results])
-
-        assert noise_inds_n.shape[0] == returns_n2.shape[0] == lengths_n2.shape[0]
-        # Process returns
-        if config.return_proc_mode == 'centered_rank': # (J) seems to be used for pure reward (quality)
-            proc_returns_n2 = compute_centered_ranks(returns_n2)
-        elif config.return_proc_mode == 'sign':
-            proc_returns_n2 = signreturns_n2
-        elif config.return_proc_mode == 'centered_sign_rank': # (J) seems to be used for pure novelty
-            proc_returns_n2 = compute_centered_ranks(signreturns_n2)
+        # Update every active parent from its own results, with its own optimizer and ob stat
+        all_returns_n2, all_lengths_n2, grad_norms, update_ratios = [], [], [], []
+        for p in active_parents:
+            # Assemble results
+            noise_inds_n = np.concatenate([r.noise_inds_n for r in curr_task_results[p]])
+            returns_n2 = np.concatenate([r.returns_n2 for r in curr_task_results[p]])
+            lengths_n2 = np.concatenate([r.lengths_n2 for r in curr_task_results[p]])
+            signreturns_n2 = np.concatenate([r.signreturns_n2 for r in curr_task_results[p]])
+
+            assert noise_inds_n.shape[0] == returns_n2.shape[0] == lengths_n2.shape[0]
+            # Process returns
+            if config.return_proc_mode == 'centered_rank': # (J) seems to be used for pure reward (quality)
+                proc_returns_n2 = compute_centered_ranks(returns_n2)
+            elif config.return_proc_mode == 'sign':
+                proc_returns_n2 = signreturns_n2
+            elif config.return_proc_mode == 'centered_sign_rank': # (J) seems to be used for pure novelty
+                proc_returns_n2 = compute_centered_ranks(signreturns_n2)
+            else:
+                raise NotImplementedError(config.return_proc_mode)
+
+            if algo_type  == "nsr":
+                rew_ranks = compute_centered_ranks(returns_n2)
+                proc_returns_n2 = (rew_ranks + proc_returns_n2) / 2.0 # (J) reward and novelty each weighted by 0.5
+
+            # Compute and take step
+            theta = population.theta(p)
+            g, count = batched_weighted_sum(
+                proc_returns_n2[:, 0] - proc_returns_n2[:, 1],
+                (noise.get(idx, policy.num_params) for idx in noise_inds_n),
+                batch_size=500
+            )
+            g /= returns_n2.size
+            assert g.shape == (policy.num_params,) and g.dtype == np.float32 and count == len(noise_inds_n)
+            # (J) maximize reward metric (i.e. novelty or fitness or some combination)
+            # The population's ob stats were already incremented in place while popping results
+            update_ratio, theta = population.update(p, -g + config.l2coeff * theta)
+            theta_version[p] += 1
+
+            all_returns_n2.append(returns_n2)
+            all_lengths_n2.append(lengths_n2)
+            grad_norms.append(float(np.square(g).sum()))
+            update_ratios.append(float(update_ratio))
+        returns_n2 = np.concatenate(all_returns_n2)
+        lengths_n2 = np.concatenate(all_lengths_n2)
+
+        # The updated parents go into the archive, with novelty_prob selection every parent needs a BC
+        if exp['novelty_search']['selection_method'] == "novelty_prob":
+            bc_parents = range(pop_size)
         else:
-            raise NotImplementedError(config.return_proc_mode)
-
-        if algo_type  == "nsr":
-            rew_ranks = compute_centered_ranks(returns_n2)
-            proc_returns_n2 = (rew_ranks + proc_returns_n2) / 2.0 # (J) reward and novelty each weighted by 0.5
-
-        # Compute and take step
-        g, count = batched_weighted_sum(
-            proc_returns_n2[:, 0] - proc_returns_n2[:, 1],
-            (noise.get(idx, policy.num_params) for idx in noise_inds_n),
-            batch_size=500
-        )
-        g /= returns_n2.size
-        assert g.shape == (policy.num_params,) and g.dtype == np.float32 and count == len(noise_inds_n)
-        update_ratio, theta = optimizer.update(-g + config.l2coeff * theta) # (J) maximize reward metric (i.e. novelty or fitness or some combination)
-
-        policy.set_trainable_flat(theta)
-
-        # Update ob stat (we're never running the policy in the master, but we might be snapshotting the policy)
-        if policy.needs_ob_stat:
-            policy.set_ob_stat(ob_stat.mean, ob_stat.std)
-
-        mean_bc = get_mean_bc(env, policy, tslimit_max, num_rollouts)
-        master.add_to_novelty_archive(mean_bc)
+            bc_parents = active_parents
+        bc_cache = {(p, theta_version[p]): bc_cache[(p, theta_version[p])] for p in bc_parents
+                    if (p, theta_version[p]) in bc_cache}
+        missing = [p for p in bc_parents if (p, theta_version[p]) not in bc_cache]
+        if missing:
+            bc_cache.update(evaluate_bcs(
+                master, [(p, theta_version[p]) for p in missing], [population.theta(p) for p in missing],
+                [population.ob_stat(p) for p in missing], ref_batch if policy.needs_ref_batch else None,
+                tslimit_max, num_rollouts))
+        for p in active_parents:
+            add_to_archive(bc_cache[(p, theta_version[p])])
 
         # Update number of steps to take
         if adaptive_tslimit and (lengths_n2 == tslimit).mean() >= incr_tslimit_threshold:
@@ -256,7 +348,8 @@ def run_master(master_redis_cfg, log_dir, exp):
             logger.info('Increased timestep limit from {} to {}'.format(old_tslimit, tslimit))
 
         step_tend = time.time()
-        tlogger.record_tabular("ParentId", curr_parent)
+        tlogger.record_tabular("ParentId", active_parents[0] if len(active_parents) == 1 else ','.join(map(str, active_parents)))
+        tlogger.record_tabular("BCEvaluations", len(missing))
         tlogger.record_tabular("EpRewMean", returns_n2.mean())
         tlogger.record_tabular("EpRewStd", returns_n2.std())
         tlogger.record_tabular("EpLenMean", lengths_n2.mean())
@@ -268,9 +361,9 @@ def run_master(master_redis_cfg, log_dir, exp):
             np.searchsorted(np.sort(returns_n2.ravel()), eval_rets).mean() / returns_n2.size))
         tlogger.record_tabular("EvalEpCount", len(eval_rets))
 
-        tlogger.record_tabular("Norm", float(np.square(policy.get_trainable_flat()).sum()))
-        tlogger.record_tabular("GradNorm", float(np.square(g).sum()))
-        tlogger.record_tabular("UpdateRatio", float(update_ratio))
+        tlogger.record_tabular("Norm", float(np.mean([np.square(population.theta(p)).sum() for p in active_parents])))
+        tlogger.record_tabular("GradNorm", float(np.mean(grad_norms)))
+        tlogger.record_tabular("UpdateRatio", float(np.mean(update_ratios)))
 
         tlogger.record_tabular("EpisodesThisIter", lengths_n2.size)
         tlogger.record_tabular("EpisodesSoFar", episodes_so_far)
@@ -282,77 +375,113 @@ def run_master(master_redis_cfg, log_dir, exp):
         tlogger.record_tabular("UniqueWorkersFrac", num_unique_workers / len(worker_ids))
         tlogger.record_tabular("ResultsSkippedFrac", frac_results_skipped)
         tlogger.record_tabular("ObCount", ob_count_this_batch)
+        tlogger.record_tabular("WorkerChunkSizeMean", mean_worker_stat(all_task_results, 'chunk_size'))
+        tlogger.record_tabular("WorkerChunkItemTimeMean", mean_worker_stat(all_task_results, 'item_time'))
+        tlogger.record_tabular("WorkerNoveltyQueryTimeMean", mean_worker_stat(all_task_results, 'novelty_query_time'))
+        archive_stats = archive_policy.stats
+        tlogger.record_tabular("ArchiveSize", archive_stats['size'])
+        tlogger.record_tabular("ArchiveInsertRate", archive_stats['insert_rate'])
+        tlogger.record_tabular("ArchiveEvicted", archive_stats['evicted'])
+        tlogger.record_tabular("ArchiveQueryTime", archive_stats['query_time'])
 
         tlogger.record_tabular("TimeElapsedThisIter", step_tend - step_tstart)
         tlogger.record_tabular("TimeElapsed", step_tend - tstart)
         tlogger.dump_tabular()
 
-        #updating population parameters
-        theta_dict[curr_parent] = policy.get_trainable_flat()
-        optimizer_dict[curr_parent] = optimizer
-        if policy.needs_ob_stat:
-            obstat_dict[curr_parent] = ob_stat
+        if config.snapshot_freq != 0 and iteration % config.snapshot_freq == 0:
+            import os.path as osp
+            for p in active_parents:
+                # We're never running the policy in the master, but we might be snapshotting it
+                policy.set_trainable_flat(population.theta(p))
+                if policy.needs_ob_stat:
+                    policy.set_ob_stat(population.ob_stat(p).mean, population.ob_stat(p).std)
+                filename = 'snapshot_iter{:05d}{}_rew{}.h5'.format(
+                    iteration,
+                    '' if len(active_parents) == 1 else '_parent{}'.format(p),
+                    np.nan if not eval_rets else int(np.mean(eval_rets))
+                )
+                # A resumed run may redo the iterations after its last saved state
+                assert population.resumed or not osp.exists(filename)
+                policy.save(filename)
+                tlogger.log('Saved snapshot {}'.format(filename))
 
         if exp['novelty_search']['selection_method'] == "novelty_prob":
-            novelty_probs = []
-            archive = master.get_archive()
-            for p in range(pop_size):
-                policy.set_trainable_flat(theta_dict[p])
-                mean_bc = get_mean_bc(env, policy, tslimit_max, num_rollouts)
-                nov_p = compute_novelty_vs_archive(archive, mean_bc, exp['novelty_search']['k'])
-                novelty_probs.append(nov_p)
-            novelty_probs = np.array(novelty_probs) / float(np.sum(novelty_probs))
-            curr_parent = np.random.choice(range(pop_size), 1, p=novelty_probs)[0]
+            mean_bcs = [bc_cache[(p, theta_version[p])] for p in range(pop_size)]
+            novelty_probs = archive.novelty(mean_bcs, exp['novelty_search']['k']).astype(np.float64)
+            # Members whose BC is already in the archive have zero novelty, keep them selectable so there are always
+            # enough candidates to draw parents_per_iteration distinct ones
+            novelty_probs = novelty_probs + 1e-8
+            novelty_probs = novelty_probs / novelty_probs.sum()
+            active_parents = [int(p) for p in np.random.choice(pop_size, parents_per_iteration, replace=False, p=novelty_probs)]
         elif exp['novelty_search']['selection_method'] == "round_robin":
-            curr_parent = (curr_parent + 1) % pop_size
+            active_parents = [(p + parents_per_iteration) % pop_size for p in active_parents]
         else:
             raise NotImplementedError(exp['novelty_search']['selection_method'])
 
-        if config.snapshot_freq != 0 and curr_task_id % config.snapshot_freq == 0:
-            import os.path as osp
-            filename = 'snapshot_iter{:05d}_rew{}.h5'.format(
-                curr_task_id,
-                np.nan if not eval_rets else int(np.mean(eval_rets))
-            )
-            assert not osp.exists(filename)
-            policy.save(filename)
-            tlogger.log('Saved snapshot {}'.format(filename))
-
-def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2):
+        iteration += 1
+        population.commit({
+            'iteration': iteration,
+            'active_parents': active_parents,
+            'tslimit': tslimit,
+            'episodes_so_far': episodes_so_far,
+            'timesteps_so_far': timesteps_so_far,
+            'theta_version': theta_version,
+            'archive': archive_policy.get_state(),
+        })
+
+def run_worker(master_redis_cfg, relay_redis_cfg, noise):
     logger.info('run_worker: {}'.format(locals()))
     assert isinstance(noise, SharedNoiseTable)
     worker = WorkerClient(relay_redis_cfg, master_redis_cfg)
     exp = worker.get_experiment()
+    chunker = ChunkSizeController(**exp.get('chunking', {}))
     config, env = setup_env(exp)
     sess, policy = setup_policy(env, exp, single_threaded=False)
     rs = np.random.RandomState()
     worker_id = rs.randint(2 ** 31)
     previous_task_id = -1
+    archive = NoveltyArchive(**exp['novelty_search'].get('archive', {}))
 
     assert policy.needs_ob_stat == (config.calc_obstat_prob != 0)
 
     while True:
         task_id, task_data = worker.get_current_task()
         task_tstart = time.time()
-        assert isinstance(task_id, int) and isinstance(task_data, Task)
+
+        if isinstance(task_data, BCTask):
+            # Behavior of one population member, noiseless weights and noiseless actions
+            i = rs.randint(len(task_data.keys))
+            policy.set_trainable_flat(task_data.params[i])
+            if policy.needs_ob_stat:
+                policy.set_ob_stat(task_data.ob_means[i], task_data.ob_stds[i])
+            if policy.needs_ref_batch:
+                policy.set_ref_batch(task_data.ref_batch)
+            _, _, bc = policy.rollout(env, timestep_limit=task_data.timestep_limit)
+            worker.push_result(task_id, BCResult(worker_id=worker_id, key=task_data.keys[i], bc=bc))
+            continue
+
+        assert isinstance(task_id, int) and isinstance(task_data, ParentsTask)
+        i = rs.randint(len(task_data.parent_ids))
+        parent_id, params = task_data.parent_ids[i], task_data.params[i]
 
         if policy.needs_ob_stat:
-            policy.set_ob_stat(task_data.ob_mean, task_data.ob_std)
+            policy.set_ob_stat(task_data.ob_means[i], task_data.ob_stds[i])
 
         if policy.needs_ref_batch:
             policy.set_ref_batch(task_data.ref_batch)
 
         if task_id != previous_task_id:
-            archive = worker.get_archive()
+            for slot, bc in worker.get_archive_updates():
+                archive.put(slot, bc)
             previous_task_id = task_id
 
         if rs.rand() < config.eval_prob:
             # Evaluation: noiseless weights and noiseless actions
-            policy.set_trainable_flat(task_data.params)
+            policy.set_trainable_flat(params)
             eval_rews, eval_length, _ = policy.rollout(env, timestep_limit=task_data.timestep_limit)
             eval_return = eval_rews.sum()
             logger.info('Eval result: task={} return={:.3f} length={}'.format(task_id, eval_return, eval_length))
-            worker.push_result(task_id, Result(
+            worker.push_result(task_id, ParentResult(parent_id, Result(
                 worker_id=worker_id,
                 noise_inds_n=None,
                 returns_n2=None,
@@ -362,34 +491,36 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 eval_length=eval_length,
                 ob_sum=None,
                 ob_sumsq=None,
-                ob_count=None
-            ))
+                ob_count=None,
+                worker_stats=None
+            )))
         else:
             # Rollouts with noise
             noise_inds, returns, signreturns, lengths = [], [], [], []
             task_ob_stat = RunningStat(env.observation_space.shape, eps=0.)  # eps=0 because we're incrementing only
 
-            while not noise_inds or time.time() - task_tstart < min_task_runtime:
+            chunk_tstart = time.time()
+            while chunker.should_continue(len(noise_inds), time.time() - chunk_tstart):
                 noise_idx = noise.sample_index(rs, policy.num_params)
                 v = config.noise_stdev * noise.get(noise_idx, policy.num_params)
 
-                policy.set_trainable_flat(task_data.params + v)
+                policy.set_trainable_flat(params + v)
                 rews_pos, len_pos, nov_vec_pos = rollout_and_update_ob_stat(
                     policy, env, task_data.timestep_limit, rs, task_ob_stat, config.calc_obstat_prob)
 
-                policy.set_trainable_flat(task_data.params - v)
+                policy.set_trainable_flat(params - v)
                 rews_neg, len_neg, nov_vec_neg = rollout_and_update_ob_stat(
                     policy, env, task_data.timestep_limit, rs, task_ob_stat, config.calc_obstat_prob)
 
-                nov_pos = compute_novelty_vs_archive(archive, nov_vec_pos, exp['novelty_search']['k'])
-                nov_neg = compute_novelty_vs_archive(archive, nov_vec_neg, exp['novelty_search']['k'])
+                nov_pos, nov_neg = archive.novelty([nov_vec_pos, nov_vec_neg], exp['novelty_search']['k'])
 
                 signreturns.append([nov_pos, nov_neg]) # (J) novelty scores
                 noise_inds.append(noise_idx)
                 returns.append([rews_pos.sum(), rews_neg.sum()]) # (J) reward scores i.e. fitness scores
                 lengths.append([len_pos, len_neg])
 
-            worker.push_result(task_id, Result(
+            chunker.update(len(noise_inds), time.time() - chunk_tstart)
+            worker.push_result(task_id, ParentResult(parent_id, Result(
                 worker_id=worker_id,
                 noise_inds_n=np.array(noise_inds),
                 returns_n2=np.array(returns, dtype=np.float32),
@@ -399,5 +530,6 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 eval_length=None,
                 ob_sum=None if task_ob_stat.count == 0 else task_ob_stat.sum,
                 ob_sumsq=None if task_ob_stat.count == 0 else task_ob_stat.sumsq,
-                ob_count=task_ob_stat.count
-            ))
+                ob_count=task_ob_stat.count,
+                worker_stats=dict(chunker.stats, novelty_query_time=archive.mean_query_time)
+            )))
@@ -2,10 +2,15 @@ import numpy as np
 
 
 class Optimizer(object):
-    def __init__(self, theta):
+    # Names of the per-parameter state arrays, which can be passed in through state= to keep them elsewhere
+    state_names = ()
+
+    def __init__(self, theta, state=None):
         self.theta = theta
         self.dim = len(self.theta)
         self.t = 0
+        for name in self.state_names:
+            setattr(self, name, np.zeros(self.dim, dtype=np.float32) if state is None else state[name])
 
     def update(self, globalg):
         self.t += 1
@@ -21,31 +26,34 @@ class Optimizer(object):
 
 
 class SGD(Optimizer):
-    def __init__(self, theta, stepsize, momentum=0.9):
-        Optimizer.__init__(self, theta)
-        self.v = np.zeros(self.dim, dtype=np.float32)
+    state_names = ('v',)
+
+    def __init__(self, theta, stepsize, momentum=0.9, state=None):
+        Optimizer.__init__(self, theta, state)
         self.stepsize, self.momentum = stepsize, momentum
 
     def _compute_step(self, globalg):
-        self.v = self.momentum * self.v + (1. - self.momentum) * globalg
+        self.v *= self.momentum
+        self.v += (1. - self.momentum) * globalg
         step = -self.stepsize * self.v
         return step
 
 
 class Adam(Optimizer):
-    def __init__(self, theta, stepsize, beta1=0.9, beta2=0.999, epsilon=1e-08):
-        Optimizer.__init__(self, theta)
+    state_names = ('m', 'v')
+
+    def __init__(self, theta, stepsize, beta1=0.9, beta2=0.999, epsilon=1e-08, state=None):
+        Optimizer.__init__(self, theta, state)
         self.stepsize = stepsize
         self.beta1 = beta1
         self.beta2 = beta2
         self.epsilon = epsilon
-        self.m = np.zeros(self.dim, dtype=np.float32)
-        self.v = np.zeros(self.dim, dtype=np.float32)
 
     def _compute_step(self, globalg):
         a = self.stepsize * np.sqrt(1 - self.beta2 ** self.t) / (1 - self.beta1 ** self.t)
-        self.m = self.beta1 * self.m + (1 - self.beta1) * globalg
-        self.v = self.beta2 * self.v + (1 - self.beta2) * (globalg * globalg)
+        self.m *= self.beta1
+        self.m += (1 - self.beta1) * globalg
+        self.v *= self.beta2
+        self.v += (1 - self.beta2) * (globalg * globalg)
         step = -a * self.m / (np.sqrt(self.v) + self.epsilon)
         return step
-
@@ -8,6 +8,7 @@ import tensorflow as tf
 import tensorflow.contrib.layers as layers
 
 from . import tf_util as U
+from .behavior import make_bc
 
 logger = logging.getLogger(__name__)
 
@@ -120,12 +121,14 @@ def bins(x, dim, num_bins, name):
 
 
 class MujocoPolicy(Policy):
-    def _initialize(self, ob_space, ac_space, ac_bins, ac_noise_std, nonlin_type, hidden_dims, connection_type):
+    def _initialize(self, ob_space, ac_space, ac_bins, ac_noise_std, nonlin_type, hidden_dims, connection_type, bc=None):
         self.ac_space = ac_space
         self.ac_bins = ac_bins
         self.ac_noise_std = ac_noise_std
         self.hidden_dims = hidden_dims
         self.connection_type = connection_type
+        self.bc = make_bc(bc or 'com')
+        self._traj_bc = None
 
         assert len(ob_space.shape) == len(self.ac_space.shape) == 1
         assert np.all(np.isfinite(self.ac_space.low)) and np.all(np.isfinite(self.ac_space.high)), \
@@ -249,13 +252,6 @@ class MujocoPolicy(Policy):
             ob_stat.set_from_init(init_mean, init_std, init_count=1e5)
 
 
-    def _get_pos(self, model):
-        mass = model.body_mass
-        xpos = model.data.xipos
-        center = (np.sum(mass * xpos, 0) / np.sum(mass))
-        return center[0], center[1], center[2]
-
-
     def rollout(self, env, *, render=False, timestep_limit=None, save_obs=False, random_stream=None, policy_seed=None, bc_choice=None):
         """
         If random_stream is provided, the rollout will take noisy actions with noise drawn from that stream.
@@ -264,11 +260,18 @@ class MujocoPolicy(Policy):
         env_timestep_limit = env.spec.tags.get('wrapper_config.TimeLimit.max_episode_steps')
         timestep_limit = env_timestep_limit if timestep_limit is None else min(timestep_limit, env_timestep_limit)
         rews = []
-        x_traj, y_traj = np.zeros(timestep_limit), np.zeros(timestep_limit)
         t = 0
         if save_obs:
             obs = []
 
+        bc = self.bc
+        if bc_choice == "traj":
+            # Legacy per-step trajectory, use {"type": "com_traj"} in the policy args for a strided one
+            if self._traj_bc is None:
+                self._traj_bc = make_bc('com_traj')
+            bc = self._traj_bc
+        bc.reset(timestep_limit)
+
         if policy_seed:
             env.seed(policy_seed)
             np.random.seed(policy_seed)
@@ -281,7 +284,7 @@ class MujocoPolicy(Policy):
             if save_obs:
                 obs.append(ob)
             ob, rew, done, _ = env.step(ac)
-            x_traj[t], y_traj[t], _ = self._get_pos(env.unwrapped.model)
+            bc.step(env, t + 1)
             rews.append(rew)
             t += 1
             if render:
@@ -289,24 +292,19 @@ class MujocoPolicy(Policy):
             if done:
                 break
 
-        x_pos, y_pos, _ = self._get_pos(env.unwrapped.model)
         rews = np.array(rews, dtype=np.float32)
-        x_traj[t:] = x_traj[t-1]
-        y_traj[t:] = y_traj[t-1]
-        if bc_choice and bc_choice == "traj":
-            novelty_vector = np.concatenate((x_traj, y_traj), axis=0)
-        else:
-            novelty_vector = np.array([x_pos, y_pos])
+        novelty_vector = bc.end(env)
         if save_obs:
             return rews, t, np.array(obs), novelty_vector
         return rews, t, novelty_vector
 
 
 class ESAtariPolicy(Policy):
-    def _initialize(self, ob_space, ac_space):
+    def _initialize(self, ob_space, ac_space, bc=None):
         self.ob_space_shape = ob_space.shape
         self.ac_space = ac_space
         self.num_actions = ac_space.n
+        self.bc = make_bc(bc)
 
         with tf.variable_scope(type(self).__name__) as scope:
             o = tf.placeholder(tf.float32, [None] + list(self.ob_space_shape))
@@ -383,7 +381,7 @@ class ESAtariPolicy(Policy):
         env_timestep_limit = env.spec.tags.get('wrapper_config.TimeLimit.max_episode_steps')
 
         timestep_limit = env_timestep_limit if timestep_limit is None else min(timestep_limit, env_timestep_limit)
-        rews = []; novelty_vector = []
+        rews = []
         t = 0
 
         if save_obs:
@@ -396,6 +394,8 @@ class ESAtariPolicy(Policy):
                 random_stream.seed(policy_seed)
 
         ob = env.reset()
+        bc = self.bc
+        bc.reset(timestep_limit)
         self.act(self.ref_list, random_stream=random_stream) #passing ref batch through network
 
         for _ in range(timestep_limit):
@@ -408,31 +408,7 @@ class ESAtariPolicy(Policy):
             start_time = time.time()
             ob, rew, done, info = env.step(ac)
 
-            # TODO: (J) change this BC (should be custom per game instead of just the RAM state)
-#            bc = env.unwrapped._get_ram() # extracts RAM state information
-
-            # TODO: try the following BC's
-            # Number of white ice in water
-            # Number of stepped on ice in water
-            # Number of igloos pieces
-            # Entire water pixels (that entire 2D block of pixel values)
-            # Entire water pixels + entire igloo pixels
-            # --> TODO: try trajectory path (should be unique enough to encourage exploration)
-            # --> TODO: see if good results from step on ice BC is just because of 'R' component of NSR-ES
-            #           i.e. run experiment again but for just NS
-
-            # BC: Number of stepped on ice in water
-            num_stepped_on_ice = 0
-            begin_water_row    = 78
-            end_water_row      = 184+1
-            begin_water_col    = 8
-            end_water_col      = 159+1
-#            for r in range(begin_water_row, end_water_row):
-#                for c in range(begin_water_col, end_water_col):
-#                    if ob[r][c] == [84, 138, 210]:
-#                        num_stepped_on_ice += 1
-            num_stepped_on_ice = len(np.where(ob[begin_water_row:end_water_row] == [84, 138, 210])[0])/3
-            bc = num_stepped_on_ice
+            bc.step(env, t + 1)
 
             if save_obs:
                obs.append(ob)
@@ -440,7 +416,6 @@ class ESAtariPolicy(Policy):
                 worker_stats.time_comp_step += time.time() - start_time
 
             rews.append(rew)
-            novelty_vector.append(bc)
 
             t += 1
             if render:
@@ -449,9 +424,10 @@ class ESAtariPolicy(Policy):
                 break
 
         rews = np.array(rews, dtype=np.float32)
+        novelty_vector = bc.end(env)
         if save_obs:
-            return rews, t, np.array(obs), np.array(novelty_vector)
-        return rews, t, np.array(novelty_vector)
+            return rews, t, np.array(obs), novelty_vector
+        return rews, t, novelty_vector
 
 
 
@@ -0,0 +1,172 @@
+import logging
+import os
+import pickle
+
+import numpy as np
+
+from .es import RunningStat
+from .optimizers import SGD, Adam
+
+logger = logging.getLogger(__name__)
+
+OPTIMIZERS = {'sgd': SGD, 'adam': Adam}
+
+
+class _ObStatRow(RunningStat):
+    """
+    RunningStat over the (staged) rows of a member of a PopulationStore, so increments happen in place
+    """
+
+    def __init__(self, sum, sumsq, count):
+        self.sum = sum
+        self.sumsq = sumsq
+        self._count = count
+
+    @property
+    def count(self):
+        return float(self._count)
+
+    @count.setter
+    def count(self, value):
+        self._count[...] = value
+
+
+class PopulationStore(object):
+    """
+    Meta-population of an NS-ES master: the parameters and optimizer moments of all pop_size members are rows of
+    preallocated (pop_size, num_params) float32 matrices, the observation statistics are stacked the same way.
+
+    Members are updated in place. With a path, the arrays are memory-mapped .npy files in that directory that
+    are reopened (and the population resumed) when a store with matching shapes already exists there.
+
+    Changes to members (update, ob_stat increments) are staged in copies of their rows until commit, which saves
+    them together with the rest of the master's state (iteration, archive, ...) before writing them to the arrays,
+    so a resumed store is always at the end of a committed iteration.
+    """
+
+    def __init__(self, pop_size, num_params, optimizer_type, optimizer_args, ob_shape=None, path=None):
+        self.pop_size, self.num_params = pop_size, num_params
+        self.optimizer_cls = OPTIMIZERS[optimizer_type]
+        self.optimizer_args = optimizer_args
+        self.path = path
+        self.resumed = path is not None and os.path.exists(os.path.join(path, 'thetas.npy'))
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+        self.thetas = self._array('thetas', (pop_size, num_params), np.float32)
+        self.moments = {name: self._array(name, (pop_size, num_params), np.float32)
+                        for name in self.optimizer_cls.state_names}
+        self.steps = self._array('steps', (pop_size,), np.int64)
+        self.ob_shape = ob_shape
+        if ob_shape is not None:
+            self.ob_sum = self._array('ob_sum', (pop_size,) + tuple(ob_shape), np.float32)
+            self.ob_sumsq = self._array('ob_sumsq', (pop_size,) + tuple(ob_shape), np.float32)
+            self.ob_count = self._array('ob_count', (pop_size,), np.float64)
+        self._fields = dict(self.moments, thetas=self.thetas, steps=self.steps)
+        if ob_shape is not None:
+            self._fields.update(ob_sum=self.ob_sum, ob_sumsq=self.ob_sumsq, ob_count=self.ob_count)
+        # Member -> field -> staged row, since the last commit
+        self._staged = {}
+        if self.resumed:
+            state = self.load_state()
+            if state is not None and state.get('rows'):
+                # Redo the writes of the last commit, which may have been interrupted
+                self._write(state['rows'])
+            logger.info('Resumed population of {} from {} (optimizer steps {})'.format(
+                pop_size, path, self.steps.tolist()))
+
+    def _array(self, name, shape, dtype):
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+        filename = os.path.join(self.path, name + '.npy')
+        if self.resumed:
+            arr = np.lib.format.open_memmap(filename, mode='r+')
+            assert arr.shape == shape and arr.dtype == dtype, \
+                'Population store {} does not match: {} {} instead of {} {}'.format(
+                    filename, arr.shape, arr.dtype, shape, np.dtype(dtype))
+            return arr
+        return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+
+    def __len__(self):
+        return self.pop_size
+
+    def _row(self, name, i):
+        rows = self._staged.setdefault(i, {})
+        if name not in rows:
+            rows[name] = np.array(self._fields[name][i])
+        return rows[name]
+
+    def theta(self, i):
+        rows = self._staged.get(i, {})
+        return rows['thetas'] if 'thetas' in rows else np.asarray(self.thetas[i])
+
+    def set_member(self, i, theta, ob_stat=None):
+        self.thetas[i] = theta
+        for m in self.moments.values():
+            m[i] = 0
+        self.steps[i] = 0
+        if ob_stat is not None:
+            self.ob_sum[i] = ob_stat.sum
+            self.ob_sumsq[i] = ob_stat.sumsq
+            self.ob_count[i] = ob_stat.count
+
+    def ob_stat(self, i):
+        if self.ob_shape is None:
+            return None
+        return _ObStatRow(self._row('ob_sum', i), self._row('ob_sumsq', i), self._row('ob_count', i))
+
+    def update(self, i, globalg):
+        """
+        One optimizer step of member i, returns the update ratio and the new parameters
+        """
+        optimizer = self.optimizer_cls(self.theta(i), state=self._state(i), **self.optimizer_args)
+        optimizer.t = int(self._row('steps', i))
+        update_ratio, theta = optimizer.update(globalg)
+        self._staged[i]['thetas'] = np.asarray(theta, dtype=np.float32)
+        self._row('steps', i)[...] = optimizer.t
+        return update_ratio, self.theta(i)
+
+    def _state(self, i):
+        return {name: self._row(name, i) for name in self.moments}
+
+    def _write(self, rows):
+        for i, fields in rows.items():
+            for name, row in fields.items():
+                self._fields[name][i] = row
+        self.flush()
+
+    def commit(self, state):
+        """
+        Saves state with the staged rows (see save_state), then writes the rows to the arrays. A crash in between is
+        redone when the store is resumed.
+        """
+        self.save_state(dict(state, rows=self._staged))
+        self._write(self._staged)
+        self._staged = {}
+
+    def save_state(self, state):
+        """
+        Pickles state next to the arrays, replacing the previous one atomically
+        """
+        if self.path is None:
+            return
+        filename = os.path.join(self.path, 'state.pkl')
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=-1)
+        os.replace(filename + '.tmp', filename)
+
+    def load_state(self):
+        """
+        The state last saved with save_state, None if there is none
+        """
+        filename = None if self.path is None else os.path.join(self.path, 'state.pkl')
+        if filename is None or not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    def flush(self):
+        if self.path is None:
+            return
+        for arr in self._fields.values():
+            arr.flush()
@@ -146,6 +146,8 @@ def run_master(master_redis_cfg, log_dir, exp):
         tlogger.record_tabular("UniqueWorkersFrac", num_unique_workers / len(worker_ids))
         tlogger.record_tabular("ResultsSkippedFrac", frac_results_skipped)
         tlogger.record_tabular("ObCount", ob_count_this_batch)
+        tlogger.record_tabular("WorkerChunkSizeMean", mean_worker_stat(curr_task_results, 'chunk_size'))
+        tlogger.record_tabular("WorkerChunkItemTimeMean", mean_worker_stat(curr_task_results, 'item_time'))
 
         tlogger.record_tabular("TimeElapsedThisIter", step_tend - step_tstart)
         tlogger.record_tabular("TimeElapsed", step_tend - tstart)
@@ -163,11 +165,12 @@ def run_master(master_redis_cfg, log_dir, exp):
             tlogger.log('Saved snapshot {}'.format(filename))
 
 
-def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2):
+def run_worker(master_redis_cfg, relay_redis_cfg, noise):
     logger.info('run_worker: {}'.format(locals()))
     assert isinstance(noise, SharedNoiseTable)
-    worker = WorkerClient(master_redis_cfg, relay_redis_cfg)
+    worker = WorkerClient(relay_redis_cfg, master_redis_cfg)
     exp = worker.get_experiment()
+    chunker = ChunkSizeController(**exp.get('chunking', {}))
     config, env, sess, policy = setup(exp, single_threaded=True)
     rs = np.random.RandomState()
     worker_id = rs.randint(2 ** 31)
@@ -200,14 +203,16 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 eval_length=eval_length,
                 ob_sum=None,
                 ob_sumsq=None,
-                ob_count=None
+                ob_count=None,
+                worker_stats=None
             ))
         else:
             # Rollouts with noise
             noise_inds, returns, signreturns, lengths = [], [], [], []
             task_ob_stat = RunningStat(env.observation_space.shape, eps=0.)  # eps=0 because we're incrementing only
 
-            while not noise_inds or time.time() - task_tstart < min_task_runtime:
+            chunk_tstart = time.time()
+            while chunker.should_continue(len(noise_inds), time.time() - chunk_tstart):
                 noise_idx = noise.sample_index(rs, policy.num_params)
                 v = noise.get(noise_idx, policy.num_params)
 
@@ -221,6 +226,7 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 signreturns.append([np.sign(rews_pos).sum()])
                 lengths.append([len_pos])
 
+            chunker.update(len(noise_inds), time.time() - chunk_tstart)
             worker.push_result(task_id, Result(
                 worker_id=worker_id,
                 noise_inds_n=np.array(noise_inds),
@@ -231,5 +237,6 @@ def run_worker(master_redis_cfg, relay_redis_cfg, noise, *, min_task_runtime=.2)
                 eval_length=None,
                 ob_sum=None if task_ob_stat.count == 0 else task_ob_stat.sum,
                 ob_sumsq=None if task_ob_stat.count == 0 else task_ob_stat.sumsq,
-                ob_count=task_ob_stat.count
+                ob_count=task_ob_stat.count,
+                worker_stats=chunker.stats
             ))
@@ -0,0 +1,225 @@
+import ctypes
+import glob
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from .dist import set_worker_slot
+
+logger = logging.getLogger(__name__)
+
+# Same settings scripts/launch.py puts on the workers command line
+SINGLE_THREAD_ENV = {'MKL_NUM_THREADS': '1', 'OPENBLAS_NUM_THREADS': '1', 'OMP_NUM_THREADS': '1'}
+RELAY_SLOT = 'relay'
+
+
+def limit_threads():
+    """
+    Single threaded BLAS/OpenMP for every process forked from here on. Must run before numpy and tensorflow are
+    imported to take effect, values already present in the environment win.
+    """
+    for k, v in SINGLE_THREAD_ENV.items():
+        os.environ.setdefault(k, v)
+
+
+def parse_cpulist(s):
+    cpus = []
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def cpu_order():
+    """
+    CPUs this process may run on, grouped by NUMA node so that neighbouring worker slots share a node.
+    Falls back to plain CPU order when the topology isn't exposed in sysfs.
+    """
+    available = os.sched_getaffinity(0)
+    order = []
+    nodes = glob.glob('/sys/devices/system/node/node[0-9]*')
+    for node in sorted(nodes, key=lambda path: int(path.rsplit('node', 1)[1])):
+        try:
+            with open(os.path.join(node, 'cpulist')) as f:
+                cpus = parse_cpulist(f.read())
+        except (OSError, ValueError):
+            continue
+        order.extend(c for c in cpus if c in available and c not in order)
+    order.extend(sorted(c for c in available if c not in order))
+    return order
+
+
+def _die_with_parent():
+    # Linux only: get SIGTERM if the supervisor goes away without cleaning up
+    try:
+        ctypes.CDLL('libc.so.6', use_errno=True).prctl(1, signal.SIGTERM)  # PR_SET_PDEATHSIG
+    except (OSError, AttributeError):
+        pass
+
+
+class WorkerSupervisor(object):
+    """
+    Forks and babysits the relay and num_workers workers.
+
+    Each worker is pinned to its own core, dead processes are restarted with exponential backoff (reset once a
+    process stayed up for min_uptime seconds), per-worker result throughput is logged every report_interval
+    seconds, and SIGINT/SIGTERM take the whole process tree down.
+
+    If given, preload runs once in this process after the relay is up and before any worker is forked. It should do
+    the fork-safe part of worker setup (heavy imports, graph construction, but no sessions, threads or open
+    connections), which every worker and every restarted worker then inherits instead of redoing it.
+    """
+
+    def __init__(self, num_workers, run_worker, run_relay=None, *, preload=None, pin_cpus=True, base_delay=1.,
+                 max_delay=60., min_uptime=60., report_interval=60.):
+        self.num_workers = num_workers
+        self.targets = {i: run_worker for i in range(num_workers)}
+        if run_relay is not None:
+            self.targets[RELAY_SLOT] = run_relay
+        self.cpus = cpu_order() if pin_cpus else None
+        self.base_delay, self.max_delay, self.min_uptime = base_delay, max_delay, min_uptime
+        self.report_interval = report_interval
+        self.preload = preload
+
+        self.results_counter = multiprocessing.RawArray(ctypes.c_long, num_workers)
+        self.ready_times = multiprocessing.RawArray(ctypes.c_double, num_workers)
+        self.ready_latencies = []
+        self.awaiting_ready = set()
+        self.procs = {}  # pid -> slot
+        self.started_at = {}
+        self.failures = {slot: 0 for slot in self.targets}
+        self.restarts = {slot: 0 for slot in self.targets}
+        self.pending = {}  # slot -> time at which to restart it
+        self._stopping = False
+
+    def _spawn(self, slot):
+        if slot != RELAY_SLOT:
+            self.ready_times[slot] = 0
+            self.awaiting_ready.add(slot)
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                _die_with_parent()
+                if slot != RELAY_SLOT:
+                    if self.cpus:
+                        os.sched_setaffinity(0, {self.cpus[slot % len(self.cpus)]})
+                    set_worker_slot(self.results_counter, self.ready_times, slot)
+                self.targets[slot]()
+            except BaseException:
+                logger.exception('[supervisor] {} crashed'.format(self._name(slot)))
+                status = 1
+            finally:
+                os._exit(status)
+        self.procs[pid] = slot
+        self.started_at[slot] = time.time()
+        logger.info('[supervisor] Started {} (pid {}{})'.format(
+            self._name(slot), pid,
+            ', cpu {}'.format(self.cpus[slot % len(self.cpus)]) if self.cpus and slot != RELAY_SLOT else ''))
+
+    def _name(self, slot):
+        return 'relay' if slot == RELAY_SLOT else 'worker {}'.format(slot)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = self.procs.pop(pid, None)
+            if slot is None or self._stopping:
+                continue
+            uptime = time.time() - self.started_at[slot]
+            self.failures[slot] = 1 if uptime >= self.min_uptime else self.failures[slot] + 1
+            delay = min(self.base_delay * 2 ** (self.failures[slot] - 1), self.max_delay)
+            self.restarts[slot] += 1
+            self.pending[slot] = time.time() + delay
+            logger.warning('[supervisor] {} (pid {}) exited with status {} after {:.1f}s. Restarting in {:.1f}s'.format(
+                self._name(slot), pid, status, uptime, delay))
+
+    def _check_ready(self):
+        for slot in list(self.awaiting_ready):
+            if self.ready_times[slot] == 0:
+                continue
+            latency = self.ready_times[slot] - self.started_at[slot]
+            self.ready_latencies.append(latency)
+            self.awaiting_ready.remove(slot)
+            logger.info('[supervisor] {} ready {:.2f}s after fork'.format(self._name(slot), latency))
+
+    def _report(self, elapsed, last_counts):
+        counts = list(self.results_counter)
+        rates = [(c - l) / elapsed for c, l in zip(counts, last_counts)]
+        logger.info('[supervisor] {:.2f} results/s from {}/{} live workers ({} restarts). Per worker: {}'.format(
+            sum(rates), sum(1 for slot in self.procs.values() if slot != RELAY_SLOT), self.num_workers,
+            sum(self.restarts.values()), ' '.join('{:.2f}'.format(r) for r in rates)))
+        if self.ready_latencies:
+            logger.info('[supervisor] Worker ready latency: mean {:.2f}s max {:.2f}s over {} starts'.format(
+                sum(self.ready_latencies) / len(self.ready_latencies), max(self.ready_latencies),
+                len(self.ready_latencies)))
+        return counts
+
+    def _handle_signal(self, signum, frame):
+        logger.info('[supervisor] Received signal {}, shutting down'.format(signum))
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        if RELAY_SLOT in self.targets:
+            self._spawn(RELAY_SLOT)
+        if self.preload is not None:
+            tstart = time.time()
+            try:
+                self.preload()
+                logger.info('[supervisor] Preloaded worker template in {:.2f}s'.format(time.time() - tstart))
+            except Exception:
+                logger.exception('[supervisor] Preloading failed, workers will set themselves up from scratch')
+        for slot in range(self.num_workers):
+            self._spawn(slot)
+
+        last_report, last_counts = time.time(), list(self.results_counter)
+        while not self._stopping:
+            self._reap()
+            self._check_ready()
+            now = time.time()
+            for slot, restart_time in list(self.pending.items()):
+                if restart_time <= now and not self._stopping:
+                    del self.pending[slot]
+                    self._spawn(slot)
+            if now - last_report >= self.report_interval:
+                last_counts = self._report(now - last_report, last_counts)
+                last_report = now
+            time.sleep(0.5)
+        self.shutdown()
+
+    def shutdown(self, timeout=10.):
+        self._stopping = True
+        for pid in list(self.procs):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + timeout
+        while self.procs and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.procs):
+            logger.warning('[supervisor] {} (pid {}) did not exit, killing it'.format(self._name(self.procs[pid]), pid))
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.procs.clear()
+        logger.info('[supervisor] All workers stopped')
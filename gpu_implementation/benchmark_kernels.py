@@ -0,0 +1,118 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+"""
+Times the kernels of neuroevolution.kernels.STRATEGIES on every indexed layer of the models in neuroevolution.models
+and writes the timings to a kernel profile, which models consult when kernel_profile is set in the experiment JSON
+(or NEUROEVOLUTION_KERNEL_PROFILE in the environment):
+
+    python benchmark_kernels.py --output kernels.json --batch_sizes 64 --obs_shape 84,84,4 --num_actions 18
+
+Timings are merged into an existing profile at the output path.
+"""
+
+import argparse
+import os
+import time
+import tensorflow as tf
+import numpy as np
+from neuroevolution.tf_util import get_available_gpus
+from neuroevolution import kernels
+import neuroevolution.models
+import tabular_logger as tlogger
+
+
+def model_layers(Model, obs_shape, num_actions, batch_size, device):
+    """
+    (name, layer, strategy) of the indexed layers of Model, see BaseModel.indexed_matmul
+    """
+    with tf.Graph().as_default(), tf.device(device):
+        x = tf.placeholder(tf.float32, (None, 1) + obs_shape)
+        indices = tf.placeholder(tf.int32, (None, ))
+        model = Model()
+        model.make_net(x, num_actions, indices=indices, batch_size=batch_size,
+                       ref_batch=np.zeros((1, ) + obs_shape, dtype=np.float32))
+        return model.layer_kernels
+
+
+def time_layer(strategy, batch_size, m, k, n, num_slots, device, iterations):
+    """
+    Median seconds of one (num_slots, m, k) x (batch_size, k, n) product with the given strategy
+    """
+    with tf.Graph().as_default():
+        with tf.device(device):
+            a = tf.get_variable('a', (num_slots, m, k), initializer=tf.random_normal_initializer(), trainable=False)
+            b = tf.get_variable('b', (batch_size, k, n), initializer=tf.random_normal_initializer(), trainable=False)
+            indices = tf.constant(np.random.RandomState(0).choice(batch_size, num_slots, replace=False), dtype=tf.int32)
+            op = kernels.STRATEGIES[strategy](a, b, indices).op
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(3):
+                sess.run(op)
+            times = []
+            for _ in range(iterations):
+                tstart = time.time()
+                sess.run(op)
+                times.append(time.time() - tstart)
+    return float(np.median(times))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='kernels.json')
+    parser.add_argument('--models', nargs='+', default=['Model', 'LargeModel', 'SmallDQN', 'LargeDQN', 'ModelVirtualBN',
+                                                        'LinearClassifier', 'SimpleClassifier'])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64])
+    parser.add_argument('--slot_fractions', type=float, nargs='+', default=[0.25, 0.5, 1.0],
+                        help='Numbers of running slots to time, as fractions of the batch size')
+    parser.add_argument('--obs_shape', default='84,84,4')
+    parser.add_argument('--num_actions', type=int, default=18)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    device = args.device or ('/gpu:0' if get_available_gpus() else '/cpu:0')
+    obs_shape = tuple(int(d) for d in args.obs_shape.split(','))
+    profile = kernels.KernelProfile.load(args.output) if os.path.exists(args.output) else kernels.KernelProfile()
+
+    models = {}
+    for name in args.models:
+        Model = neuroevolution.models.__dict__[name]
+        for batch_size in args.batch_sizes:
+            models[(name, batch_size)] = model_layers(Model, obs_shape, args.num_actions, batch_size, device)
+
+    layers = sorted(set(layer for model in models.values() for _, layer, _ in model))
+    for layer in layers:
+        _, batch_size, m, k, n = layer
+        for num_slots in sorted(set(max(1, int(round(f * batch_size))) for f in args.slot_fractions)):
+            for strategy in sorted(kernels.STRATEGIES):
+                seconds = time_layer(strategy, batch_size, m, k, n, num_slots, device, args.iterations)
+                profile.record(kernels.layer_key(*layer), strategy, num_slots, seconds)
+                tlogger.info('{} slots={} {}: {:.3f}ms'.format(kernels.layer_key(*layer), num_slots, strategy, seconds * 1000))
+        tlogger.info('{}: {}'.format(kernels.layer_key(*layer), profile.best(kernels.layer_key(*layer))))
+
+    profile.save(args.output)
+    tlogger.info('Wrote {} layers to {}'.format(len(profile.entries), args.output))
+    for (name, batch_size), model in sorted(models.items()):
+        tlogger.info('{} (batch size {}): {}'.format(name, batch_size, ', '.join(
+            '{}={}'.format(layer_name, profile.best(kernels.layer_key(*layer))) for layer_name, layer, _ in model)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+"""
+Throughput of the hard maze implementations: HardMaze stepped directly in NumPy, NumpyMazeEnv and, when
+gym_tensorflow.so is built, the C++ MazeEnv, the last two in a TensorFlow session as RLEvalutionWorker runs them.
+
+    python benchmark_maze.py --batch_sizes 1 64 1024 --episodes 2
+"""
+
+import argparse
+import time
+import tensorflow as tf
+import numpy as np
+import gym_tensorflow
+from gym_tensorflow.maze import MazeEnv, NumpyMazeEnv
+from gym_tensorflow.maze.np_maze import HardMaze
+import tabular_logger as tlogger
+
+
+def time_numpy(batch_size, episodes):
+    maze = HardMaze(batch_size)
+    indices = np.arange(batch_size)
+    rs = np.random.RandomState(0)
+    steps = 0
+    tstart = time.time()
+    for _ in range(episodes):
+        maze.reset(indices)
+        done = np.zeros(batch_size, dtype=np.bool_)
+        while not done.all():
+            maze.observation(indices)
+            _, done = maze.step(indices, rs.uniform(-0.5, 0.5, (batch_size, 2)))
+            steps += batch_size
+    return steps / (time.time() - tstart)
+
+
+def time_env(make_env, batch_size, episodes):
+    with tf.Graph().as_default():
+        env = make_env(batch_size)
+        indices = tf.range(batch_size)
+        reset_op = env.reset(indices=indices, max_frames=env.env_default_timestep_cutoff)
+        obs = env.observation(indices=indices)
+        # Random actions, after the observation like a policy's would be
+        with tf.control_dependencies([obs]):
+            action = tf.random_uniform((batch_size, 2), minval=-0.5, maxval=0.5)
+        rew_op, done_op = env.step(action, indices=indices)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            steps = 0
+            tstart = time.time()
+            for _ in range(episodes):
+                sess.run(reset_op)
+                done = np.zeros(batch_size, dtype=np.bool_)
+                while not done.all():
+                    _, done = sess.run([rew_op, done_op])
+                    steps += batch_size
+            return steps / (time.time() - tstart)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 64, 256, 1024])
+    parser.add_argument('--episodes', type=int, default=2)
+    args = parser.parse_args()
+
+    envs = [('NumPy', None), ('NumpyMazeEnv', NumpyMazeEnv)]
+    if gym_tensorflow.gym_tensorflow_module is not None:
+        envs.append(('MazeEnv (C++)', MazeEnv))
+    else:
+        tlogger.info('gym_tensorflow.so not available, skipping MazeEnv')
+
+    for batch_size in args.batch_sizes:
+        for name, make_env in envs:
+            if make_env is None:
+                steps_per_second = time_numpy(batch_size, args.episodes)
+            else:
+                steps_per_second = time_env(make_env, batch_size, args.episodes)
+            tlogger.info('batch size {:5d} {:>14}: {:12.0f} steps/s'.format(batch_size, name, steps_per_second))
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,7 @@ from neuroevolution.tf_util import get_available_gpus, WorkerSession
 from neuroevolution.helper import SharedNoiseTable, make_schedule
 from neuroevolution.concurrent_worker import ConcurrentWorkers
 from neuroevolution.optimizers import SGD, Adam
+from neuroevolution import kernels
 import neuroevolution.models
 import tabular_logger as tlogger
 from threading import Lock
@@ -142,10 +143,12 @@ def main(**exp):
     tlogger.info(json.dumps(exp, indent=4, sort_keys=True))
     tlogger.info('Logging to: {}'.format(log_dir))
     Model = neuroevolution.models.__dict__[exp['model']]
+    if 'kernel_profile' in exp:
+        kernels.set_profile(exp['kernel_profile'])
     all_tstart = time.time()
     def make_env(b):
-        return gym_tensorflow.make(game=exp["game"], batch_size=b)
-    worker = ConcurrentWorkers(make_env, Model, batch_size=64)
+        return gym_tensorflow.make(game=exp["game"], batch_size=b, **exp.get('env_args', {}))
+    worker = ConcurrentWorkers(make_env, Model, batch_size=64, remote=exp.get('remote'), **exp.get('cpu', {}))
     with WorkerSession(worker) as sess:
         noise = SharedNoiseTable()
         rs = np.random.RandomState()
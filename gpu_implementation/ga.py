@@ -25,12 +25,15 @@ import base64
 import pickle
 import tempfile
 import os
+import threading
 from shutil import copyfile
 import tensorflow as tf
 import numpy as np
 from neuroevolution.tf_util import get_available_gpus, WorkerSession
 from neuroevolution.helper import SharedNoiseTable, make_schedule
 from neuroevolution.concurrent_worker import ConcurrentWorkers
+from neuroevolution.lineage import LineageStore
+from neuroevolution import kernels
 import neuroevolution.models
 import gym_tensorflow
 import tabular_logger as tlogger
@@ -102,30 +105,87 @@ class OffspringCached(object):
     def __init__(self, seeds):
         self.seeds = seeds
 
+class OffspringPipeline(object):
+    """
+    Evaluates offspring of the next generation in the background, while the current one is validated and its elite
+    tested. Offspring are only launched while fewer than max_in_flight episodes of any kind are outstanding, so they
+    take the slots validation and test episodes leave free instead of queueing up in front of them.
+
+    Parents are drawn upfront for the whole next generation. Offspring of the last selected parent, which the elite
+    may still replace, are left for the next generation's monitor_eval, so the offspring follow the same distribution
+    as without pipelining.
+    """
+    def __init__(self, worker, generation, make_offspring, parent_indices, max_frames, max_in_flight):
+        self.worker = worker
+        self.generation = generation
+        self.make_offspring = make_offspring
+        self.pending = list(parent_indices)
+        self.max_frames = max_frames
+        self.max_in_flight = max_in_flight
+        self.launched = []
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while self.pending and not self._stopped:
+            if self.worker.num_in_flight >= self.max_in_flight:
+                time.sleep(0.005)
+                continue
+            task = self.make_offspring(self.pending[-1])
+            self.launched.append(self.worker.eval_async(*task, max_frames=self.max_frames))
+            self.pending.pop()
+
+    def stop(self):
+        """
+        Stops launching offspring, returns the results of the launched ones (tagged with their generation) and the
+        parent indices of those never launched
+        """
+        self._stopped = True
+        if self._thread.ident is not None:
+            self._thread.join()
+        return [(self.generation, r) for r in self.launched], self.pending
+
 def main(**exp):
     log_dir = tlogger.log_dir()
 
     tlogger.info(json.dumps(exp, indent=4, sort_keys=True))
     tlogger.info('Logging to: {}'.format(log_dir))
     Model = neuroevolution.models.__dict__[exp['model']]
+    if 'kernel_profile' in exp:
+        kernels.set_profile(exp['kernel_profile'])
     all_tstart = time.time()
     def make_env(b):
-        return gym_tensorflow.make(game=exp["game"], batch_size=b)
-    worker = ConcurrentWorkers(make_env, Model, batch_size=64)
+        return gym_tensorflow.make(game=exp["game"], batch_size=b, **exp.get('env_args', {}))
+    noise = SharedNoiseTable()
+    # Offspring computed in-graph from a copy of the noise table and the parents held on every device
+    in_graph_mutation = exp.get('in_graph_mutation', False) and exp['selection_threshold'] > 0
+    worker = ConcurrentWorkers(make_env, Model, batch_size=64, unroll_steps=exp.get('unroll_steps', 1),
+                               noise=noise, num_parent_slots=exp['selection_threshold'] if in_graph_mutation else 0,
+                               remote=exp.get('remote'), **exp.get('cpu', {}))
     with WorkerSession(worker) as sess:
-        noise = SharedNoiseTable()
         rs = np.random.RandomState()
 
         cached_parents = []
+        lineage = LineageStore(**exp.get('lineage', {}))
         results = []
+        pipelining = exp.get('pipeline_generations', True) and worker.num_slots > 0
+        pipeline = None
 
 
-        def make_offspring():
+        def make_offspring(parent_idx=None):
             if len(cached_parents) == 0:
                 return worker.model.randomize(rs, noise)
             else:
                 assert len(cached_parents) == exp['selection_threshold']
-                parent = cached_parents[rs.randint(len(cached_parents))]
+                if parent_idx is None:
+                    parent_idx = rs.randint(len(cached_parents))
+                parent = cached_parents[parent_idx]
+                if in_graph_mutation:
+                    return worker.model.mutate_slot(parent_idx, parent[1], rs, noise, mutation_power=state.sample(state.mutation_power))
                 return worker.model.mutate(parent, rs, noise, mutation_power=state.sample(state.mutation_power))
 
         tlogger.info('Start timing')
@@ -147,11 +207,14 @@ def main(**exp):
         if state.population and exp['selection_threshold'] > 0:
             tlogger.info("Caching parents")
             cached_parents.clear()
+            # Parents share most of their lineage, register it so that common prefixes are only computed once
+            lineage.add_lineages([state.elite.seeds] + [o.seeds for o in state.population[:exp['selection_threshold']]])
             if state.elite in state.population[:exp['selection_threshold']]:
-                cached_parents.extend([(worker.model.compute_weights_from_seeds(noise, o.seeds), o.seeds) for o in state.population[:exp['selection_threshold']]])
+                cached_parents.extend([(worker.model.compute_weights_from_seeds(noise, o.seeds, cache=lineage), o.seeds) for o in state.population[:exp['selection_threshold']]])
             else:
-                cached_parents.append((worker.model.compute_weights_from_seeds(noise, state.elite.seeds), state.elite.seeds))
-                cached_parents.extend([(worker.model.compute_weights_from_seeds(noise, o.seeds), o.seeds) for o in state.population[:exp['selection_threshold']-1]])
+                cached_parents.append((worker.model.compute_weights_from_seeds(noise, state.elite.seeds, cache=lineage), state.elite.seeds))
+                cached_parents.extend([(worker.model.compute_weights_from_seeds(noise, o.seeds, cache=lineage), o.seeds) for o in state.population[:exp['selection_threshold']-1]])
+            worker.store_parents(cached_parents)
             tlogger.info("Done caching parents")
 
         while True:
@@ -159,13 +222,21 @@ def main(**exp):
             if state.timesteps_so_far >= exp['timesteps']:
                 tlogger.info('Training terminated after {} timesteps'.format(state.timesteps_so_far))
                 break
-            frames_computed_so_far = sess.run(worker.steps_counter)
+            frames_at_iteration_start = sess.run(worker.steps_counter)
+            slot_seconds_so_far = worker.slot_seconds
             assert (len(cached_parents) == 0 and state.it == 0) or len(cached_parents) == exp['selection_threshold']
 
-            tasks = [make_offspring() for _ in range(exp['population_size'])]
-            for seeds, episode_reward, episode_length in worker.monitor_eval(tasks, max_frames=state.tslimit * 4):
+            # Offspring already evaluated while the previous generation was validated
+            prefetched, parent_indices = [], [None] * exp['population_size']
+            if pipeline is not None:
+                prefetched, parent_indices = pipeline.stop()
+                parent_indices = parent_indices + deferred_parent_indices
+                pipeline = None
+                assert all(generation == state.it for generation, _ in prefetched)
+
+            tasks = [make_offspring(j) for j in parent_indices]
+            for seeds, episode_reward, episode_length in worker.monitor_eval(tasks, max_frames=state.tslimit * 4) + [r.get() for _, r in prefetched]:
                 results.append(Offspring(seeds, [episode_reward], [episode_length]))
-            state.num_frames += sess.run(worker.steps_counter) - frames_computed_so_far
 
             state.it += 1
             tlogger.record_tabular('Iteration', state.it)
@@ -184,14 +255,42 @@ def main(**exp):
             tlogger.record_tabular('PopulationTimesteps', population_timesteps)
             tlogger.record_tabular('NumSelectedIndividuals', exp['selection_threshold'])
 
+            next_tslimit = state.tslimit
+            if state.adaptive_tslimit:
+                if np.mean([a.training_steps >= state.tslimit for a in results]) > state.incr_tslimit_threshold:
+                    next_tslimit = min(state.tslimit * state.tslimit_incr_ratio, state.tslimit_max)
+
+            # Selection is known, start on the next generation while this one is validated
+            next_parents = []
+            if pipelining:
+                num_parents = exp['selection_threshold']
+                if num_parents > 0:
+                    next_parents = [(worker.model.compute_weights_from_seeds(noise, o.seeds, cache=lineage), o.seeds) for o in state.population[:num_parents-1]]
+                    parent_indices = rs.randint(num_parents, size=exp['population_size']).tolist()
+                    if in_graph_mutation:
+                        # Nothing of this generation is loaded from the parent slots anymore
+                        worker.store_parents(next_parents)
+                        make_next_offspring = lambda j: worker.model.mutate_slot(j, next_parents[j][1], rs, noise, mutation_power=state.sample(state.mutation_power))
+                    else:
+                        make_next_offspring = lambda j: worker.model.mutate(next_parents[j], rs, noise, mutation_power=state.sample(state.mutation_power))
+                else:
+                    parent_indices = [None] * exp['population_size']
+                    make_next_offspring = lambda j: worker.model.randomize(rs, noise)
+                deferred_parent_indices = [j for j in parent_indices if j == num_parents - 1]
+                pipeline = OffspringPipeline(worker, state.it, make_next_offspring,
+                                             [j for j in parent_indices if j != num_parents - 1],
+                                             max_frames=next_tslimit * 4,
+                                             max_in_flight=exp.get('pipeline_max_in_flight', worker.num_slots))
+
             tlogger.info('Evaluate population')
             validation_population = state.population[:exp['validation_threshold']]
             if state.elite is not None:
                 validation_population = [state.elite] + validation_population[:-1]
 
-            validation_tasks = [(worker.model.compute_weights_from_seeds(noise, validation_population[x].seeds, cache=cached_parents), validation_population[x].seeds)
+            validation_tasks = [(worker.model.compute_weights_from_seeds(noise, validation_population[x].seeds, cache=lineage), validation_population[x].seeds)
                                            for x in range(exp['validation_threshold'])]
-            _, population_validation, population_validation_len = zip(*worker.monitor_eval_repeated(validation_tasks, max_frames=state.tslimit * 4, num_episodes=exp['num_validation_episodes']))
+            _, population_validation, population_validation_len = zip(*worker.monitor_eval_repeated(validation_tasks, max_frames=state.tslimit * 4, num_episodes=exp['num_validation_episodes'],
+                                                                                                    on_submitted=pipeline.start if pipeline is not None else None))
             population_validation = [np.mean(x) for x in population_validation]
             population_validation_len = [np.sum(x) for x in population_validation_len]
 
@@ -200,7 +299,7 @@ def main(**exp):
 
             population_elite_idx = np.argmax(population_validation)
             state.elite = validation_population[population_elite_idx]
-            elite_theta = worker.model.compute_weights_from_seeds(noise, state.elite.seeds, cache=cached_parents)
+            elite_theta = worker.model.compute_weights_from_seeds(noise, state.elite.seeds, cache=lineage)
             _, population_elite_evals, population_elite_evals_timesteps = worker.monitor_eval_repeated([(elite_theta, state.elite.seeds)], max_frames=None, num_episodes=exp['num_test_episodes'])[0]
 
             # Log Results
@@ -208,6 +307,10 @@ def main(**exp):
             timesteps_this_iter = population_timesteps + validation_timesteps
             state.timesteps_so_far += timesteps_this_iter
             state.validation_timesteps_so_far += validation_timesteps
+            # Offspring frames are the frames of the whole iteration but those of the validation and the elite test, so
+            # the offspring the pipeline evaluates alongside them count as well
+            state.num_frames += (sess.run(worker.steps_counter) - frames_at_iteration_start - validation_timesteps -
+                                 int(np.sum(population_elite_evals_timesteps)))
 
             # Log
             tlogger.record_tabular('TruncatedPopulationRewMean', np.mean([a.fitness for a in validation_population]))
@@ -228,8 +331,15 @@ def main(**exp):
             tlogger.record_tabular('ValidationTimestepsSoFar', state.validation_timesteps_so_far)
             tlogger.record_tabular('TimestepsThisIter', timesteps_this_iter)
             tlogger.record_tabular('TimestepsPerSecondThisIter', timesteps_this_iter/(time.time()-tstart_iteration))
+            tlogger.record_tabular('FramesPerSecondThisIter', (sess.run(worker.steps_counter) - frames_at_iteration_start)/(time.time()-tstart_iteration))
+            tlogger.record_tabular('SlotUtilization', (worker.slot_seconds - slot_seconds_so_far)/max(1, worker.num_slots)/(time.time()-tstart_iteration))
+            tlogger.record_tabular('PrefetchedOffspring', len(prefetched))
             tlogger.record_tabular('TimestepsComputed', state.num_frames)
             tlogger.record_tabular('TimestepsSoFar', state.timesteps_so_far)
+            tlogger.record_tabular('LineageCachedThetas', len(lineage))
+            tlogger.record_tabular('LineageCacheMB', lineage.num_bytes / 2 ** 20)
+            tlogger.record_tabular('LineageHitRate', lineage.hit_rate)
+            tlogger.record_tabular('LineageMutationsComputed', lineage.mutations_computed)
             tlogger.record_tabular('TimeElapsedThisIter', time_elapsed_this_iter)
             tlogger.record_tabular('TimeElapsedThisIterTotal', time.time()-tstart_iteration)
             tlogger.record_tabular('TimeElapsed', state.time_elapsed)
@@ -240,10 +350,9 @@ def main(**exp):
             fps = state.timesteps_so_far/(time.time() - tstart)
             tlogger.info('Timesteps Per Second: {:.0f}. Elapsed: {:.2f}h ETA {:.2f}h'.format(fps, (time.time()-all_tstart)/3600, (exp['timesteps'] - state.timesteps_so_far)/fps/3600))
 
-            if state.adaptive_tslimit:
-                if np.mean([a.training_steps >= state.tslimit for a in results]) > state.incr_tslimit_threshold:
-                    state.tslimit = min(state.tslimit * state.tslimit_incr_ratio, state.tslimit_max)
-                    tlogger.info('Increased threshold to {}'.format(state.tslimit))
+            if next_tslimit != state.tslimit:
+                state.tslimit = next_tslimit
+                tlogger.info('Increased threshold to {}'.format(state.tslimit))
 
             os.makedirs(log_dir, exist_ok=True)
             save_file = os.path.join(log_dir, 'snapshot.pkl')
@@ -254,20 +363,28 @@ def main(**exp):
 
             if state.timesteps_so_far >= exp['timesteps']:
                 tlogger.info('Training terminated after {} timesteps'.format(state.timesteps_so_far))
+                if pipeline is not None:
+                    pipeline.stop()
                 break
             results.clear()
 
             if exp['selection_threshold'] > 0:
                 tlogger.info("Caching parents")
-                new_parents = []
+                # The top selection_threshold - 1 and, last, either the next one or the elite (see OffspringPipeline)
+                if not pipelining:
+                    next_parents = [(worker.model.compute_weights_from_seeds(noise, o.seeds, cache=lineage), o.seeds) for o in state.population[:exp['selection_threshold']-1]]
                 if state.elite in state.population[:exp['selection_threshold']]:
-                    new_parents.extend([(worker.model.compute_weights_from_seeds(noise, o.seeds, cache=cached_parents), o.seeds) for o in state.population[:exp['selection_threshold']]])
+                    last_parent = state.population[exp['selection_threshold']-1]
                 else:
-                    new_parents.append((worker.model.compute_weights_from_seeds(noise, state.elite.seeds, cache=cached_parents), state.elite.seeds))
-                    new_parents.extend([(worker.model.compute_weights_from_seeds(noise, o.seeds, cache=cached_parents), o.seeds) for o in state.population[:exp['selection_threshold']-1]])
+                    last_parent = state.elite
+                new_parents = next_parents + [(worker.model.compute_weights_from_seeds(noise, last_parent.seeds, cache=lineage), last_parent.seeds)]
 
                 cached_parents.clear()
                 cached_parents.extend(new_parents)
+                if pipelining:
+                    worker.store_parents(new_parents[-1:], first_slot=len(new_parents) - 1)
+                else:
+                    worker.store_parents(new_parents)
                 tlogger.info("Done caching parents")
     return float(state.curr_solution_test), {'val': float(state.curr_solution_val)}
 
@@ -0,0 +1,82 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+"""
+Env process of gym_tensorflow.SubprocGymEnv, started as its own script so that it only imports numpy and gym: a
+multiprocessing child would import the trainer's main module (and with it TensorFlow) again.
+
+Observations, rewards and done flags are written into a buffer file shared with the parent (see open_buffers), a
+socket inherited from the parent carries the commands, env indices and actions of a step.
+"""
+import argparse
+import mmap
+from multiprocessing.connection import Connection
+import numpy as np
+
+
+def buffer_size(batch_size, obs_shape):
+    return batch_size * (4 * int(np.prod(obs_shape)) + 4 + 1)
+
+
+def open_buffers(fileno, batch_size, obs_shape):
+    """
+    (mmap, obs, rew, done) over the buffer file fileno: batch_size float32 observations, then as many float32
+    rewards and bool done flags
+    """
+    obs_size = batch_size * int(np.prod(obs_shape))
+    mm = mmap.mmap(fileno, buffer_size(batch_size, obs_shape))
+    obs = np.frombuffer(mm, dtype=np.float32, count=obs_size).reshape((batch_size, ) + tuple(obs_shape))
+    rew = np.frombuffer(mm, dtype=np.float32, count=batch_size, offset=4 * obs_size)
+    done = np.frombuffer(mm, dtype=np.bool_, count=batch_size, offset=4 * obs_size + 4 * batch_size)
+    return mm, obs, rew, done
+
+
+def run(remote, name, env_ids, obs, rew, done):
+    import gym
+    envs = {i: gym.make(name) for i in env_ids}
+    try:
+        while True:
+            cmd, indices, actions = remote.recv()
+            if cmd == 'step':
+                for i, a in zip(indices, actions):
+                    obs[i], rew[i], done[i], _ = envs[i].step(a)
+            elif cmd == 'reset':
+                for i in indices:
+                    obs[i] = envs[i].reset()
+            elif cmd == 'close':
+                break
+            remote.send(None)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        for env in envs.values():
+            env.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', required=True)
+    parser.add_argument('--remote_fd', type=int, required=True)
+    parser.add_argument('--buffers_fd', type=int, required=True)
+    parser.add_argument('--batch_size', type=int, required=True)
+    parser.add_argument('--obs_shape', type=int, nargs='*', default=[])
+    parser.add_argument('--env_ids', type=int, nargs='+', required=True)
+    args = parser.parse_args()
+    _, obs, rew, done = open_buffers(args.buffers_fd, args.batch_size, tuple(args.obs_shape))
+    run(Connection(args.remote_fd), args.name, args.env_ids, obs, rew, done)
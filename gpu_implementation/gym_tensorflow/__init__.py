@@ -1,15 +1,22 @@
 import tensorflow as tf
 import numpy as np
-from .tf_env import GymEnv
+from .tf_env import GymEnv, gym_tensorflow_module
+from .subproc_env import SubprocGymEnv
 from.import atari, maze
 from .wrappers import StackFramesWrapper
 
 def make(game, batch_size, *args, **kwargs):
+    if game == 'maze_numpy' or (game == 'maze' and gym_tensorflow_module is None):
+        return maze.NumpyMazeEnv(batch_size)
     if game == 'maze':
         return maze.MazeEnv(batch_size)
     if game in atari.games:
         return StackFramesWrapper(atari.AtariEnv(game, batch_size, *args, **kwargs))
     if game.startswith('gym.'):
+        # num_processes=0 (or None) leaves the number of processes to SubprocGymEnv's default
+        num_processes = kwargs.pop('num_processes', 1)
+        if num_processes != 1:
+            return SubprocGymEnv(game[4:], batch_size, *args, num_processes=num_processes or None, **kwargs)
         return GymEnv(game[4:], batch_size, *args, **kwargs)
     raise NotImplementedError(game)
 
@@ -33,5 +40,6 @@ def get_ref_batch(make_env_f, sess, batch_size):
         ref_batch.append(obs)
         if done.any():
             sess.run(reset_op)
+    env.close()
 
     return np.concatenate(ref_batch)
@@ -0,0 +1,204 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+"""
+NumPy implementation of the hard maze of maze.h, stepping all the instances of a batch at once, so that it runs
+(and can be profiled) without the compiled gym_tensorflow ops. NumpyMazeEnv (tf_maze.py) is the drop-in PythonEnv
+for MazeEnv, HardMazeGymEnv a single-instance gym env registered as HardMaze-v0 for the es_distributed rollouts
+(add this module to env_modules in the experiment JSON). Only NumPy (and gym for HardMazeGymEnv) is needed here.
+"""
+import os
+import numpy as np
+try:
+    import gym
+except ImportError:
+    gym = None
+
+# maze.h converts degrees with this value of pi
+_DEG = np.float32(3.1415926 / 180.0)
+RANGEFINDER_ANGLES = np.array([-90, -45, 0, 45, 90, -180], dtype=np.float32)
+RADAR_ANGLES = np.array([[315, 405], [45, 135], [135, 225], [225, 315]], dtype=np.float32)
+RANGEFINDER_RANGE = 100.0
+RADIUS = 8.0
+OBSERVATION_SIZE = 1 + len(RANGEFINDER_ANGLES) + len(RADAR_ANGLES)
+
+
+def _default_maze_file():
+    return os.path.join(os.path.dirname(__file__), 'hard_maze.txt')
+
+
+class HardMaze(object):
+    """
+    batch_size navigators in the maze of filename (maze.h's format), as arrays indexed by instance
+    """
+    def __init__(self, batch_size, filename=None):
+        with open(filename or _default_maze_file(), 'r') as f:
+            values = f.read().split()
+        self.disable = bool(int(values[0]))
+        self.max_steps = int(values[1])
+        num_lines = int(values[2])
+        self.start = np.array(values[3:5], dtype=np.float32)
+        self.end = np.array(values[6:8], dtype=np.float32)
+        lines = np.array(values[10:10 + 4 * num_lines], dtype=np.float32).reshape(num_lines, 4)
+        self.line_a, self.line_b = lines[:, :2], lines[:, 2:]
+        self.line_ab = self.line_b - self.line_a
+        self.line_len2 = (self.line_ab ** 2).sum(axis=1)
+
+        self.batch_size = batch_size
+        self.location = np.tile(self.start, (batch_size, 1))
+        self.heading = np.zeros(batch_size, dtype=np.float32)
+        self.speed = np.zeros(batch_size, dtype=np.float32)
+        self.ang_vel = np.zeros(batch_size, dtype=np.float32)
+        self.collide = np.zeros(batch_size, dtype=np.bool_)
+        self.steps = np.zeros(batch_size, dtype=np.int32)
+
+    def reset(self, indices):
+        self.location[indices] = self.start
+        self.heading[indices] = 0
+        self.speed[indices] = 0
+        self.ang_vel[indices] = 0
+        self.collide[indices] = False
+        self.steps[indices] = 0
+
+    def _collides(self, loc):
+        # Distance from every location to every wall segment (maze.h Line::distance)
+        ap = loc[:, None, :] - self.line_a[None]
+        u = (ap * self.line_ab[None]).sum(axis=2) / self.line_len2[None]
+        closest = self.line_a[None] + np.clip(u, 0, 1)[:, :, None] * self.line_ab[None]
+        dist = np.sqrt(((loc[:, None, :] - closest) ** 2).sum(axis=2))
+        return (dist < RADIUS).any(axis=1)
+
+    def step(self, indices, action):
+        """
+        Applies the (n, 2) actions to the instances in indices, returns their rewards and done flags
+        """
+        action = np.clip(np.asarray(action, dtype=np.float32) + 0.5, 0, 1)
+        d_ang = np.clip((action[:, 0] - 0.5) * 6 - self.ang_vel[indices], -0.2, 0.2)
+        d_speed = np.clip((action[:, 1] - 0.5) * 6 - self.speed[indices], -0.2, 0.2)
+        ang_vel = np.clip(self.ang_vel[indices] + d_ang, -3, 3)
+        speed = np.clip(self.speed[indices] + d_speed, -3, 3)
+        heading = self.heading[indices]
+
+        velocity = np.stack([np.cos(heading * _DEG), np.sin(heading * _DEG)], axis=1) * speed[:, None]
+        new_heading = heading + ang_vel
+        new_heading = np.where(new_heading > 360, new_heading - 360, new_heading)
+        new_heading = np.where(new_heading < 0, new_heading + 360, new_heading)
+        new_loc = self.location[indices] + velocity
+
+        blocked = self.collide[indices] | self._collides(new_loc)
+        self.location[indices] = np.where(blocked[:, None], self.location[indices], new_loc)
+        if self.disable:
+            self.collide[indices] |= blocked
+        self.heading[indices] = new_heading
+        self.speed[indices] = speed
+        self.ang_vel[indices] = ang_vel
+        self.steps[indices] += 1
+
+        done = self.steps[indices] >= self.max_steps
+        reward = np.where(done, -self.distance_to_target(indices), 0).astype(np.float32)
+        return reward, done
+
+    def distance_to_target(self, indices):
+        return np.sqrt(((self.location[indices] - self.end) ** 2).sum(axis=1))
+
+    def _rangefinders(self, loc, heading):
+        angles = (RANGEFINDER_ANGLES[None] + heading[:, None]) * _DEG
+        # Rays C->D against walls A->B (maze.h Line::intersection, with A, B the wall)
+        cd = np.stack([np.cos(angles), np.sin(angles)], axis=2) * RANGEFINDER_RANGE  # (n, sensors, 2)
+        ac = self.line_a[None, None] - loc[:, None, None]  # (n, 1, lines, 2)
+        ab = self.line_ab[None, None]
+        cd = cd[:, :, None]
+        bot = ab[..., 0] * cd[..., 1] - ab[..., 1] * cd[..., 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = (ac[..., 1] * cd[..., 0] - ac[..., 0] * cd[..., 1]) / bot
+            s = (ac[..., 1] * ab[..., 0] - ac[..., 0] * ab[..., 1]) / bot
+        found = (bot != 0) & (r > 0) & (r < 1) & (s > 0) & (s < 1)
+        hit = ac + r[..., None] * ab
+        dist = np.where(found, np.sqrt((hit ** 2).sum(axis=3)), RANGEFINDER_RANGE)
+        return np.minimum(dist.min(axis=2), RANGEFINDER_RANGE)
+
+    def _radar(self, loc, heading):
+        rad = -heading * _DEG
+        t = self.end[None] - loc
+        x = np.cos(rad) * t[:, 0] - np.sin(rad) * t[:, 1]
+        y = np.sin(rad) * t[:, 0] + np.cos(rad) * t[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angle = np.arctan(y / x) / _DEG
+        angle = np.where(x > 0, angle, angle + 180)
+        angle = np.where(x == 0, np.where(y > 0, 90, 270), angle)[:, None]
+        lo, hi = RADAR_ANGLES[None, :, 0], RADAR_ANGLES[None, :, 1]
+        return (((angle >= lo) & (angle < hi)) | ((angle + 360 >= lo) & (angle + 360 < hi))).astype(np.float32)
+
+    def observation(self, indices):
+        """
+        (n, 11) bias, rangefinders scaled by their range and goal radar (maze.h generate_neural_inputs)
+        """
+        loc, heading = self.location[indices], self.heading[indices]
+        obs = np.empty((len(loc), OBSERVATION_SIZE), dtype=np.float32)
+        obs[:, 0] = 1
+        obs[:, 1:1 + len(RANGEFINDER_ANGLES)] = self._rangefinders(loc, heading) / RANGEFINDER_RANGE
+        obs[:, 1 + len(RANGEFINDER_ANGLES):] = self._radar(loc, heading)
+        return obs
+
+    def final_state(self, indices):
+        return self.location[indices].copy()
+
+
+class HardMazeGymEnv(gym.Env if gym is not None else object):
+    """
+    One HardMaze instance behind the gym interface, actions are clipped to [-0.5, 0.5] like the C++ op does
+    """
+    metadata = {'render.modes': []}
+
+    def __init__(self, filename=None):
+        self.maze = HardMaze(1, filename)
+        if gym is not None:
+            self.observation_space = gym.spaces.Box(low=0, high=1, shape=(OBSERVATION_SIZE, ))
+            self.action_space = gym.spaces.Box(low=-0.5, high=0.5, shape=(2, ))
+        self._index = np.zeros(1, dtype=np.int32)
+
+    def seed(self, seed=None):
+        # The dynamics are deterministic
+        return [seed]
+
+    def reset(self):
+        self.maze.reset(self._index)
+        return self.maze.observation(self._index)[0]
+
+    def step(self, action):
+        reward, done = self.maze.step(self._index, np.reshape(action, (1, 2)))
+        return self.maze.observation(self._index)[0], float(reward[0]), bool(done[0]), {}
+
+    @property
+    def position(self):
+        return self.maze.final_state(self._index)[0]
+
+    def render(self, mode='human', close=False):
+        pass
+
+    def close(self):
+        pass
+
+
+if gym is not None:
+    try:
+        gym.envs.registration.register(
+            id='HardMaze-v0', entry_point='{}:HardMazeGymEnv'.format(__name__), max_episode_steps=400,
+            tags={'wrapper_config.TimeLimit.max_episode_steps': 400})
+    except gym.error.Error:
+        pass  # Already registered under another module name
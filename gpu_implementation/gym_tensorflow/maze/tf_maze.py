@@ -17,7 +17,8 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 import tensorflow as tf
-from gym_tensorflow.tf_env import TensorFlowEnv, gym_tensorflow_module
+from gym_tensorflow.tf_env import TensorFlowEnv, PythonEnv, gym_tensorflow_module
+from .np_maze import HardMaze, OBSERVATION_SIZE
 
 
 class MazeEnv(TensorFlowEnv):
@@ -66,4 +67,44 @@ class MazeEnv(TensorFlowEnv):
             return gym_tensorflow_module.maze_final_state(self.instances, indices)
 
     def close(self):
-        pass
\ No newline at end of file
+        pass
+
+class NumpyMazeEnv(PythonEnv):
+    """
+    Same environment as MazeEnv, stepped by HardMaze in NumPy instead of the compiled op
+    """
+    def __init__(self, batch_size, filename=None):
+        self.batch_size = batch_size
+        self.maze = HardMaze(batch_size, filename)
+
+    @property
+    def env_default_timestep_cutoff(self):
+        return self.maze.max_steps
+
+    @property
+    def action_space(self):
+        return 2
+
+    @property
+    def observation_space(self):
+        return (OBSERVATION_SIZE, )
+
+    @property
+    def discrete_action(self):
+        return False
+
+    def _step(self, action, indices):
+        return self.maze.step(indices, action)
+
+    def _reset(self, indices):
+        self.maze.reset(indices)
+        return 0
+
+    def _obs(self, indices):
+        return self.maze.observation(indices)
+
+    def final_state(self, indices, name=None):
+        with tf.variable_scope(name, default_name='PythonFinalState'):
+            position = tf.py_func(self.maze.final_state, [indices], tf.float32)
+            position.set_shape((None, 2))
+            return position
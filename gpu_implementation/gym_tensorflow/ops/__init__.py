@@ -3,7 +3,9 @@ from ..tf_env import gym_tensorflow_module
 
 try:
     indexed_matmul = gym_tensorflow_module.indexed_batch_mat_mul
+    indexed_matmul_available = True
 except:
+    indexed_matmul_available = False
     import time
     print('Index MatMul implementation not available. This significantly affects performance')
     time.sleep(5)
@@ -0,0 +1,113 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from multiprocessing.connection import Connection
+import numpy as np
+
+from .tf_env import GymEnv
+
+# gym_subproc_worker sits next to this package, it is run as a script and doesn't import gym_tensorflow
+_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gym_subproc_worker.py')
+
+
+# Processes per SubprocGymEnv when num_processes isn't given, see set_default_num_processes
+_default_num_processes = None
+
+
+def set_default_num_processes(num_processes):
+    """
+    Sets the number of processes of the SubprocGymEnvs created without num_processes from now on (None for one per
+    core). ConcurrentWorkers sets it so that all its workers' envs together use one process per core.
+    """
+    global _default_num_processes
+    _default_num_processes = num_processes
+
+
+class SubprocGymEnv(GymEnv):
+    """
+    GymEnv whose envs are spread over num_processes subprocesses (by default the number set with
+    set_default_num_processes or one per core, at most one per env).
+    The subprocesses run gym_subproc_worker.py, a script importing only numpy and gym, and write observations,
+    rewards and done flags into a buffer file mapped by all of them, indexed by env. Socket pairs inherited by the
+    subprocesses only carry the indices and actions of a step. All processes step their envs at the same time.
+    """
+    def __init__(self, name, batch_size, num_processes=None):
+        import gym
+        from gym_subproc_worker import buffer_size, open_buffers
+        self.spec_env = gym.make(name)
+        self.is_discrete_action = isinstance(self.spec_env.action_space, gym.spaces.Discrete)
+        self.batch_size = batch_size
+
+        # An unlinked file, in memory where /dev/shm exists, inherited by the subprocesses
+        self._buffer_file = tempfile.TemporaryFile(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self._buffer_file.truncate(buffer_size(batch_size, self.observation_space))
+        self._buffers, self.obs, self.rew, self.done = open_buffers(
+            self._buffer_file.fileno(), batch_size, self.observation_space)
+
+        num_processes = min(num_processes or _default_num_processes or os.cpu_count(), batch_size)
+        self.process_of = np.zeros(batch_size, dtype=np.int32)
+        self.remotes, self.processes = [], []
+        for p, env_ids in enumerate(np.array_split(np.arange(batch_size), num_processes)):
+            self.process_of[env_ids] = p
+            remote, child_remote = socket.socketpair()
+            args = [sys.executable, _WORKER_SCRIPT, '--name', name, '--remote_fd', str(child_remote.fileno()),
+                    '--buffers_fd', str(self._buffer_file.fileno()), '--batch_size', str(batch_size),
+                    '--obs_shape'] + [str(d) for d in self.observation_space] + \
+                   ['--env_ids'] + [str(i) for i in env_ids]
+            self.processes.append(subprocess.Popen(args, pass_fds=(child_remote.fileno(), self._buffer_file.fileno())))
+            child_remote.close()
+            self.remotes.append(Connection(remote.detach()))
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _run(self, cmd, indices, actions=None):
+        processes = self.process_of[indices]
+        with self._lock:
+            busy = np.unique(processes)
+            for p in busy:
+                mine = processes == p
+                self.remotes[p].send((cmd, indices[mine], None if actions is None else actions[mine]))
+            for p in busy:
+                self.remotes[p].recv()
+
+    def _step(self, action, indices):
+        assert self.discrete_action == True
+        self._run('step', indices, action)
+        return self.rew[indices], self.done[indices]
+
+    def _reset(self, indices):
+        self._run('reset', indices)
+        return 0
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for remote in self.remotes:
+            remote.send(('close', None, None))
+        for process in self.processes:
+            process.wait()
+        for remote in self.remotes:
+            remote.close()
+        self.spec_env.close()
@@ -21,7 +21,11 @@ import os
 
 import tensorflow as tf
 
-gym_tensorflow_module = tf.load_op_library(os.path.join(os.path.dirname(__file__), 'gym_tensorflow.so'))
+try:
+    gym_tensorflow_module = tf.load_op_library(os.path.join(os.path.dirname(__file__), 'gym_tensorflow.so'))
+except tf.errors.NotFoundError:
+    print('gym_tensorflow.so not available, only the Python environments can be used')
+    gym_tensorflow_module = None
 
 
 class TensorFlowEnv(object):
@@ -84,18 +88,19 @@ class GymEnv(PythonEnv):
     def __init__(self, name, batch_size):
         import gym
         self.env = [gym.make(name) for _ in range(batch_size)]
-        self.obs = [None] * batch_size
-        self.is_discrete_action = isinstance( self.env[0].action_space , gym.spaces.Discrete ) 
+        self.spec_env = self.env[0]
+        self.is_discrete_action = isinstance( self.spec_env.action_space , gym.spaces.Discrete )
         self.batch_size = batch_size
+        self.obs = np.zeros((batch_size, ) + self.observation_space, dtype=np.float32)
 
     @property
     def action_space(self):
         #return np.prod(self.env[0].action_space.shape, dtype=np.int32)
-        return self.env[0].action_space.n
+        return self.spec_env.action_space.n
 
     @property
     def observation_space(self):
-        return self.env[0].observation_space.shape
+        return self.spec_env.observation_space.shape
 
     @property
     def discrete_action(self):
@@ -106,18 +111,17 @@ class GymEnv(PythonEnv):
         return 1000
 
     def _step(self, action, indices):
-        assert self.discrete_action == True 
-        results = map(lambda i: self.env[indices[i]].step(action[i]), range(len(indices)))
-        obs, reward, done, _ = zip(*results)
+        assert self.discrete_action == True
+        reward = np.zeros(len(indices), dtype=np.float32)
+        done = np.zeros(len(indices), dtype=np.bool)
         for i in range(len(indices)):
-            self.obs[indices[i]] = obs[i].astype(np.float32)
-
-        return np.array(reward, dtype=np.float32), np.array(done, dtype=np.bool)
+            self.obs[indices[i]], reward[i], done[i], _ = self.env[indices[i]].step(action[i])
+        return reward, done
 
     def _reset(self, indices):
         for i in indices:
-            self.obs[i] = self.env[i].reset().astype(np.float32)
+            self.obs[i] = self.env[i].reset()
         return 0
 
     def _obs(self, indices):
-        return np.array([self.obs[i] for i in indices]).astype(np.float32)
+        return self.obs[indices]
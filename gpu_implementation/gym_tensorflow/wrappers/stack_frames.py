@@ -5,10 +5,18 @@ import numpy as np
 from gym_tensorflow.tf_env import TensorFlowEnv
 
 class StackFramesWrapper(TensorFlowEnv):
+    '''Stacks the last num_stacked_frames observations along the channels (oldest first).
+
+    Frames are kept in a ring buffer per slot, a step only writes the newest frame at the slot's cursor and the
+    stack is put back in order when it is read.
+    '''
     def __init__(self, env, num_stacked_frames=4):
         self.env = env
         self.num_stacked_frames = num_stacked_frames
-        self.obs_variable = tf.Variable(tf.zeros(shape=self.observation_space, dtype=tf.float32), trainable=False)
+        frame_shape = self.env.observation_space
+        self.frames = tf.Variable(tf.zeros(shape=frame_shape[:1] + (num_stacked_frames, ) + frame_shape[1:], dtype=tf.float32), trainable=False)
+        # Position of the newest frame of every slot in frames
+        self.cursor = tf.Variable(tf.zeros(shape=frame_shape[:1], dtype=tf.int32), trainable=False)
 
     @property
     def batch_size(self):
@@ -32,15 +40,17 @@ class StackFramesWrapper(TensorFlowEnv):
 
     def stack_observation(self, indices, reset=False):
         obs = self.env.observation(indices)
+        indices = tf.convert_to_tensor(indices, dtype=tf.int32)
 
         if reset:
-            obs_batch = tf.zeros((tf.shape(indices)[0],) +self.env.observation_space[1:-1] + (self.env.observation_space[-1] * self.num_stacked_frames-1, ), dtype=tf.float32)
-            obs_batch = tf.concat([obs_batch, obs], axis=-1)
-        else:
-            obs_batch = tf.gather(self.obs_variable, indices)
-            obs_batch = tf.slice(obs_batch, (0, 0, 0, 1), (-1, -1, -1, -1))
-            obs_batch = tf.concat([obs_batch, obs], axis=-1)
-        return tf.scatter_update(self.obs_variable, indices, obs_batch)
+            # Older frames are zeros, the newest one goes to position 0
+            obs_batch = tf.zeros((tf.shape(indices)[0], self.num_stacked_frames - 1) + self.env.observation_space[1:], dtype=tf.float32)
+            obs_batch = tf.concat([tf.expand_dims(obs, 1), obs_batch], axis=1)
+            return tf.group(tf.scatter_update(self.frames, indices, obs_batch),
+                            tf.scatter_update(self.cursor, indices, tf.zeros_like(indices)))
+        cursor = (tf.gather(self.cursor, indices) + 1) % self.num_stacked_frames
+        return tf.group(tf.scatter_nd_update(self.frames, tf.stack([indices, cursor], axis=1), obs),
+                        tf.scatter_update(self.cursor, indices, cursor))
 
     def step(self, action, indices=None, name=None):
         if indices is None:
@@ -57,14 +67,22 @@ class StackFramesWrapper(TensorFlowEnv):
             indices = np.arange(self.batch_size)
         reset_op = self.env.reset(indices=indices, max_frames=max_frames, name=name)
         with tf.control_dependencies([reset_op]):
-            return self.stack_observation(indices, reset=True).op
+            return self.stack_observation(indices, reset=True)
 
     def observation(self, indices=None, name=None):
         '''Returns current observation after preprocessing (skip, grayscale, warp, stack).\nMust be called ONCE each time step is called if num_stacked_frames > 1
         '''
         if indices is None:
             indices = np.arange(self.batch_size)
-        return tf.gather(self.obs_variable, indices)
+        indices = tf.convert_to_tensor(indices, dtype=tf.int32)
+        # Frame positions from the oldest to the newest
+        positions = (tf.expand_dims(tf.gather(self.cursor, indices), 1) + 1 + tf.range(self.num_stacked_frames)) % self.num_stacked_frames
+        slots = tf.tile(tf.expand_dims(indices, 1), [1, self.num_stacked_frames])
+        obs_batch = tf.gather_nd(self.frames, tf.stack([slots, positions], axis=2))
+        # (n, k, H, W, C) -> (n, H, W, k * C)
+        rank = len(self.observation_space) + 1
+        obs_batch = tf.transpose(obs_batch, [0] + list(range(2, rank - 1)) + [1, rank - 1])
+        return tf.reshape(obs_batch, (-1, ) + self.observation_space[1:])
 
     def final_state(self, indices, name=None):
         return self.env.final_state(indices, name)
@@ -16,19 +16,25 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
+import os
 import time
 import threading
 import tensorflow as tf
 import numpy as np
-from .tf_util import get_available_gpus
+from .tf_util import get_available_gpus, cpu_session_config
 import tabular_logger as tlogger
 from queue import Queue
 from multiprocessing.pool import ApplyResult
 from .distributed_helpers import AsyncWorker, WorkerHub, AsyncTaskHub
+from .models.base import DeviceNoise, Mutation
+from .remote import RemoteWorkerServer
 
 class RLEvalutionWorker(AsyncWorker):
-    def __init__(self, make_env_f, model, batch_size, device='/cpu:0', ref_batch=None):
+    def __init__(self, make_env_f, model, batch_size, device='/cpu:0', ref_batch=None, unroll_steps=1, run_options=None, affinity=None, device_noise=None):
         self.batch_size = batch_size
+        self.unroll_steps = unroll_steps
+        self.run_options = run_options
+        self.affinity = affinity
         self.make_env_f = make_env_f
         self.sample_callback = [None] * self.batch_size
 
@@ -41,10 +47,12 @@ class RLEvalutionWorker(AsyncWorker):
         self._input_handler._state = 0
         self._input_handler.start()
 
-        self.make_net(model, device=device, ref_batch=ref_batch)
+        self.make_net(model, device=device, ref_batch=ref_batch, device_noise=device_noise)
         self.num_frames = 0
+        # Sum over env steps of the step time times the number of occupied slots, for utilization reporting
+        self.slot_seconds = 0.
 
-    def make_net(self, model_constructor, device, ref_batch=None):
+    def make_net(self, model_constructor, device, ref_batch=None, device_noise=None):
         self.model = model_constructor()
 
         with tf.variable_scope(None, default_name='model'):
@@ -60,6 +68,8 @@ class RLEvalutionWorker(AsyncWorker):
                     obs = tf.expand_dims(self.obs_op, axis=1)
                     self.action_op = self.model.make_net(obs, self.env.action_space, indices=self.placeholder_indices, batch_size=self.batch_size, ref_batch=ref_batch)
                 self.model.initialize()
+                if device_noise is not None:
+                    self.model.make_mutation_ops(device_noise)
 
                 if self.env.discrete_action:
                     self.action_op = tf.argmax(self.action_op[:tf.shape(self.placeholder_indices)[0]], axis=-1, output_type=tf.int32)
@@ -69,6 +79,42 @@ class RLEvalutionWorker(AsyncWorker):
                 self.steps_counter = tf.Variable(np.zeros((), dtype=np.int64))
                 self.incr_counter = tf.assign_add(self.steps_counter, tf.cast(tf.reduce_prod(tf.shape(self.placeholder_indices)), dtype=tf.int64))
 
+                if self.unroll_steps > 1:
+                    self.unrolled_ops = self.make_unrolled_step(device)
+
+    def make_unrolled_step(self, device):
+        """
+        Advances the slots in placeholder_indices by up to unroll_steps env steps in one session call, each slot
+        stopping at the end of its episode. Returns the accumulated rewards, the number of steps taken and the done
+        flags of these slots, and increments steps_counter.
+        """
+        indices = self.placeholder_indices
+        num_slots = tf.shape(indices)[0]
+
+        def cond(t, active, rews, lens, dones):
+            return tf.logical_and(t < self.unroll_steps, tf.reduce_any(active))
+
+        def body(t, active, rews, lens, dones):
+            active_indices = tf.boolean_mask(indices, active)
+            positions = tf.where(active)
+            with tf.device(device):
+                obs = tf.expand_dims(self.env.observation(indices=active_indices), axis=1)
+                action = self.model.reuse_net(obs, active_indices)
+            if self.env.discrete_action:
+                action = tf.argmax(action[:tf.shape(active_indices)[0]], axis=-1, output_type=tf.int32)
+            with tf.device(device):
+                rew, done = self.env.step(action, indices=active_indices)
+            rews += tf.scatter_nd(positions, rew, [num_slots])
+            lens += tf.scatter_nd(positions, tf.ones_like(active_indices), [num_slots])
+            done = tf.scatter_nd(positions, tf.cast(done, tf.int32), [num_slots]) > 0
+            return t + 1, tf.logical_and(active, tf.logical_not(done)), rews, lens, tf.logical_or(dones, done)
+
+        _, _, rews, lens, dones = tf.while_loop(cond, body, [
+            tf.constant(0), tf.ones([num_slots], dtype=tf.bool), tf.zeros([num_slots], dtype=tf.float32),
+            tf.zeros([num_slots], dtype=tf.int32), tf.zeros([num_slots], dtype=tf.bool)], back_prop=False)
+        incr_counter = tf.assign_add(self.steps_counter, tf.cast(tf.reduce_sum(lens), dtype=tf.int64))
+        return rews, lens, dones, incr_counter
+
     def _loop(self):
         info = [None] * self.batch_size
         running = np.zeros((self.batch_size,), dtype=np.bool)
@@ -76,24 +122,39 @@ class RLEvalutionWorker(AsyncWorker):
         cumlen = np.zeros((self.batch_size, ), dtype=np.int32)
 
         tf_indices = tf.placeholder(dtype=tf.int32, shape=(None,), name='input_indices')
+        if self.affinity is not None:
+            # On Linux this pins the calling thread only
+            os.sched_setaffinity(0, self.affinity)
 
         while True:
             # nothing loaded, block
+            tasks = []
             if not any(running):
-                idx = self.queue.get()
-                if idx is None:
+                task = self.queue.get()
+                if task is None:
                     break
-                running[idx] = True
+                tasks.append(task)
             while not self.queue.empty():
-                idx = self.queue.get()
-                if idx is None:
+                task = self.queue.get()
+                if task is None:
                     break
-                running[idx] = True
+                tasks.append(task)
+            if tasks:
+                self._start(tasks)
+                for idx, _ in tasks:
+                    running[idx] = True
 
             indices = np.nonzero(running)[0]
-            rews, is_done, _ = self.sess.run([self.rew_op, self.done_op, self.incr_counter], {self.placeholder_indices: indices})
+            tstart = time.time()
+            if self.unroll_steps > 1:
+                rews, lens, is_done, _ = self.sess.run(self.unrolled_ops, {self.placeholder_indices: indices}, options=self.run_options)
+                self.slot_seconds += lens.sum() / max(1, lens.max()) * (time.time() - tstart)
+            else:
+                rews, is_done, _ = self.sess.run([self.rew_op, self.done_op, self.incr_counter], {self.placeholder_indices: indices}, options=self.run_options)
+                lens = 1
+                self.slot_seconds += len(indices) * (time.time() - tstart)
             cumrews[running] += rews
-            cumlen[running] += 1
+            cumlen[running] += lens
             if any(is_done):
                 for idx in indices[is_done]:
                     self.sample_callback[idx](self, idx, (self.model.seeds[idx], cumrews[idx], cumlen[idx]))
@@ -115,33 +176,94 @@ class RLEvalutionWorker(AsyncWorker):
     def concurrent_tasks(self):
         return range(self.batch_size)
 
+    def _start(self, tasks):
+        """
+        Loads the (task_id, (theta, extras, max_frames)) tasks queued since the last step and resets their envs.
+        Offspring given as a Mutation are computed in-graph, all in one session call.
+        """
+        mutations = []
+        for task_id, (theta, extras, _) in tasks:
+            if isinstance(theta, Mutation):
+                mutations.append((task_id, theta, extras))
+            else:
+                self.model.load(self.sess, task_id, theta, extras)
+        if mutations:
+            self.model.load_mutations(self.sess, *zip(*mutations))
+        max_frames = [self.env.env_default_timestep_cutoff if m is None else m for _, (_, _, m) in tasks]
+        self.sess.run(self.reset_op, {self.placeholder_indices: [task_id for task_id, _ in tasks], self.placeholder_max_frames: max_frames}, options=self.run_options)
+
     def run_async(self, task_id, task, callback):
-        theta, extras, max_frames=task
-        self.model.load(self.sess, task_id, theta, extras)
-        if max_frames is None:
-            max_frames = self.env.env_default_timestep_cutoff
-        self.sess.run(self.reset_op, {self.placeholder_indices:[task_id], self.placeholder_max_frames:[max_frames]})
+        # Loading happens on the loop thread, batched with the other tasks started before its next step
         self.sample_callback[task_id] = callback
-        self.queue.put(task_id)
+        self.queue.put((task_id, task))
 
 
 class ConcurrentWorkers(object):
-    def __init__(self, make_env_f, *args, gpus=get_available_gpus() * 4, input_queue=None, done_queue=None, **kwargs):
+    """
+    Without GPUs, runs cpu_workers workers (by default one per threads_per_worker available cores) on '/cpu:0', each
+    with an inter-op thread pool of threads_per_worker threads in the shared session (see cpu_session_config, the
+    session must be created with session_config, which WorkerSession does) and, with pin_cores, its loop thread
+    pinned to threads_per_worker cores of its own. The batch_size slots are split among the workers unless
+    cpu_batch_size sets the slots per worker.
+
+    With num_parent_slots > 0, every device holds a copy of the noise table and that many parent slots (see
+    DeviceNoise): offspring can then be submitted as the Mutation returned by model.mutate_slot once their parents
+    are stored with store_parents.
+
+    With remote set to the RemoteWorkerServer arguments (address, authkey), remote workers started with
+    remote_worker.py can connect and take tasks from the same queue as the local workers.
+    """
+    def __init__(self, make_env_f, *args, gpus=get_available_gpus() * 4, input_queue=None, done_queue=None,
+                 cpu_workers=None, threads_per_worker=1, pin_cores=False, cpu_batch_size=None, noise=None,
+                 num_parent_slots=0, ref_batch=None, remote=None, **kwargs):
         self.sess = None
+        self.num_in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self.session_config = None
+        worker_kwargs = [{}] * len(gpus)
         if not gpus:
-            gpus = ['/cpu:0']
-        with tf.Session() as sess:
-            import gym_tensorflow
-            ref_batch = gym_tensorflow.get_ref_batch(make_env_f, sess, 128)
-            ref_batch=ref_batch[:, ...]
+            cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+            num_workers = cpu_workers or max(1, len(cores) // threads_per_worker)
+            gpus = ['/cpu:0'] * num_workers
+            self.session_config, run_options = cpu_session_config(num_workers, threads_per_worker)
+            worker_kwargs = [dict(run_options=run_options[i]) for i in range(num_workers)]
+            if pin_cores:
+                for i, w in enumerate(worker_kwargs):
+                    w['affinity'] = {cores[(i * threads_per_worker + j) % len(cores)] for j in range(threads_per_worker)}
+            if cpu_batch_size is not None:
+                kwargs['batch_size'] = cpu_batch_size
+            elif 'batch_size' in kwargs:
+                kwargs['batch_size'] = max(1, -(-kwargs['batch_size'] // num_workers))
+            tlogger.info('No GPU available, running {} CPU workers with {} thread(s) and {} slots each'.format(
+                num_workers, threads_per_worker, kwargs.get('batch_size')))
+        # Subprocess gym envs without an explicit num_processes share the cores among all workers
+        import gym_tensorflow
+        gym_tensorflow.subproc_env.set_default_num_processes(max(1, os.cpu_count() // len(gpus)))
+        self.noise = noise
+        self.device_noise = {}
+        if num_parent_slots > 0:
+            assert noise is not None, 'In-graph mutations need the noise table'
+            self.device_noise = {d: DeviceNoise(d, noise.noise.size, num_parent_slots) for d in set(gpus)}
+            worker_kwargs = [dict(w, device_noise=self.device_noise[gpus[i]]) for i, w in enumerate(worker_kwargs)]
+        if ref_batch is None:
+            with tf.Session(config=self.session_config) as sess:
+                ref_batch = gym_tensorflow.get_ref_batch(make_env_f, sess, 128)
+                ref_batch=ref_batch[:, ...]
+        self.ref_batch = ref_batch
+        self.remote = None
         if input_queue is None and done_queue is None:
-            self.workers = [RLEvalutionWorker(make_env_f, *args, ref_batch=ref_batch, **dict(kwargs, device=gpus[i])) for i in range(len(gpus))]
+            self.workers = [RLEvalutionWorker(make_env_f, *args, ref_batch=ref_batch, **dict(kwargs, device=gpus[i], **worker_kwargs[i])) for i in range(len(gpus))]
             self.model = self.workers[0].model
             self.steps_counter = sum([w.steps_counter for w in self.workers])
             self.async_hub = AsyncTaskHub()
             self.hub = WorkerHub(self.workers, self.async_hub.input_queue, self.async_hub)
+            if remote is not None:
+                # Remote workers need the same reference batch for the virtual batch norm
+                hello = dict(ref_batch=ref_batch if self.model.requires_ref_batch else None)
+                self.remote = RemoteWorkerServer(self.async_hub.input_queue, self.async_hub, hello=hello, **remote)
+                self.steps_counter += tf.py_func(lambda: np.int64(self.remote.num_frames), [], tf.int64, stateful=True)
         else:
-            fake_worker = RLEvalutionWorker( * args, ** dict(kwargs, device=gpus[0]))
+            fake_worker = RLEvalutionWorker( * args, ** dict(kwargs, device=gpus[0], **worker_kwargs[0]))
             self.model = fake_worker.model
             self.workers = []
             self.hub = None
@@ -149,84 +271,105 @@ class ConcurrentWorkers(object):
             self.async_hub = AsyncTaskHub(input_queue, done_queue)
 
 
+    @property
+    def num_slots(self):
+        return sum(len(w.concurrent_tasks) for w in self.workers) + (self.remote.num_slots if self.remote else 0)
+
+    @property
+    def slot_seconds(self):
+        return sum(w.slot_seconds for w in self.workers)
+
     def eval_async(self, theta, extras, max_frames=None, callback=None, error_callback=None):
-        return self.async_hub.run_async((theta, extras, max_frames), callback=callback, error_callback=error_callback)
+        with self._in_flight_lock:
+            self.num_in_flight += 1
+
+        def done(result):
+            with self._in_flight_lock:
+                self.num_in_flight -= 1
+            if callback is not None:
+                callback(result)
+        return self.async_hub.run_async((theta, extras, max_frames), callback=done, error_callback=error_callback)
 
     def eval(self, theta, extras, max_frames=None):
         return self.eval_async(theta, extras, max_frames).get()
 
-    def monitor_eval(self, it, max_frames):
-        logging_interval = 5
+    def eval_batch(self, thetas, extras, max_frames=None, repeats=1):
+        """
+        Evaluates every (theta, extras) pair repeats times, returns a BatchResult whose values are the
+        (extras, reward, length) of the episodes, the repeats of a pair being consecutive
+        """
+        size = len(thetas) * repeats if hasattr(thetas, '__len__') else None
+        return self._eval_batch(zip(thetas, extras), size, max_frames, repeats)
+
+    def _eval_batch(self, it, size, max_frames, repeats):
+        def tasks():
+            for theta, extras in it:
+                for _ in range(repeats):
+                    with self._in_flight_lock:
+                        self.num_in_flight += 1
+                    yield theta, extras, max_frames
+
+        def done(i, result):
+            with self._in_flight_lock:
+                self.num_in_flight -= 1
+        return self.async_hub.run_batch(tasks(), size=size, callback=done)
+
+    def _monitor(self, batch, logging_interval, on_submitted=None):
         last_timesteps = self.sess.run(self.steps_counter)
         tstart_all = time.time()
         tstart = time.time()
+        if on_submitted is not None:
+            batch.submitted.wait()
+            on_submitted()
+
+        while not batch.wait(timeout=max(0., logging_interval - (time.time() - tstart))):
+            cur_timesteps = self.sess.run(self.steps_counter)
+            tlogger.info('Num timesteps:', cur_timesteps, 'per second:', (cur_timesteps-last_timesteps)//(time.time()-tstart), 'num episodes finished: {}/{}'.format(batch.num_done, batch.size if batch.size is not None else '?'))
+            tstart = time.time()
+            last_timesteps = cur_timesteps
+        tlogger.info('Done evaluating {} episodes in {:.2f} seconds'.format(batch.size, time.time()-tstart_all))
+        return batch.get()
 
-        tasks = []
-        for t in it:
-            tasks.append(self.eval_async(*t, max_frames=max_frames))
-            if time.time() - tstart > logging_interval:
-                cur_timesteps = self.sess.run(self.steps_counter)
-                tlogger.info('Num timesteps:', cur_timesteps, 'per second:', (cur_timesteps-last_timesteps)//(time.time()-tstart), 'num episodes finished: {}/{}'.format(sum([1 if t.ready() else 0 for t in tasks]), len(tasks)))
-                tstart = time.time()
-                last_timesteps = cur_timesteps
-
-        while not all([t.ready() for t in tasks]):
-            if time.time() - tstart > logging_interval:
-                cur_timesteps = self.sess.run(self.steps_counter)
-                tlogger.info('Num timesteps:', cur_timesteps, 'per second:', (cur_timesteps-last_timesteps)//(time.time()-tstart), 'num episodes:', sum([1 if t.ready() else 0 for t in tasks]))
-                tstart = time.time()
-                last_timesteps = cur_timesteps
-            time.sleep(0.1)
-        tlogger.info('Done evaluating {} episodes in {:.2f} seconds'.format(len(tasks), time.time()-tstart_all))
-
-        return [t.get() for t in tasks]
-
-    def monitor_eval_repeated(self, it, max_frames, num_episodes):
-        logging_interval = 30
-        last_timesteps = self.sess.run(self.steps_counter)
-        tstart_all = time.time()
-        tstart = time.time()
+    def monitor_eval(self, it, max_frames):
+        size = len(it) if hasattr(it, '__len__') else None
+        return self._monitor(self._eval_batch(it, size, max_frames, 1), logging_interval=5)
 
-        tasks = []
-        for t in it:
-            for _ in range(num_episodes):
-                tasks.append(self.eval_async(*t, max_frames=max_frames))
-                if time.time() - tstart > logging_interval:
-                    cur_timesteps = self.sess.run(self.steps_counter)
-                    tlogger.info('Num timesteps:', cur_timesteps, 'per second:', (cur_timesteps-last_timesteps)//(time.time()-tstart), 'num episodes finished: {}/{}'.format(sum([1 if task.ready() else 0 for task in tasks]), len(tasks)))
-                    tstart = time.time()
-                    last_timesteps = cur_timesteps
-
-        while not all([t.ready() for t in tasks]):
-            if time.time() - tstart > 5:
-                cur_timesteps = self.sess.run(self.steps_counter)
-                tlogger.info('Num timesteps:', cur_timesteps, 'per second:', (cur_timesteps-last_timesteps)//(time.time()-tstart), 'num episodes:', sum([1 if t.ready() else 0 for t in tasks]))
-                tstart = time.time()
-                last_timesteps = cur_timesteps
-            time.sleep(0.1)
-        tlogger.info('Done evaluating {} episodes in {:.2f} seconds'.format(len(tasks), time.time()-tstart_all))
-
-        results = [t.get() for t in tasks]
+    def monitor_eval_repeated(self, it, max_frames, num_episodes, on_submitted=None):
+        size = len(it) * num_episodes if hasattr(it, '__len__') else None
+        results = self._monitor(self._eval_batch(it, size, max_frames, num_episodes), logging_interval=30,
+                                on_submitted=on_submitted)
 
         # Group episodes
-        results = zip(*[iter(results)] * num_episodes)
-
         l = []
-        for evals in results:
-            seeds, rews, length = zip(*evals)
+        for i in range(0, len(results), num_episodes):
+            seeds, rews, length = zip(*results[i:i + num_episodes])
             for s in seeds[1:]:
                 assert s == seeds[0]
             l.append((seeds[0], np.array(rews), np.array(length)))
         return l
 
+    def store_parents(self, parents, first_slot=0):
+        """
+        Stores the (theta, seeds) parents in the parent slots from first_slot on, on every device. No offspring of
+        the parents they replace may still be queued.
+        """
+        for device_noise in self.device_noise.values():
+            device_noise.store_parents(self.sess, parents, first_slot)
+
     def initialize(self, sess):
         for worker in self.workers:
             worker.initialize(sess)
         self.sess = sess
+        for device_noise in self.device_noise.values():
+            device_noise.load_noise(sess, self.noise)
         if self.hub:
             self.hub.initialize()
+        if self.remote:
+            self.remote.initialize()
 
     def close(self):
+        if self.remote:
+            self.remote.close()
         if self.hub:
             self.hub.close()
         for worker in self.workers:
@@ -1,7 +1,7 @@
 
 import threading
 from queue import Queue
-from multiprocessing.pool import ApplyResult
+from multiprocessing.pool import ApplyResult, job_counter
 
 import tabular_logger as tlogger
 
@@ -97,6 +97,59 @@ class WorkerHub(object):
         self.input_queue.put(None)
         self.done_buffer.put(None)
 
+class BatchResult(object):
+    """
+    Results of a batch of tasks submitted with AsyncTaskHub.run_batch, in submission order. The results list is
+    preallocated when the number of tasks is known upfront, and completions are counted under a condition variable,
+    so waiting on a batch costs nothing per task.
+    """
+    def __init__(self, cache, size=None, callback=None):
+        self._job = next(job_counter)
+        self._cache = cache
+        self._callback = callback
+        self._cond = threading.Condition()
+        self.size = size
+        self.values = [None] * (size or 0)
+        self.num_done = 0
+        self.submitted = threading.Event()
+        cache[self._job] = self
+
+    def _add(self):
+        # Called for every task before it is enqueued when the size is not known upfront
+        self.values.append(None)
+        return len(self.values) - 1
+
+    def _finish_submission(self, size):
+        with self._cond:
+            self.size = size
+            if self.ready():
+                self._cache.pop(self._job, None)
+            self._cond.notify_all()
+        self.submitted.set()
+
+    def ready(self):
+        return self.size is not None and self.num_done == self.size
+
+    def wait(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(self.ready, timeout)
+
+    def get(self):
+        self.wait()
+        return self.values
+
+    def _set(self, i, obj):
+        success, value = obj
+        self.values[i] = value
+        if self._callback is not None:
+            self._callback(i, value)
+        with self._cond:
+            self.num_done += 1
+            if self.ready():
+                del self._cache[self._job]
+            self._cond.notify_all()
+
+
 class AsyncTaskHub(object):
     def __init__(self, input_queue=None, results_queue=None):
         if input_queue is None:
@@ -133,7 +186,35 @@ class AsyncTaskHub(object):
         self.input_queue.put((result._job, task))
         return result
 
+    def run_batch(self, tasks, size=None, callback=None):
+        """
+        Submits all tasks at once, returns a BatchResult. Tasks are enqueued from a background thread, so this doesn't
+        block on the bounded input queue, and an iterator of tasks is only consumed as the queue drains. The results
+        are preallocated if size (or len(tasks)) is known.
+        callback(i, result) is called as task i completes.
+        """
+        if size is None and hasattr(tasks, '__len__'):
+            size = len(tasks)
+        batch = BatchResult(self._cache, size, callback)
+
+        def enqueue():
+            count = 0
+            for task in tasks:
+                i = count if size is not None else batch._add()
+                self.input_queue.put(((batch._job, i), task))
+                count += 1
+            batch._finish_submission(count)
+        thread = threading.Thread(target=enqueue)
+        thread.daemon = True
+        thread.start()
+        return batch
+
     def put(self, result):
         job, result=result
-        self._cache[job]._set(0, (True, result))
+        if isinstance(job, tuple):
+            # Task i of a batch
+            job, i = job
+            self._cache[job]._set(i, (True, result))
+        else:
+            self._cache[job]._set(0, (True, result))
 
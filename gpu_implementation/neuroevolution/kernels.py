@@ -0,0 +1,106 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import json
+import os
+import tensorflow as tf
+import tabular_logger as tlogger
+from gym_tensorflow.ops import indexed_matmul, indexed_matmul_available
+
+
+def gather_matmul(a, b, indices):
+    return tf.matmul(a, tf.gather(b, indices))
+
+
+# Ways of multiplying a (slots, m, k) input with the (k, n) weights of the policies in indices out of (batch_size, k, n)
+STRATEGIES = {'gather_matmul': gather_matmul}
+if indexed_matmul_available:
+    STRATEGIES['indexed_matmul'] = indexed_matmul
+DEFAULT_STRATEGY = 'indexed_matmul' if indexed_matmul_available else 'gather_matmul'
+
+
+def layer_key(device_type, batch_size, m, k, n):
+    return '{}:{}:{}x{}x{}'.format(device_type, batch_size, m, k, n)
+
+
+def device_type(tensor):
+    device = tensor.device.upper()
+    if not device:
+        from .tf_util import get_available_gpus
+        return 'gpu' if get_available_gpus() else 'cpu'
+    return 'gpu' if 'GPU' in device else 'cpu'
+
+
+class KernelProfile(object):
+    """
+    Timings of the STRATEGIES per layer (see layer_key) and number of running slots, as written by
+    benchmark_kernels.py. best() picks the strategy with the lowest time summed over the slot counts measured.
+    """
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f)['entries'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'entries': self.entries}, f, indent=4, sort_keys=True)
+
+    def record(self, key, strategy, num_slots, seconds):
+        self.entries.setdefault(key, {}).setdefault(strategy, {})[str(num_slots)] = seconds
+
+    def best(self, key):
+        timings = {s: t for s, t in self.entries.get(key, {}).items() if s in STRATEGIES}
+        if not timings:
+            return DEFAULT_STRATEGY
+        # Only compare over slot counts every strategy was measured for
+        slots = set.intersection(*[set(t) for t in timings.values()])
+        if not slots:
+            return DEFAULT_STRATEGY
+        return min(timings, key=lambda s: sum(timings[s][n] for n in slots))
+
+
+_profile = None
+
+
+def set_profile(path):
+    """
+    Makes models built from now on pick their kernels from the profile at path (None to use DEFAULT_STRATEGY)
+    """
+    global _profile
+    _profile = KernelProfile.load(path) if path is not None else None
+    if _profile is not None:
+        tlogger.info('Using kernel profile {} ({} layers)'.format(path, len(_profile.entries)))
+
+
+def get_profile():
+    global _profile
+    if _profile is None and os.environ.get('NEUROEVOLUTION_KERNEL_PROFILE'):
+        set_profile(os.environ['NEUROEVOLUTION_KERNEL_PROFILE'])
+    return _profile
+
+
+def select(layer):
+    """
+    Strategy for a layer given as (device_type, batch_size, m, k, n)
+    """
+    profile = get_profile()
+    return profile.best(layer_key(*layer)) if profile is not None else DEFAULT_STRATEGY
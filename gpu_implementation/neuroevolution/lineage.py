@@ -0,0 +1,120 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from collections import OrderedDict
+
+
+class _Node(object):
+    __slots__ = ('parent', 'key', 'children', 'theta')
+
+    def __init__(self, parent, key):
+        self.parent = parent
+        self.key = key
+        self.children = {}
+        self.theta = None
+
+
+class LineageStore(object):
+    """
+    Prefix trie over seed tuples (root seed, then one (idx, power) per mutation) holding materialized theta at
+    some of its nodes, under a budget of max_mb megabytes (least recently used thetas are dropped first).
+
+    Weights are computed from the deepest materialized ancestor. Besides the lineages asked for, the nodes where
+    registered lineages branch off are materialized, so that lineages sharing a long prefix (e.g. all parents after
+    a restart) only compute it once.
+    """
+
+    def __init__(self, max_mb=2048):
+        self.max_bytes = max_mb * 2 ** 20
+        self.num_bytes = 0
+        self._root = _Node(None, None)
+        self._materialized = OrderedDict()  # node -> None, in LRU order
+        self.hits = 0
+        self.lookups = 0
+        self.mutations_computed = 0
+
+    def _find(self, seeds, create=False):
+        node = self._root
+        for key in seeds:
+            child = node.children.get(key)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[key] = _Node(node, key)
+            node = child
+        return node
+
+    def add_lineages(self, lineages):
+        """
+        Registers lineages that are about to be computed, so that their common prefixes get materialized
+        """
+        for seeds in lineages:
+            self._find(seeds, create=True)
+
+    def deepest(self, seeds):
+        """
+        (depth, theta) of the deepest materialized prefix of seeds, (0, None) if there is none
+        """
+        self.lookups += 1
+        node, best = self._root, (0, None)
+        for depth, key in enumerate(seeds, 1):
+            node = node.children.get(key)
+            if node is None:
+                break
+            if node.theta is not None:
+                best = (depth, node)
+        depth, node = best
+        if node is None:
+            return 0, None
+        self.hits += 1
+        self._materialized.move_to_end(node)
+        return depth, node.theta
+
+    def offer(self, seeds, theta, final=False):
+        """
+        Called with every theta computed along a lineage, materializes it if it's the lineage itself (final) or a
+        branch point
+        """
+        self.mutations_computed += 1
+        node = self._find(seeds, create=final)
+        if node is None or node.theta is not None or not (final or len(node.children) > 1):
+            return
+        if theta.nbytes > self.max_bytes:
+            return
+        node.theta = theta
+        self._materialized[node] = None
+        self.num_bytes += theta.nbytes
+        while self.num_bytes > self.max_bytes:
+            self._evict(next(iter(self._materialized)))
+
+    def _evict(self, node):
+        del self._materialized[node]
+        self.num_bytes -= node.theta.nbytes
+        node.theta = None
+        # Prune the branch that no longer leads to anything materialized
+        while node.parent is not None and node.theta is None and not node.children:
+            del node.parent.children[node.key]
+            node = node.parent
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(1, self.lookups)
+
+    def __len__(self):
+        return len(self._materialized)
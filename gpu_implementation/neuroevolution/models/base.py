@@ -20,8 +20,53 @@ THE SOFTWARE.
 import tensorflow as tf
 import numpy as np
 import math
+from collections import namedtuple
 import tabular_logger as tlogger
-from gym_tensorflow.ops import indexed_matmul
+from .. import kernels
+from ..lineage import LineageStore
+
+# An offspring given by its parent's slot in a DeviceNoise and its mutation, computed in-graph by BaseModel.load_mutations
+Mutation = namedtuple('Mutation', ['parent_slot', 'idx', 'power'])
+
+
+class DeviceNoise(object):
+    """
+    Copy of the noise table and num_parent_slots parent thetas held as variables on one device, shared by the models
+    placed there, so that offspring are computed in-graph from (parent slot, noise index, power) instead of being
+    fed as full thetas.
+    """
+    def __init__(self, device, noise_size, num_parent_slots):
+        self.device = device
+        self.noise_size = noise_size
+        self.num_parent_slots = num_parent_slots
+        self.num_params = None
+        self.noise_loaded = False
+
+    def build(self, num_params):
+        if self.num_params is not None:
+            assert self.num_params == num_params, 'Models sharing a DeviceNoise must have the same number of parameters'
+            return
+        self.num_params = num_params
+        with tf.device(self.device), tf.variable_scope(None, default_name='device_noise'):
+            self.noise = tf.get_variable('noise', (self.noise_size, ), initializer=tf.zeros_initializer(), trainable=False)
+            self.parents = tf.get_variable('parents', (self.num_parent_slots, num_params), initializer=tf.zeros_initializer(), trainable=False)
+            self.noise_ph = tf.placeholder(tf.float32, [self.noise_size])
+            self.load_noise_op = tf.assign(self.noise, self.noise_ph)
+            self.parent_ph = tf.placeholder(tf.float32, [num_params])
+            self.parent_slot = tf.placeholder(tf.int32, ())
+            self.store_parent_op = tf.scatter_update(self.parents, self.parent_slot, self.parent_ph)
+
+    def load_noise(self, sess, noise):
+        if not self.noise_loaded:
+            assert noise.noise.size == self.noise_size
+            sess.run(self.load_noise_op, {self.noise_ph: noise.noise})
+            self.noise_loaded = True
+
+    def store_parents(self, sess, parents, first_slot=0):
+        assert first_slot + len(parents) <= self.num_parent_slots
+        for i, (theta, _) in enumerate(parents):
+            sess.run(self.store_parent_op, {self.parent_ph: theta, self.parent_slot: first_slot + i})
+
 
 class BaseModel(object):
     def __init__(self):
@@ -31,6 +76,7 @@ class BaseModel(object):
         self.indices = None
         self.variables = []
         self.description = ""
+        self.layer_kernels = []
 
     @property
     def requires_ref_batch(self):
@@ -61,6 +107,7 @@ class BaseModel(object):
             x_reshape = tf.reshape(x, (-1, x.get_shape()[2], x.get_shape()[3], x.get_shape()[4]))
             patches = tf.extract_image_patches(x_reshape, [1, kernel_size, kernel_size, 1], [1, stride, stride, 1], rates=[1, 1, 1, 1], padding=padding)
             final_shape = (tf.shape(x)[0], tf.shape(x)[1], patches.get_shape()[1].value, patches.get_shape()[2].value, num_outputs)
+            rows = patches.get_shape()[1].value * patches.get_shape()[2].value
             patches = tf.reshape(patches, [tf.shape(x)[0],
                                            -1,
                                            kernel_size * kernel_size * x.get_shape()[-1].value])
@@ -68,7 +115,7 @@ class BaseModel(object):
             if self.indices is None:
                 ret = tf.matmul(patches, w)
             else:
-                ret = indexed_matmul(patches, w, self.indices)
+                ret = self.indexed_matmul(patches, w, name, rows)
             ret = tf.reshape(ret, final_shape)
             self.description += "Convolution layer {} with input shape {} and output shape {}\n".format(name, x.get_shape(), ret.get_shape())
 
@@ -87,7 +134,7 @@ class BaseModel(object):
             if self.indices is None:
                 ret = tf.matmul(x, w)
             else:
-                ret = indexed_matmul(x, w, self.indices)
+                ret = self.indexed_matmul(x, w, name, 1)
             self.description += "Dense layer {} with input shape {} and output shape {}\n".format(name, x.get_shape(), ret.get_shape())
             if bias:
                 b = self.create_bias_variable('b', (1, size, ))
@@ -98,6 +145,17 @@ class BaseModel(object):
             else:
                 return ret
 
+    def indexed_matmul(self, x, w, name, m):
+        """
+        x times the weights w of the policies in self.indices, with the kernel the active kernel profile picks for
+        this layer shape (m rows per policy)
+        """
+        layer = (kernels.device_type(x), self.batch_size, m, w.get_shape()[-2].value, w.get_shape()[-1].value)
+        strategy = kernels.select(layer)
+        self.layer_kernels.append((name, layer, strategy))
+        self.description += "Layer {} uses {} ({})\n".format(name, strategy, kernels.layer_key(*layer))
+        return kernels.STRATEGIES[strategy](x, w, self.indices)
+
     def flattenallbut0(self, x):
         return tf.reshape(x, [-1, tf.shape(x)[1], np.prod(x.get_shape()[2:])])
 
@@ -117,6 +175,17 @@ class BaseModel(object):
     def _make_net(self, x, num_actions):
         raise NotImplementedError()
 
+    def reuse_net(self, x, indices):
+        """
+        Another instance of the network, sharing its variables, evaluated on x for the given indices (e.g. in a tf.while_loop)
+        """
+        tmp, description, layer_kernels = self.indices, self.description, list(self.layer_kernels)
+        self.indices = indices
+        with tf.variable_scope(self.scope, reuse=True):
+            a = self._make_net(x, self.num_actions)
+        self.indices, self.description, self.layer_kernels = tmp, description, layer_kernels
+        return tf.reshape(a, (-1, self.num_actions))
+
     def initialize(self):
         self.make_weights()
 
@@ -125,7 +194,17 @@ class BaseModel(object):
         return self.compute_weights_from_seeds(noise, seeds), seeds
 
     def compute_weights_from_seeds(self, noise, seeds, cache=None):
-        if cache:
+        if isinstance(cache, LineageStore):
+            depth, theta = cache.deepest(seeds)
+            if theta is None:
+                depth, theta = 1, noise.get(seeds[0], self.num_params).copy() * self.scale_by
+                cache.offer(seeds[:1], theta, final=len(seeds) == 1)
+            for i in range(depth, len(seeds)):
+                idx, power = seeds[i]
+                theta = self.compute_mutation(noise, theta, idx, power)
+                cache.offer(seeds[:i + 1], theta, final=i + 1 == len(seeds))
+            return theta
+        elif cache:
             cache_seeds = [o[1] for o in cache]
             if seeds in cache_seeds:
                 return cache[cache_seeds.index(seeds)][0]
@@ -152,6 +231,14 @@ class BaseModel(object):
         theta = self.compute_mutation(noise, parent_theta, idx, mutation_power)
         return theta, seeds
 
+    def mutate_slot(self, parent_slot, parent_seeds, rs, noise, mutation_power):
+        """
+        Same as mutate, for the parent stored in parent_slot of the DeviceNoise: returns a Mutation instead of theta
+        """
+        idx = noise.sample_index(rs, self.num_params)
+        seeds = parent_seeds + ((idx, mutation_power), )
+        return Mutation(parent_slot, idx, mutation_power), seeds
+
     def compute_mutation(self, noise, parent_theta, idx, mutation_power):
         return parent_theta + mutation_power * noise.get(idx, self.num_params)
 
@@ -162,6 +249,22 @@ class BaseModel(object):
         self.seeds[i] = seeds
         return True
 
+    def load_mutations(self, sess, indices, mutations, seeds):
+        """
+        Loads the offspring given as Mutations into slots indices in one session call, returns the slots loaded
+        """
+        todo = [k for k, i in enumerate(indices) if self.seeds[i] != seeds[k]]
+        if not todo:
+            return []
+        sess.run(self.load_mutations_op, {
+            self.mutation_indices: [indices[k] for k in todo],
+            self.mutation_parents: [mutations[k].parent_slot for k in todo],
+            self.mutation_noise_idx: [mutations[k].idx for k in todo],
+            self.mutation_power: [mutations[k].power for k in todo]})
+        for k in todo:
+            self.seeds[indices[k]] = seeds[k]
+        return [indices[k] for k in todo]
+
     def make_weights(self):
         self.num_params = 0
         self.batch_size = 0
@@ -189,4 +292,34 @@ class BaseModel(object):
             assigns.append(tf.scatter_update(v, self.theta_idx, tf.reshape(self.theta[offset:offset+size], shape[1:])))
             offset += size
         self.load_op = tf.group( * assigns)
+        self.shapes = shapes
         self.description += "Number of parameteres: {}".format(self.num_params)
+
+    def make_mutation_ops(self, device_noise):
+        """
+        Builds load_mutations_op, which sets slots mutation_indices to the parents in slots mutation_parents of
+        device_noise plus mutation_power times the noise at mutation_noise_idx, one slot after the other
+        """
+        device_noise.build(self.num_params)
+        self.device_noise = device_noise
+        self.mutation_indices = tf.placeholder(tf.int32, [None])
+        self.mutation_parents = tf.placeholder(tf.int32, [None])
+        self.mutation_noise_idx = tf.placeholder(tf.int32, [None])
+        self.mutation_power = tf.placeholder(tf.float32, [None])
+        num_params = int(self.num_params)
+
+        # One offspring per iteration, so only one theta is ever materialized besides the variables
+        def body(k):
+            with tf.device(device_noise.device):
+                noise = tf.slice(device_noise.noise, tf.reshape(self.mutation_noise_idx[k], [1]), [num_params])
+                theta = tf.gather(device_noise.parents, self.mutation_parents[k]) + self.mutation_power[k] * noise
+            offset = 0
+            assigns = []
+            for (shape, v) in zip(self.shapes, self.variables):
+                size = np.prod(shape[1:])
+                assigns.append(tf.scatter_update(v, self.mutation_indices[k], tf.reshape(theta[offset:offset+size], shape[1:])))
+                offset += size
+            with tf.control_dependencies(assigns):
+                return k + 1
+        self.load_mutations_op = tf.while_loop(lambda k: k < tf.shape(self.mutation_indices)[0], body, [tf.constant(0)],
+                                               parallel_iterations=1, back_prop=False)
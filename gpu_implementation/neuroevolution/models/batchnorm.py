@@ -121,3 +121,9 @@ class ModelVirtualBN(Model):
         ret = super(ModelVirtualBN, self).load(sess, i, *args, **kwargs)
         sess.run(self.ref_batch_assign, {self.ref_batch_idx: i})
         return ret
+
+    def load_mutations(self, sess, *args, **kwargs):
+        ret = super(ModelVirtualBN, self).load_mutations(sess, *args, **kwargs)
+        for i in ret:
+            sess.run(self.ref_batch_assign, {self.ref_batch_idx: i})
+        return ret
@@ -0,0 +1,257 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+"""
+Remote workers for gpu_implementation: a trainer serves the tasks of its AsyncTaskHub over TCP (or a Unix socket) to
+remote_worker.py processes, on this host or others, which evaluate them on their own ConcurrentWorkers next to the
+trainer's local workers.
+
+Messages are pickled by multiprocessing.connection. A task is (task_id, theta, extras, max_frames) where theta is None
+when extras is the seed chain of a GA individual (root seed, then one (idx, power) per mutation): the remote worker
+recomputes it from its own copy of the noise table instead of receiving num_params floats. A result is
+(task_id, (extras, reward, length)). Since messages are unpickled, a server that doesn't listen on loopback or a Unix
+socket requires an authkey.
+"""
+
+import ipaddress
+import threading
+from queue import Empty
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+import tabular_logger as tlogger
+from .models.base import Mutation
+
+
+def parse_address(address):
+    """
+    'host:port' -> (host, port) for TCP, anything else is the path of a Unix socket
+    """
+    if isinstance(address, str) and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+def is_local_address(address):
+    """
+    Whether only this host can connect to address: a Unix socket or a loopback TCP address
+    """
+    if not isinstance(address, tuple):
+        return True
+    host = address[0]
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _authkey(authkey):
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def is_seed_chain(extras):
+    return isinstance(extras, tuple) and len(extras) > 0 and isinstance(extras[0], (int, np.integer))
+
+
+def encode_task(task_id, task):
+    theta, extras, max_frames = task
+    if is_seed_chain(extras):
+        return task_id, None, extras, max_frames
+    if isinstance(theta, Mutation):
+        raise ValueError('Offspring submitted as a Mutation need their seed chain as extras to run remotely')
+    return task_id, theta, extras, max_frames
+
+
+class _RemoteConnection(object):
+    def __init__(self, conn, slots):
+        self.conn = conn
+        self.slots = slots
+        self.credits = threading.Semaphore(slots)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.alive = True
+
+
+class RemoteWorkerServer(object):
+    """
+    Feeds the (task_id, task) pairs of input_queue to the remote workers that connect to address and puts their
+    (task_id, result) on done_queue, which is what WorkerHub does with local workers (both can share the same queues).
+
+    A remote worker announces its number of slots and never has more tasks in flight than that. The tasks in flight
+    on a worker whose connection drops are put back on input_queue for another worker to run.
+    """
+    def __init__(self, input_queue, done_queue, address, authkey=None, hello=None):
+        self.input_queue = input_queue
+        self.done_queue = done_queue
+        self.hello = hello or {}
+        address = parse_address(address)
+        if not authkey and not is_local_address(address):
+            raise ValueError('Remote workers on {} need an authkey, connections are unpickled'.format(address))
+        self.listener = Listener(address, authkey=_authkey(authkey))
+        self.connections = []
+        self.num_frames = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        tlogger.info('Waiting for remote workers on {}'.format(self.listener.address))
+
+    @property
+    def num_slots(self):
+        return sum(c.slots for c in self.connections if c.alive)
+
+    def initialize(self):
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self._closed:
+                    break
+                tlogger.exception('RemoteWorkerServer failed to accept a connection')
+                continue
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        try:
+            conn.send(self.hello)
+            remote = _RemoteConnection(conn, conn.recv()['slots'])
+        except (EOFError, OSError):
+            tlogger.exception('RemoteWorkerServer handshake failed')
+            conn.close()
+            return
+        with self._lock:
+            self.connections.append(remote)
+        tlogger.info('Remote worker connected with {} slots'.format(remote.slots))
+        sender = threading.Thread(target=self._send_tasks, args=(remote,))
+        sender.daemon = True
+        sender.start()
+        try:
+            while True:
+                task_id, result = conn.recv()
+                with remote.lock:
+                    del remote.in_flight[task_id]
+                remote.credits.release()
+                with self._lock:
+                    self.num_frames += int(result[2])
+                self.done_queue.put((task_id, result))
+        except (EOFError, OSError):
+            pass
+        except Exception:
+            tlogger.exception('RemoteWorkerServer._serve exception thrown')
+        self._drop(remote)
+
+    def _drop(self, remote):
+        with remote.lock:
+            remote.alive = False
+            tasks, remote.in_flight = list(remote.in_flight.items()), {}
+        remote.conn.close()
+        with self._lock:
+            self.connections.remove(remote)
+        if not self._closed:
+            tlogger.info('Remote worker disconnected, requeuing its {} tasks'.format(len(tasks)))
+            for task in tasks:
+                self.input_queue.put(task)
+
+    def _send_tasks(self, remote):
+        while remote.alive and not self._closed:
+            if not remote.credits.acquire(timeout=1):
+                continue
+            try:
+                task = self.input_queue.get(timeout=1)
+            except Empty:
+                remote.credits.release()
+                continue
+            if task is None:
+                # Shutdown of the local WorkerHub, leave it for its input handler
+                self.input_queue.put(None)
+                break
+            task_id, task_data = task
+            with remote.lock:
+                if not remote.alive:
+                    self.input_queue.put(task)
+                    break
+                remote.in_flight[task_id] = task_data
+            try:
+                remote.conn.send(encode_task(task_id, task_data))
+            except (EOFError, OSError):
+                # The receiving side requeues everything in flight
+                break
+
+    def close(self):
+        self._closed = True
+        self.listener.close()
+        for remote in list(self.connections):
+            remote.conn.close()
+
+
+def connect(address, authkey=None):
+    """
+    Connects to a RemoteWorkerServer, returns the connection and the server's hello dict
+    """
+    conn = Client(parse_address(address), authkey=_authkey(authkey))
+    return conn, conn.recv()
+
+
+class RemoteWorkerClient(object):
+    """
+    Runs the tasks received on conn on a local ConcurrentWorkers until the server goes away. Thetas sent as seed
+    chains are recomputed through lineage (a LineageStore), the parent first so its siblings only cost one mutation.
+    """
+    def __init__(self, conn, worker, noise, lineage, prefetch=2):
+        self.conn = conn
+        self.worker = worker
+        self.noise = noise
+        self.lineage = lineage
+        self.prefetch = prefetch
+        self._send_lock = threading.Lock()
+
+    def _reply(self, task_id):
+        def callback(result):
+            try:
+                with self._send_lock:
+                    self.conn.send((task_id, result))
+            except (EOFError, OSError):
+                tlogger.info('RemoteWorkerClient lost the connection while sending a result')
+        return callback
+
+    def run(self):
+        # A few tasks per slot in flight so the slots don't idle on the network round trip
+        self.conn.send({'slots': self.worker.num_slots * self.prefetch})
+        num_tasks = 0
+        try:
+            while True:
+                task_id, theta, extras, max_frames = self.conn.recv()
+                if theta is None:
+                    if len(extras) > 1:
+                        self.worker.model.compute_weights_from_seeds(self.noise, extras[:-1], cache=self.lineage)
+                    theta = self.worker.model.compute_weights_from_seeds(self.noise, extras, cache=self.lineage)
+                self.worker.eval_async(theta, extras, max_frames, callback=self._reply(task_id))
+                num_tasks += 1
+        except (EOFError, OSError):
+            tlogger.info('Server closed the connection after {} tasks'.format(num_tasks))
+        finally:
+            self.conn.close()
@@ -28,11 +28,27 @@ def get_available_gpus():
     return [x.name for x in local_device_protos if x.device_type == 'GPU']
 
 
+def cpu_session_config(num_workers, threads_per_worker):
+    """
+    Config of a session shared by num_workers CPU workers. Every worker gets an inter-op thread pool of its own with
+    threads_per_worker threads, selected by passing the worker's RunOptions to sess.run, and intra-op parallelism is
+    limited to the same number of threads so that workers don't oversubscribe the cores.
+    """
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads_per_worker)
+    run_options = []
+    for i in range(num_workers):
+        pool = config.session_inter_op_thread_pool.add()
+        pool.num_threads = threads_per_worker
+        run_options.append(tf.RunOptions(inter_op_thread_pool=i))
+    return config, run_options
+
+
 class WorkerSession(object):
-    def __init__(self, worker):
+    def __init__(self, worker, config=None):
         self._worker = worker
+        self._config = config if config is not None else getattr(worker, 'session_config', None)
     def __enter__(self, *args, **kwargs):
-        self._sess = tf.Session(*args, **kwargs)
+        self._sess = tf.Session(*args, config=self._config, **kwargs)
         self._sess.run(tf.global_variables_initializer())
         self._worker.initialize(self._sess)
 
@@ -0,0 +1,65 @@
+__copyright__ = """
+Copyright (c) 2018 Uber Technologies, Inc.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+"""
+Remote worker for a ga.py or es.py trainer whose experiment config sets "remote": {"address": "0.0.0.0:6000"}
+(plus an "authkey", required unless the address is loopback or a Unix socket). Run it with the same config on any
+host that can reach the trainer:
+
+    python remote_worker.py --connect trainer-host:6000 configurations/ga_atari_config.json
+"""
+
+import argparse
+import json
+from neuroevolution.tf_util import WorkerSession
+from neuroevolution.helper import SharedNoiseTable
+from neuroevolution.concurrent_worker import ConcurrentWorkers
+from neuroevolution.lineage import LineageStore
+from neuroevolution.remote import connect, RemoteWorkerClient
+from neuroevolution import kernels
+import neuroevolution.models
+import gym_tensorflow
+import tabular_logger as tlogger
+
+
+def main(exp, address, authkey=None, prefetch=2):
+    Model = neuroevolution.models.__dict__[exp['model']]
+    if 'kernel_profile' in exp:
+        kernels.set_profile(exp['kernel_profile'])
+    def make_env(b):
+        return gym_tensorflow.make(game=exp["game"], batch_size=b, **exp.get('env_args', {}))
+    conn, hello = connect(address, authkey or exp.get('remote', {}).get('authkey'))
+    tlogger.info('Connected to {}'.format(address))
+    noise = SharedNoiseTable()
+    worker = ConcurrentWorkers(make_env, Model, batch_size=64, unroll_steps=exp.get('unroll_steps', 1),
+                               ref_batch=hello.get('ref_batch'), **exp.get('cpu', {}))
+    with WorkerSession(worker):
+        RemoteWorkerClient(conn, worker, noise, LineageStore(**exp.get('lineage', {})), prefetch=prefetch).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connect', required=True, help='host:port (or Unix socket path) of the trainer')
+    parser.add_argument('--authkey', default=None)
+    parser.add_argument('--prefetch', type=int, default=2, help='tasks in flight per slot')
+    parser.add_argument('config')
+    args = parser.parse_args()
+    with open(args.config, 'r') as f:
+        exp = json.loads(f.read())
+    main(exp, args.connect, args.authkey, args.prefetch)